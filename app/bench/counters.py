@@ -0,0 +1,65 @@
+import threading
+from typing import Dict
+
+from pymongo import monitoring
+
+# Path: app/bench/counters.py
+
+# Count the Mongo commands issued during a benchmark step.
+
+class CommandCounter(monitoring.CommandListener):
+    """
+    Commands started against a real mongod, register before the MongoClient is created
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.commands = {}
+
+    def started(self, event):
+        with self._lock:
+            self.commands[event.command_name] = self.commands.get(event.command_name, 0) + 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+    def reset(self):
+        with self._lock:
+            self.commands = {}
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.commands)
+
+# mongomock issues no commands, the collection methods standing for one round trip each are counted instead
+MONGOMOCK_METHODS = ["aggregate", "find", "find_one", "find_one_and_update", "distinct", "insert_one", "insert_many",
+    "replace_one", "update_one", "update_many", "delete_many", "bulk_write", "create_indexes", "count_documents"]
+
+_mongomock_depth = threading.local()
+
+def count_mongomock_calls(counter: CommandCounter):
+    import mongomock
+
+    for name in MONGOMOCK_METHODS:
+        method = getattr(mongomock.collection.Collection, name, None)
+
+        if method is None:
+            continue
+
+        def counted(self, *args, _name=name, _method=method, **kwargs):
+            depth = getattr(_mongomock_depth, "value", 0)
+
+            # mongomock methods call each other, only the outermost call is a round trip
+            if depth == 0:
+                counter.started(type("Event", (), {"command_name": _name}))
+
+            _mongomock_depth.value = depth + 1
+            try:
+                return _method(self, *args, **kwargs)
+            finally:
+                _mongomock_depth.value = depth
+
+        setattr(mongomock.collection.Collection, name, counted)
@@ -0,0 +1,72 @@
+import random
+from datetime import datetime, timedelta
+from typing import Dict, Iterator, List, Optional
+
+# Path: app/bench/generator.py
+
+# Synthetic miniapp journeys with a Zipfian miniapp popularity, built with make_miniapp_journey/make_miniapp_node.
+
+DEFAULT_OS_MIX = {"IOS": 0.45, "Android": 0.5, "Web": 0.05}
+
+class JourneyGenerator:
+    """
+    :param users: number of distinct agents
+    :param sessions_per_day: mean journeys per user and day
+    :param mean_path_length: mean number of miniapps of a journey, lengths follow a geometric distribution
+    :param max_path_length: longest journey
+    :param miniapps: number of distinct miniapps
+    :param zipf_s: exponent of the miniapp popularity, 0 is uniform
+    :param os_mix: device_os -> weight, every user keeps one device_os
+    """
+
+    def __init__(self, users: int = 1000, sessions_per_day: float = 2.0, mean_path_length: float = 3.0, max_path_length: int = 10,
+            miniapps: int = 50, zipf_s: float = 1.1, os_mix: Optional[Dict[str, float]] = None, seed: int = 0):
+        self.users = users
+        self.sessions_per_day = sessions_per_day
+        self.mean_path_length = mean_path_length
+        self.max_path_length = max_path_length
+        self.miniapps = [f"miniapp {i}" for i in range(miniapps)]
+        self.entity_ids = {name: i for i, name in enumerate(self.miniapps)}
+        self.random = random.Random(seed)
+
+        self.popularity = [1.0 / (rank ** zipf_s) for rank in range(1, miniapps + 1)]
+
+        os_mix = os_mix or DEFAULT_OS_MIX
+        self.user_os = self.random.choices(list(os_mix.keys()), weights=list(os_mix.values()), k=users)
+
+    def path_length(self) -> int:
+        length = 1
+        p = 1.0 / self.mean_path_length
+
+        while length < self.max_path_length and self.random.random() > p:
+            length += 1
+
+        return length
+
+    def path(self) -> List[str]:
+        return self.random.choices(self.miniapps, weights=self.popularity, k=self.path_length())
+
+    def sessions(self) -> int:
+        # poisson number of sessions by counting exponential arrivals in one day
+        count, t = 0, self.random.expovariate(self.sessions_per_day)
+
+        while t < 1.0:
+            count += 1
+            t += self.random.expovariate(self.sessions_per_day)
+
+        return count
+
+    def journeys(self, start_date: datetime, days: int) -> Iterator[Dict]:
+        from utils import make_miniapp_journey, make_miniapp_node
+
+        for day in range(days):
+            journey_date = start_date + timedelta(days=day)
+
+            for agent_id in range(self.users):
+                for session in range(self.sessions()):
+                    path = None
+                    for entity_name in reversed(self.path()):
+                        path = make_miniapp_node(self.entity_ids[entity_name], entity_name, path)
+
+                    journey_id = f"{agent_id}-{journey_date:%Y%m%d}-{session}"
+                    yield make_miniapp_journey(agent_id, journey_id, journey_date, self.user_os[agent_id], path)
@@ -0,0 +1,177 @@
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional
+
+from bench.counters import CommandCounter, count_mongomock_calls
+from bench.generator import JourneyGenerator
+
+# Path: app/bench/run.py
+
+# Offline benchmark of the hot paths on synthetic journeys, run from the app directory:
+#
+#   python -m bench.run --mongomock
+#   python -m bench.run --uri mongodb://localhost:27017/ --users 5000 --days 14 --output bench.json
+#
+# The database is wiped and loaded with the synthetic journeys, so never point --uri at a real deployment.
+# Every step reports latency percentiles and the Mongo commands it issued per iteration.
+
+def percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(q / 100.0 * len(ordered))) - 1))]
+
+def measure(name: str, fn: Callable, counter: CommandCounter, iterations: int, setup: Optional[Callable] = None) -> Dict:
+    latencies = []
+    commands = []
+
+    for _ in range(iterations):
+        if setup:
+            setup()
+
+        counter.reset()
+        start = time.perf_counter()
+        fn()
+        latencies.append((time.perf_counter() - start) * 1000)
+        commands.append(counter.snapshot())
+
+    return {
+        "step": name,
+        "iterations": iterations,
+        "p50_ms": round(percentile(latencies, 50), 3),
+        "p90_ms": round(percentile(latencies, 90), 3),
+        "p99_ms": round(percentile(latencies, 99), 3),
+        "mean_ms": round(sum(latencies) / len(latencies), 3),
+        "commands": max(sum(c.values()) for c in commands),
+        "commands_by_name": commands[-1],
+    }
+
+def parse_os_mix(value: str) -> Dict[str, float]:
+    return {name: float(weight) for name, weight in (item.split("=") for item in value.split(","))}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the journey queries on synthetic data")
+    parser.add_argument("--mongomock", action="store_true", help="run on mongomock instead of a mongod")
+    parser.add_argument("--uri", default="mongodb://localhost:27017/", help="disposable mongod to load the journeys into")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--days", type=int, default=14)
+    parser.add_argument("--sessions-per-day", type=float, default=2.0)
+    parser.add_argument("--mean-path-length", type=float, default=3.0)
+    parser.add_argument("--max-path-length", type=int, default=10)
+    parser.add_argument("--miniapps", type=int, default=50)
+    parser.add_argument("--zipf", type=float, default=1.1, help="exponent of the miniapp popularity")
+    parser.add_argument("--os-mix", type=parse_os_mix, default=None, help="e.g. IOS=0.45,Android=0.5,Web=0.05")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--iterations", type=int, default=10)
+    parser.add_argument("--skip-load", action="store_true", help="reuse the journeys loaded by a previous run")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args(argv)
+
+    # the client of utils is created at import, so the backend is chosen before importing the app modules
+    counter = CommandCounter()
+
+    if args.mongomock:
+        import mongomock
+        import pymongo
+
+        pymongo.MongoClient = mongomock.MongoClient
+        count_mongomock_calls(counter)
+    else:
+        from pymongo import monitoring
+
+        monitoring.register(counter)
+        os.environ["MONGO_URI"] = args.uri
+
+    import utils
+    from cache import RESULT_CACHES, invalidate_dates
+    from entities import register_entities
+    from indexes import ensure_indexes
+    from path_trie import PathTrie, _tries
+    from miniapp_journey import build_root_node, build_tree_leaf_filter, get_first_nodes, get_top_journeys_from_node, get_path_tree
+    from serialization import iter_json_rows
+
+    start_date = datetime(2023, 6, 1)
+    ds = start_date + timedelta(days=args.days - 1)
+    granularity = utils.Granularity.DAILY
+
+    if not args.skip_load:
+        generator = JourneyGenerator(args.users, args.sessions_per_day, args.mean_path_length, args.max_path_length,
+            args.miniapps, args.zipf, args.os_mix, args.seed)
+
+        utils.miniapp_collection.delete_many({})
+        ensure_indexes()
+
+        batch = []
+        loaded = 0
+        for journey in generator.journeys(start_date, args.days):
+            batch.append(journey)
+
+            if len(batch) >= 1000:
+                utils.miniapp_collection.insert_many(batch, ordered=False)
+                loaded += len(batch)
+                batch = []
+
+        if batch:
+            utils.miniapp_collection.insert_many(batch, ordered=False)
+            loaded += len(batch)
+
+        register_entities((entity_id, name) for name, entity_id in generator.entity_ids.items())
+        invalidate_dates(start_date + timedelta(days=i) for i in range(args.days))
+        print(f"loaded {loaded} journeys over {args.days} days", file=sys.stderr)
+
+    def clear_caches():
+        for cache in RESULT_CACHES:
+            cache.clear_memory()
+            cache.collection.delete_many({})
+
+        _tries.clear()
+
+    root_node = build_root_node(ds, granularity)
+    paths = utils.find_all_path_from_node(utils.miniapp_collection, root_node)
+    top_path = max(utils.retrieve_batch_journey_statistics(utils.miniapp_collection, ds, granularity, root_node["filter"]).items(),
+        key=lambda item: item[1]["sessions"])[0]
+
+    def tree_with_filters():
+        tree = PathTrie.from_paths(paths.keys()).build_tree()
+        utils.prepare_tree_filter(tree)
+        return tree
+
+    def sketch_tree():
+        tree = PathTrie.from_paths(paths.keys()).build_tree()
+        leaf_filter = build_tree_leaf_filter(ds, granularity, root_node["filter"], None, 0)
+        leaves = utils.build_leaf_period_stats(utils.miniapp_collection.aggregate(utils.build_leaf_sketch_pipeline(leaf_filter, ds), allowDiskUse=True))
+        utils.attach_leaf_paths(tree, leaves.keys(), -1)
+        utils.collect_tree_stat_from_leaves(tree, leaves)
+
+    steps = [
+        ("find_all_path_from_node", lambda: utils.find_all_path_from_node(utils.miniapp_collection, root_node), None),
+        ("retrieve_journey_statistics", lambda: utils.retrieve_journey_statistics(utils.miniapp_collection, ds, granularity, (top_path, paths[top_path])), None),
+        ("retrieve_batch_journey_statistics", lambda: utils.retrieve_batch_journey_statistics(utils.miniapp_collection, ds, granularity, root_node["filter"]), None),
+        # gen_sub_paths/build_tree were replaced by the path trie
+        ("path_trie_build_tree", lambda: PathTrie.from_paths(paths.keys()).build_tree(), None),
+        ("collect_tree_stat", lambda: utils.collect_tree_stat(utils.miniapp_collection, ds, granularity, tree_with_filters()), None),
+        ("collect_tree_stat_from_leaves", sketch_tree, None),
+        ("first_nodes_cold", lambda: get_first_nodes(ds, granularity), clear_caches),
+        ("first_nodes_warm", lambda: get_first_nodes(ds, granularity), None),
+        ("top_paths_cold", lambda: b"".join(iter_json_rows(get_top_journeys_from_node(ds, granularity))), clear_caches),
+        ("top_paths_warm", lambda: b"".join(iter_json_rows(get_top_journeys_from_node(ds, granularity))), None),
+        ("tree_cold", lambda: get_path_tree(ds, granularity), clear_caches),
+        ("tree_warm", lambda: get_path_tree(ds, granularity), None),
+    ]
+
+    results = []
+    for name, fn, setup in steps:
+        result = measure(name, fn, counter, args.iterations, setup)
+        results.append(result)
+        print(f"{name:36} p50 {result['p50_ms']:10.3f} ms  p90 {result['p90_ms']:10.3f} ms  p99 {result['p99_ms']:10.3f} ms  commands {result['commands']}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"args": {k: v for k, v in vars(args).items()}, "results": results}, f, indent=2, default=str)
+
+    return results
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+from contextvars import ContextVar
+import asyncio
+import os
+import time
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from fastapi import Request, Response, status
+from pymongo.errors import ExecutionTimeout
+
+from serialization import dumps, json_response
+
+# Path: app/budget.py
+
+# Budget of the queries of one request. Its deadline becomes the maxTimeMS of every find/aggregate, the paths
+# discovered and the tree nodes queried one by one are capped, and the request is cancelled when its client goes
+# away. The checks run between the queries, a query already sent is bounded by its maxTimeMS. Work done outside a
+# request (cache warmer, CLIs) has no budget.
+
+QUERY_BUDGET_SECONDS = float(os.environ.get("QUERY_BUDGET_SECONDS", 30))
+# distinct paths of a period loaded to build its trie
+MAX_DISCOVERED_PATHS = int(os.environ.get("MAX_DISCOVERED_PATHS", 200000))
+# tree nodes getting their stats from their own queries (TREE_STATS_MODE query and prune)
+MAX_TREE_STAT_NODES = int(os.environ.get("MAX_TREE_STAT_NODES", 2000))
+# how often a running request checks that its client is still connected
+DISCONNECT_POLL_SECONDS = float(os.environ.get("DISCONNECT_POLL_SECONDS", 0.5))
+
+# nginx's status of the requests closed by the client, only seen in the metrics
+CLIENT_CLOSED_REQUEST = 499
+
+class BudgetExceeded(Exception):
+    """
+    The request needs more time, paths or tree nodes than its budget, answered 503
+    """
+
+class QueryCancelled(Exception):
+    """
+    The client of the request went away, its remaining queries are not run
+    """
+
+class QueryBudget:
+    __slots__ = ("deadline", "cancelled")
+
+    def __init__(self, seconds: Optional[float] = None):
+        self.deadline = time.monotonic() + (QUERY_BUDGET_SECONDS if seconds is None else seconds)
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def remaining_ms(self) -> int:
+        return int((self.deadline - time.monotonic()) * 1000)
+
+    def check(self):
+        if self.cancelled:
+            raise QueryCancelled()
+
+        if self.remaining_ms() <= 0:
+            raise BudgetExceeded(f"the request ran out of its {QUERY_BUDGET_SECONDS:g}s query budget")
+
+current_budget = ContextVar("current_budget", default=None)
+
+def check_budget():
+    """
+    Raise QueryCancelled or BudgetExceeded when the request of the current context must stop
+    """
+    budget = current_budget.get()
+
+    if budget is not None:
+        budget.check()
+
+def max_time_ms() -> Optional[int]:
+    """
+    maxTimeMS of the next query of the current context, None without budget
+    """
+    budget = current_budget.get()
+
+    if budget is None:
+        return None
+
+    budget.check()
+
+    return budget.remaining_ms()
+
+def aggregate_options() -> Dict:
+    """
+    Keyword arguments of Collection.aggregate bounding it by the budget
+    """
+    ms = max_time_ms()
+
+    return {} if ms is None else {"maxTimeMS": ms}
+
+def find_options() -> Dict:
+    """
+    Keyword arguments of Collection.find bounding it by the budget
+    """
+    ms = max_time_ms()
+
+    return {} if ms is None else {"max_time_ms": ms}
+
+def discovery_limit() -> List[Dict]:
+    """
+    Stages ending a path discovery aggregation, one path more than the budget allows is enough to refuse it. The
+    row of the journeys without a path is not a path, hence + 2
+    """
+    return [] if current_budget.get() is None else [{"$limit": MAX_DISCOVERED_PATHS + 2}]
+
+def check_discovered_paths(count: int):
+    if current_budget.get() is not None and count > MAX_DISCOVERED_PATHS:
+        raise BudgetExceeded(f"more than {MAX_DISCOVERED_PATHS} paths match the request, narrow it with device_os or a node")
+
+def check_tree_nodes(count: int):
+    if current_budget.get() is not None and count > MAX_TREE_STAT_NODES:
+        raise BudgetExceeded(f"the tree has {count} nodes, more than {MAX_TREE_STAT_NODES}, narrow it with device_os or a deeper node")
+
+def budget_exceeded_response(message: str) -> Response:
+    return json_response(dumps({"message": message}), status_code=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+async def run_with_budget(request: Request, respond: Callable[[], Awaitable[Response]]) -> Response:
+    """
+    Response of respond run under a new QueryBudget, 503 when the budget is exceeded
+
+    respond runs in its own task, cancelled with its budget when the client disconnects. The blocking queries of the
+    threadpool cannot be interrupted, they stop at their next budget check.
+    """
+    budget = QueryBudget()
+    token = current_budget.set(budget)
+
+    try:
+        # the task runs in a copy of the context, the budget included
+        task = asyncio.ensure_future(respond())
+    finally:
+        current_budget.reset(token)
+
+    # the error of a task abandoned by a disconnected client is not re-raised
+    task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+    try:
+        while not task.done():
+            await asyncio.wait({task}, timeout=DISCONNECT_POLL_SECONDS)
+
+            if not task.done() and await request.is_disconnected():
+                budget.cancel()
+                task.cancel()
+
+                return Response(status_code=CLIENT_CLOSED_REQUEST)
+    except asyncio.CancelledError:
+        budget.cancel()
+        task.cancel()
+        raise
+
+    try:
+        return task.result()
+    except BudgetExceeded as e:
+        return budget_exceeded_response(str(e))
+    except ExecutionTimeout:
+        return budget_exceeded_response(f"a query ran out of the {QUERY_BUDGET_SECONDS:g}s query budget")
@@ -0,0 +1,726 @@
+from utils import *
+
+from collections import OrderedDict
+import asyncio
+import socket
+import threading
+import time
+
+from pymongo import ASCENDING, IndexModel, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
+
+from serialization import encode, compress, decompress, pack_payload, unpack_payload, RAW, JSON, JSON_ROWS, IDENTITY
+from metrics import timed_phase
+from budget import check_budget, find_options, QueryCancelled
+
+# Path: app/cache.py
+
+# Two tier result cache: a bounded in-process LRU in front of a Mongo collection with a TTL index.
+#
+# Every entry records the version of the journey dates its result depends on. Ingesting journeys for a date
+# bumps the version of that date (invalidate_dates) and every entry covering it becomes a miss. Renaming an entity
+# bumps the version of every set of dates (count_renames), the results carry entity names.
+#
+# Encoded payloads (JSON, JSON_ROWS) are stored compressed in Mongo. A compressed payload larger than
+# CACHE_CHUNK_BYTES is split into the documents of the <name>_chunks collection, away from the 16 MB BSON limit,
+# and decompressed chunk by chunk as the cursor returns them. The decompressed payload is then held whole, in the
+# memory tier too: payloads are kept small by caching every page of top paths as its own entry, not streamed.
+# RAW data is stored as BSON.
+#
+# A miss is computed once however many requests ask for it at the same time: the requests of one process wait for
+# the one computing it (single flight), and across processes the computing one holds a lease in cache_leases while
+# the others poll the cache for its result. A computing request whose client went away hands the miss over to
+# the next waiting one.
+
+DEFAULT_MEMORY_SIZE = int(os.environ.get("CACHE_MEMORY_SIZE", 256))
+DEFAULT_TTL = int(os.environ.get("CACHE_TTL_SECONDS", 7 * 24 * 3600))
+# how long a process trusts the date versions it has read before asking Mongo again
+VERSION_REFRESH_SECONDS = float(os.environ.get("CACHE_VERSION_REFRESH_SECONDS", 5))
+# payloads smaller than this are stored uncompressed
+COMPRESS_MIN_BYTES = int(os.environ.get("CACHE_COMPRESS_MIN_BYTES", 1024))
+CHUNK_BYTES = int(os.environ.get("CACHE_CHUNK_BYTES", 4 * 1024 * 1024))
+# compressed payloads larger than this are not stored in Mongo, the result is computed again by the next process
+MAX_STORED_BYTES = int(os.environ.get("CACHE_MAX_STORED_BYTES", 64 * 1024 * 1024))
+# encoded bytes held by the in-process tier of one cache, a payload larger than an eighth of it is not kept in memory
+DEFAULT_MEMORY_BYTES = int(os.environ.get("CACHE_MEMORY_BYTES", 256 * 1024 * 1024))
+
+# a lease is renewed every third of this delay while its process computes, a crashed process only delays the others
+# that much. A None result keeps the lease that long as a marker, the other processes return None without computing
+LEASE_SECONDS = float(os.environ.get("CACHE_LEASE_SECONDS", 120))
+LEASE_POLL_SECONDS = float(os.environ.get("CACHE_LEASE_POLL_SECONDS", 0.1))
+USE_LEASES = os.environ.get("CACHE_LEASES", "1") == "1"
+
+DUPLICATE_KEY = 11000
+
+cache_version_collection = journey_db["cache_versions"]
+# one document counting the entity renames
+cache_rename_collection = journey_db["cache_entity_renames"]
+cache_lease_collection = journey_db["cache_leases"]
+
+LEASE_INDEXES = [
+    IndexModel([("expire_at", ASCENDING)], name="expire_at_ttl", expireAfterSeconds=0),
+]
+
+# journey date -> (version, monotonic time it was read, last ingestion into the date)
+_date_versions = {}
+_date_versions_lock = threading.Lock()
+# (renames, monotonic time they were read)
+_renames = (0, float("-inf"))
+
+def to_day(value) -> datetime:
+    return datetime(year=value.year, month=value.month, day=value.day)
+
+def covered_dates(start_date: datetime, granularity: Granularity, with_previous: bool = False) -> List[datetime]:
+    """
+    Days of journey_date a result computed for (start_date, granularity) depends on
+
+    :param with_previous: also cover the previous period, used by the statistics comparing both periods
+    """
+    days = int(granularity)
+    first = to_day(start_date) - timedelta(days=days if with_previous else 0)
+
+    return [first + timedelta(days=i) for i in range(days * 2 if with_previous else days)]
+
+def fresh_dates_version(dates: List[datetime]) -> Optional[int]:
+    """
+    Version of the dates from the versions already read by this process, None if one of them must be read again
+    """
+    now = time.monotonic()
+    renames, read_at = _renames
+
+    if now - read_at > VERSION_REFRESH_SECONDS:
+        return None
+
+    with _date_versions_lock:
+        if any(d not in _date_versions or now - _date_versions[d][1] > VERSION_REFRESH_SECONDS for d in dates):
+            return None
+
+        return sum(_date_versions[d][0] for d in dates) + renames
+
+def get_renames() -> int:
+    """
+    Number of entity renames, read from Mongo when this process has no fresh copy
+    """
+    global _renames
+
+    renames, read_at = _renames
+
+    if time.monotonic() - read_at > VERSION_REFRESH_SECONDS:
+        row = cache_rename_collection.find_one({"_id": "renames"})
+        renames = row["version"] if row else 0
+        _renames = (renames, time.monotonic())
+
+    return renames
+
+def count_renames(count: int):
+    """
+    Record entity renames, every cache entry is invalidated
+    """
+    global _renames
+
+    row = cache_rename_collection.find_one_and_update({"_id": "renames"}, {"$inc": {"version": count}}, upsert=True, return_document=ReturnDocument.AFTER)
+    _renames = (row["version"], time.monotonic())
+
+def _read_date_versions(dates: List[datetime]):
+    now = time.monotonic()
+
+    with _date_versions_lock:
+        stale = [d for d in dates if d not in _date_versions or now - _date_versions[d][1] > VERSION_REFRESH_SECONDS]
+
+    if stale:
+        fetched = {d: (0, now, None) for d in stale}
+
+        for row in cache_version_collection.find({"_id": {"$in": stale}}):
+            fetched[row["_id"]] = (row["version"], now, row.get("written_at"))
+
+        with _date_versions_lock:
+            _date_versions.update(fetched)
+
+    with _date_versions_lock:
+        return {d: _date_versions[d] for d in dates}
+
+def get_date_versions(dates: List[datetime]) -> Dict[datetime, int]:
+    """
+    Version of every date, read from Mongo when this process has no fresh copy
+    """
+    return {d: version for d, (version, _, _) in _read_date_versions(dates).items()}
+
+def get_dates_written_at(dates: List[datetime]) -> Dict[datetime, Optional[datetime]]:
+    """
+    Last ingestion into every date, None for the dates never written since the versions record it
+    """
+    return {d: written_at for d, (_, _, written_at) in _read_date_versions(dates).items()}
+
+def get_dates_version(dates: List[datetime]) -> int:
+    """
+    Version of a set of journey dates, the sum of per date counters and of the entity renames, which only ever
+    increase
+    """
+    version = fresh_dates_version(dates)
+
+    if version is not None:
+        return version
+
+    return sum(get_date_versions(dates).values()) + get_renames()
+
+def invalidate_dates(dates) -> List[datetime]:
+    """
+    Bump the version of the given journey dates, every cache entry depending on one of them is invalidated
+
+    :return: the distinct days bumped
+    """
+    days = sorted({to_day(d) for d in dates})
+
+    for day in days:
+        row = cache_version_collection.find_one_and_update({"_id": day}, {"$inc": {"version": 1}, "$set": {"written_at": datetime.utcnow()}},
+            upsert=True, return_document=ReturnDocument.AFTER)
+
+        with _date_versions_lock:
+            _date_versions[day] = (row["version"], time.monotonic(), row["written_at"])
+
+    return days
+
+def lease_owner() -> str:
+    # read on every call, the gunicorn workers fork after the import
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def acquire_lease(lease_id: str) -> bool:
+    """
+    Take the lease unless another process holds it and it has not expired
+    """
+    now = datetime.utcnow()
+
+    try:
+        # an expired empty marker taken over no longer stands for a None result
+        cache_lease_collection.update_one({"_id": lease_id, "expire_at": {"$lte": now}},
+            {"$set": {"owner": lease_owner(), "expire_at": now + timedelta(seconds=LEASE_SECONDS)}, "$unset": {"empty": ""}}, upsert=True)
+    except DuplicateKeyError:
+        # the lease exists and is still valid, the upsert collided with it
+        return False
+
+    return True
+
+def renew_lease(lease_id: str, **fields):
+    expire_at = datetime.utcnow() + timedelta(seconds=LEASE_SECONDS)
+    cache_lease_collection.update_one({"_id": lease_id, "owner": lease_owner()}, {"$set": dict(fields, expire_at=expire_at)})
+
+def release_lease(lease_id: str):
+    cache_lease_collection.delete_one({"_id": lease_id, "owner": lease_owner()})
+
+def mark_lease_empty(lease_id: str):
+    """
+    Keep the lease as the marker of a None result, its waiters stop polling and no process computes it again before
+    it expires
+    """
+    renew_lease(lease_id, empty=True)
+
+def lease_is_empty(lease_id: str) -> bool:
+    lease = cache_lease_collection.find_one({"_id": lease_id}, {"empty": 1})
+
+    return lease is not None and lease.get("empty", False)
+
+class LeaseHeartbeat:
+    """
+    Renew a lease every LEASE_SECONDS / 3 from a daemon thread while the computation holding it runs
+    """
+
+    def __init__(self, lease_id: str):
+        self.lease_id = lease_id
+        self._stopped = threading.Event()
+
+    def _run(self):
+        while not self._stopped.wait(LEASE_SECONDS / 3):
+            try:
+                renew_lease(self.lease_id)
+            except PyMongoError:
+                # the next beat retries, the lease may expire meanwhile and another process compute too
+                pass
+
+    def __enter__(self):
+        threading.Thread(target=self._run, name=f"lease heartbeat {self.lease_id}", daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        # not joined, a beat after the release matches no lease
+        self._stopped.set()
+
+class Flight:
+    """
+    One computation of a miss shared by the threads asking for the same key
+    """
+    __slots__ = ("done", "data", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.data = None
+        self.error = None
+
+class ResultCache:
+    """
+    Cache of the results of one query type, stored in the Mongo collection of the same name
+
+    :param name: name of the Mongo collection
+    :param key_fields: fields identifying an entry, values must be BSON encodable
+    :param memory_size: maximum number of entries kept in process
+    :param ttl: seconds an entry lives in Mongo and in memory
+    :param format: how the data is stored and returned, see serialization.encode
+    :param memory_bytes: maximum encoded bytes kept in process, RAW entries are only bounded by memory_size
+    """
+
+    def __init__(self, name: str, key_fields: List[str], memory_size: int = DEFAULT_MEMORY_SIZE, ttl: int = DEFAULT_TTL, format: str = RAW,
+            memory_bytes: int = DEFAULT_MEMORY_BYTES):
+        self.name = name
+        self.key_fields = key_fields
+        self.memory_size = memory_size
+        self.memory_bytes = memory_bytes
+        self.ttl = ttl
+        self.format = format
+
+        self._memory = OrderedDict()
+        self._memory_used = 0
+        self._lock = threading.Lock()
+        self.counters = {"memory_hits": 0, "mongo_hits": 0, "misses": 0, "evictions": 0, "stale": 0, "oversized": 0, "chunked": 0,
+            "coalesced": 0, "lease_waits": 0}
+        # (memory key, version) -> Flight, or the asyncio.Future of the async endpoints
+        self._flights = {}
+        self._async_flights = {}
+
+    @property
+    def collection(self) -> Collection:
+        return journey_db[self.name]
+
+    @property
+    def chunk_collection(self) -> Collection:
+        return journey_db[self.name + "_chunks"]
+
+    def index_models(self) -> List[IndexModel]:
+        return [
+            IndexModel([(field, ASCENDING) for field in self.key_fields], name="cache_key", unique=True),
+            IndexModel([("expire_at", ASCENDING)], name="expire_at_ttl", expireAfterSeconds=0),
+        ]
+
+    def chunk_index_models(self) -> List[IndexModel]:
+        return [
+            IndexModel([(field, ASCENDING) for field in self.key_fields] + [("version", ASCENDING), ("n", ASCENDING)], name="cache_key_chunk", unique=True),
+            IndexModel([("expire_at", ASCENDING)], name="expire_at_ttl", expireAfterSeconds=0),
+        ]
+
+    def _size(self, data) -> int:
+        if self.format == JSON:
+            return len(data)
+
+        if self.format == JSON_ROWS:
+            return sum(len(row) for row in data)
+
+        return 0
+
+    def make_key(self, **key) -> Dict:
+        return SON((field, key.get(field)) for field in self.key_fields)
+
+    def _memory_key(self, key: Dict) -> Tuple:
+        return tuple(key[field] for field in self.key_fields)
+
+    def _count(self, counter: str):
+        with self._lock:
+            self.counters[counter] += 1
+
+    def _remember(self, memory_key: Tuple, version: int, expire_at: datetime, data):
+        size = self._size(data)
+
+        with self._lock:
+            previous = self._memory.pop(memory_key, None)
+            if previous is not None:
+                self._memory_used -= previous[3]
+
+            if size * 8 > self.memory_bytes:
+                return
+
+            self._memory[memory_key] = (version, expire_at, data, size)
+            self._memory_used += size
+
+            while len(self._memory) > self.memory_size or self._memory_used > self.memory_bytes:
+                _, entry = self._memory.popitem(last=False)
+                self._memory_used -= entry[3]
+                self.counters["evictions"] += 1
+
+    def _get_memory(self, memory_key: Tuple, version: int):
+        with self._lock:
+            entry = self._memory.get(memory_key)
+
+            if entry is not None:
+                if entry[0] == version and entry[1] > datetime.utcnow():
+                    self._memory.move_to_end(memory_key)
+                    self.counters["memory_hits"] += 1
+                    return entry[2]
+
+                del self._memory[memory_key]
+                self._memory_used -= entry[3]
+
+        return None
+
+    def _read_data(self, key: Dict, version: int, document: Dict):
+        """
+        The data of a cache document, decompressed from its chunks if it was split
+
+        :raise ValueError: when the payload cannot be read back (chunks expired or missing, codec not installed)
+        """
+        if self.format == RAW or "codec" not in document:
+            return document["data"]
+
+        if "chunks" in document:
+            chunk_filter = SON(key)
+            chunk_filter["version"] = version
+
+            cursor = self.chunk_collection.find(chunk_filter, {"_id": 0, "n": 1, "data": 1}, **find_options()).sort("n", ASCENDING)
+            expected = iter(range(document["chunks"]))
+
+            def read_chunks():
+                for row in cursor:
+                    if row["n"] != next(expected, None):
+                        raise ValueError("cache chunks out of order")
+
+                    yield row["data"]
+
+            payload = decompress(document["codec"], read_chunks())
+
+            if next(expected, None) is not None:
+                raise ValueError("cache chunks missing")
+        else:
+            payload = decompress(document["codec"], [document["data"],])
+
+        return unpack_payload(payload, self.format)
+
+    def _get_mongo(self, key: Dict, version: int, count_miss: bool = True):
+        document = self.collection.find_one(key, **find_options())
+
+        if document is None:
+            if count_miss:
+                self._count("misses")
+            return None
+
+        if document.get("version") != version or document.get("format", RAW) != self.format or document.get("expire_at", datetime.max) <= datetime.utcnow():
+            self._count("stale")
+            return None
+
+        try:
+            data = self._read_data(key, version, document)
+        except ValueError:
+            self._count("stale")
+            return None
+
+        self._count("mongo_hits")
+        self._remember(self._memory_key(key), version, document["expire_at"], data)
+
+        return data
+
+    def get(self, key: Dict, version: int):
+        """
+        Cached data of the key if it was computed at this version, None otherwise
+        """
+        data = self._get_memory(self._memory_key(key), version)
+
+        if data is None:
+            data = self._get_mongo(key, version)
+
+        return data
+
+    def set(self, key: Dict, version: int, data):
+        """
+        Store the data encoded in the cache format
+
+        :return: the encoded data, as get returns it
+        """
+        expire_at = datetime.utcnow() + timedelta(seconds=self.ttl)
+
+        with timed_phase("serialize"):
+            data = encode(data, self.format)
+
+            if self.format != RAW:
+                payload = pack_payload(data, self.format)
+                codec, payload = compress(payload) if len(payload) >= COMPRESS_MIN_BYTES else (IDENTITY, payload)
+
+        document = SON(key)
+        document.update(version=version, format=self.format, expire_at=expire_at)
+
+        if self.format == RAW:
+            document["data"] = data
+            self.collection.replace_one(key, document, upsert=True)
+        elif len(payload) > MAX_STORED_BYTES:
+            self._count("oversized")
+        else:
+            document["codec"] = codec
+
+            if len(payload) <= CHUNK_BYTES:
+                document["data"] = payload
+            else:
+                document["chunks"] = self._write_chunks(key, version, expire_at, payload)
+
+            self.collection.replace_one(key, document, upsert=True)
+
+        self._remember(self._memory_key(key), version, expire_at, data)
+
+        return data
+
+    def _write_chunks(self, key: Dict, version: int, expire_at: datetime, payload: bytes) -> int:
+        """
+        Store a payload split in CHUNK_BYTES documents, written before the entry pointing to them
+
+        :return: number of chunks
+        """
+        # the chunks of every version of the key, the older ones are no longer reachable
+        self.chunk_collection.delete_many(key)
+
+        chunks = []
+        for n, start in enumerate(range(0, len(payload), CHUNK_BYTES)):
+            chunk = SON(key)
+            chunk.update(version=version, n=n, expire_at=expire_at, data=payload[start:start + CHUNK_BYTES])
+            chunks.append(chunk)
+
+        try:
+            self.chunk_collection.insert_many(chunks, ordered=False)
+        except BulkWriteError as e:
+            # another process stored the same version meanwhile, its chunks hold the same payload
+            if any(error["code"] != DUPLICATE_KEY for error in e.details["writeErrors"]):
+                raise
+
+        self._count("chunked")
+
+        return len(chunks)
+
+    def _lease_id(self, key: Dict, version: int) -> str:
+        return "|".join(str(value) for value in (self.name, version) + self._memory_key(key))
+
+    def _compute_leased(self, key: Dict, version: int, compute_fn):
+        """
+        Compute and store the data under the lease of the key, or wait for the process holding it to store it
+        """
+        if not USE_LEASES:
+            data = compute_fn()
+            return self.set(key, version, data) if data is not None else None
+
+        lease_id = self._lease_id(key, version)
+        waited = False
+
+        while True:
+            if acquire_lease(lease_id):
+                empty = False
+
+                try:
+                    # the previous holder may have stored it between our miss and the lease
+                    data = self._get_memory(self._memory_key(key), version) or self._get_mongo(key, version, count_miss=False)
+                    if data is not None:
+                        return data
+
+                    with LeaseHeartbeat(lease_id):
+                        data = compute_fn()
+
+                        if data is not None:
+                            return self.set(key, version, data)
+
+                    # a None result is never stored, the lease stays as its marker
+                    mark_lease_empty(lease_id)
+                    empty = True
+
+                    return None
+                finally:
+                    if not empty:
+                        release_lease(lease_id)
+
+            if not waited:
+                self._count("lease_waits")
+                waited = True
+
+            time.sleep(LEASE_POLL_SECONDS)
+            check_budget()
+
+            data = self._get_mongo(key, version, count_miss=False)
+            if data is not None:
+                return data
+
+            if lease_is_empty(lease_id):
+                return None
+
+    async def _acompute_leased(self, key: Dict, version: int, compute_coro_fn):
+        if not USE_LEASES:
+            data = await compute_coro_fn()
+            return await asyncio.to_thread(self.set, key, version, data) if data is not None else None
+
+        lease_id = self._lease_id(key, version)
+        waited = False
+
+        while True:
+            if await asyncio.to_thread(acquire_lease, lease_id):
+                empty = False
+
+                try:
+                    data = self._get_memory(self._memory_key(key), version) or await asyncio.to_thread(self._get_mongo, key, version, False)
+                    if data is not None:
+                        return data
+
+                    with LeaseHeartbeat(lease_id):
+                        data = await compute_coro_fn()
+
+                        if data is not None:
+                            return await asyncio.to_thread(self.set, key, version, data)
+
+                    await asyncio.to_thread(mark_lease_empty, lease_id)
+                    empty = True
+
+                    return None
+                finally:
+                    if not empty:
+                        await asyncio.to_thread(release_lease, lease_id)
+
+            if not waited:
+                self._count("lease_waits")
+                waited = True
+
+            await asyncio.sleep(LEASE_POLL_SECONDS)
+            check_budget()
+
+            data = await asyncio.to_thread(self._get_mongo, key, version, False)
+            if data is not None:
+                return data
+
+            if await asyncio.to_thread(lease_is_empty, lease_id):
+                return None
+
+    def _single_flight(self, key: Dict, version: int, fn):
+        """
+        Run fn once for the threads of this process missing the same key at the same version, they all get its result
+        """
+        flight_key = (self._memory_key(key), version)
+
+        while True:
+            with self._lock:
+                flight = self._flights.get(flight_key)
+                leader = flight is None
+
+                if leader:
+                    flight = self._flights[flight_key] = Flight()
+                else:
+                    self.counters["coalesced"] += 1
+
+            if leader:
+                break
+
+            # the waiting request keeps to its own budget
+            while not flight.done.wait(LEASE_POLL_SECONDS):
+                check_budget()
+
+            # the client of the computing request went away, the next waiting thread takes over
+            if isinstance(flight.error, QueryCancelled):
+                continue
+
+            if flight.error is not None:
+                raise flight.error
+
+            return flight.data
+
+        try:
+            flight.data = fn()
+            return flight.data
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[flight_key]
+
+            flight.done.set()
+
+    async def _async_single_flight(self, key: Dict, version: int, coro_fn):
+        flight_key = (self._memory_key(key), version)
+
+        while flight_key in self._async_flights:
+            future = self._async_flights[flight_key]
+            self._count("coalesced")
+
+            try:
+                # shielded, a waiting request going away leaves the computation to the others
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # the computing request was cancelled, the next waiting one takes over
+                if not future.cancelled():
+                    raise
+
+        future = asyncio.get_running_loop().create_future()
+        # the error is re-raised to the caller, the waiters may be gone
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._async_flights[flight_key] = future
+
+        try:
+            data = await coro_fn()
+            future.set_result(data)
+            return data
+        except (asyncio.CancelledError, QueryCancelled):
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            del self._async_flights[flight_key]
+
+    def get_or_compute(self, key: Dict, dates: List[datetime], compute_fn):
+        """
+        Return the cached data of the key, or compute, store and return it, encoded in the cache format
+
+        Concurrent misses of the same key are computed once, see _single_flight and _compute_leased.
+
+        :param dates: journey dates the result depends on, see covered_dates
+        :param compute_fn: function without argument computing the data, a None result is returned but not stored
+        """
+        version = get_dates_version(dates)
+        data = self.get(key, version)
+
+        if data is None:
+            data = self._single_flight(key, version, lambda: self._compute_leased(key, version, compute_fn))
+
+        return data
+
+    async def aget_or_compute(self, key: Dict, dates: List[datetime], compute_coro_fn):
+        """
+        get_or_compute for the async endpoints, compute_coro_fn returns a coroutine
+
+        Memory hits are answered inline, the pymongo calls of the Mongo tier run in a thread.
+        """
+        version = fresh_dates_version(dates)
+
+        if version is None:
+            version = await asyncio.to_thread(get_dates_version, dates)
+
+        data = self._get_memory(self._memory_key(key), version)
+
+        if data is None:
+            data = await asyncio.to_thread(self._get_mongo, key, version)
+
+        if data is None:
+            data = await self._async_single_flight(key, version, lambda: self._acompute_leased(key, version, compute_coro_fn))
+
+        return data
+
+    def clear_memory(self):
+        with self._lock:
+            self._memory.clear()
+            self._memory_used = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.counters, memory_entries=len(self._memory), memory_bytes=self._memory_used)
+
+# rankings hold the paths as entity ids, one per path of names
+top_paths_ranking_cache = ResultCache("top_paths_named_ranking_cache", ["date", "granularity", "start_node", "device_os"])
+# the payloads returned by the endpoints are cached pre-serialized, the pages carry the path_id registered for each path
+# and the statistics of every path of ids spelling its names
+top_paths_page_cache = ResultCache("top_paths_named_page_cache", ["date", "granularity", "start_node", "device_os", "offset", "limit"], format=JSON_ROWS)
+first_node_cache = ResultCache("first_node_cache", ["date", "granularity", "device_os"], format=JSON)
+# the limits of the rendered tree are part of the key since trees are pruned while they are computed
+path_tree_cache = ResultCache("path_tree_limited_cache", ["date", "granularity", "node_name", "depth", "device_os", "max_node_per_depth", "max_depth"], format=JSON)
+# the trend of a path_id covers every path of ids spelling its names
+path_trend_cache = ResultCache("path_trend_named_cache", ["path_id", "from_date", "to_date", "device_os"], format=JSON)
+
+RESULT_CACHES = [top_paths_ranking_cache, top_paths_page_cache, first_node_cache, path_tree_cache, path_trend_cache]
+
+def cache_stats() -> Dict[str, Dict[str, int]]:
+    return {cache.name: cache.stats() for cache in RESULT_CACHES}
@@ -0,0 +1,219 @@
+from utils import *
+
+from itertools import islice, product
+import logging
+import threading
+import time
+
+from pymongo import ASCENDING, IndexModel
+
+from budget import find_options
+from cache import count_renames, get_renames
+
+# Path: app/entities.py
+
+# Entity dictionary (entity_id <-> entity_name) of the dictionary-encoded paths: journeys, rollups, tries and
+# rankings only carry entity ids, the names of the API parameters are resolved to ids here and the ids are decoded
+# back to names when a response is built.
+#
+# Renaming an entity keeps its id and is counted by cache.count_renames: the cached results and the ETags carrying
+# the old name no longer match, and every process forgets the names it resolved once it reads the new count.
+#
+# Several entities may share a name, the API knows them by name only: a path of names stands for every path of ids
+# spelling it (path_variants) and their statistics are added.
+
+# a name without entity, or an id missing from the dictionary, is looked up again after this many seconds
+UNKNOWN_NAME_SECONDS = float(os.environ.get("ENTITY_UNKNOWN_NAME_SECONDS", 60))
+# unknown names and ids remembered, the API parameters are arbitrary strings
+MAX_UNKNOWN_NAMES = 10000
+# paths of ids kept for one path of names, the entities sharing a name are few
+MAX_PATH_VARIANTS = 64
+
+entity_collection = journey_db["miniapp_entities"]
+
+ENTITY_INDEXES = [
+    IndexModel([("entity_name", ASCENDING)], name="entity_name"),
+]
+
+logger = logging.getLogger("journey.entities")
+
+_names = {}
+_ids = {}
+# entity name -> monotonic time it was found in no entity
+_unknown = {}
+# entity id -> monotonic time it was found missing from the dictionary
+_unknown_ids = {}
+# renames counted when the names above were resolved
+_renames = 0
+_lock = threading.Lock()
+
+def _forget_renamed():
+    """
+    Forget the names resolved by this process once an entity was renamed by any process
+    """
+    global _renames
+
+    renames = get_renames()
+
+    if renames != _renames:
+        with _lock:
+            _names.clear()
+            _ids.clear()
+            _unknown.clear()
+            _unknown_ids.clear()
+            _renames = renames
+
+def _remember(entity_id: int, entity_name: str):
+    with _lock:
+        previous = _names.get(entity_id)
+
+        if previous is not None and previous != entity_name:
+            _ids.get(previous, set()).discard(entity_id)
+
+        _names[entity_id] = entity_name
+        _ids.setdefault(entity_name, set()).add(entity_id)
+        _unknown.pop(entity_name, None)
+        _unknown_ids.pop(entity_id, None)
+
+def _mark_unknown(unknown: Dict, key):
+    """
+    Remember that key was looked up and not found
+    """
+    with _lock:
+        if len(unknown) >= MAX_UNKNOWN_NAMES:
+            unknown.clear()
+
+        unknown[key] = time.monotonic()
+
+def _recently_unknown(unknown: Dict, key) -> bool:
+    unknown_at = unknown.get(key)
+
+    return unknown_at is not None and time.monotonic() - unknown_at < UNKNOWN_NAME_SECONDS
+
+def register_entities(entities) -> int:
+    """
+    Add the (entity_id, entity_name) pairs to the dictionary, an entity renamed keeps its id
+
+    :return: number of entities written
+    """
+    new = {}
+
+    for entity_id, entity_name in entities:
+        if _names.get(entity_id) != entity_name:
+            new[entity_id] = entity_name
+
+    if not new:
+        return 0
+
+    renamed = 0
+
+    # only the entities new to this process are written, a handful once the dictionary is warm
+    for entity_id, entity_name in new.items():
+        result = entity_collection.update_one({"_id": entity_id}, {"$set": {"entity_name": entity_name}}, upsert=True)
+        renamed += result.modified_count
+        _remember(entity_id, entity_name)
+
+    if renamed:
+        count_renames(renamed)
+
+    return len(new)
+
+def register_journey_entities(journeys) -> int:
+    return register_entities(entity for journey in journeys for entity in flatten_path_entities(journey.get("path")))
+
+def entity_names(entity_ids) -> Dict[int, str]:
+    """
+    Names of the entity ids, the ids missing from the dictionary are decoded to their string
+    """
+    _forget_renamed()
+
+    entity_ids = set(entity_ids)
+    missing = [entity_id for entity_id in entity_ids if entity_id not in _names and not _recently_unknown(_unknown_ids, entity_id)]
+
+    if missing:
+        for row in entity_collection.find({"_id": {"$in": missing}}, **find_options()):
+            _remember(row["_id"], row["entity_name"])
+
+        for entity_id in missing:
+            if entity_id not in _names:
+                logger.warning("entity %s is not in the dictionary", entity_id)
+                _mark_unknown(_unknown_ids, entity_id)
+
+    return {entity_id: _names.get(entity_id, str(entity_id)) for entity_id in entity_ids}
+
+def entity_ids(entity_name: str) -> List[int]:
+    """
+    Ids of the entities with this name, usually one. Empty when no entity has this name
+    """
+    _forget_renamed()
+
+    ids = _ids.get(entity_name)
+
+    if not ids:
+        if _recently_unknown(_unknown, entity_name):
+            return []
+
+        for row in entity_collection.find({"entity_name": entity_name}, **find_options()):
+            _remember(row["_id"], row["entity_name"])
+
+        ids = _ids.get(entity_name, set())
+
+        if not ids:
+            _mark_unknown(_unknown, entity_name)
+
+    return sorted(ids)
+
+def path_variants(paths) -> Dict[Tuple[int, ...], List[Tuple[int, ...]]]:
+    """
+    The paths of ids spelling the same names as each path, the path itself first, in one query for all the paths
+    """
+    paths = list(paths)
+    names = entity_names(entity_id for path in paths for entity_id in path)
+    ids = {}
+
+    # every process may not know every entity of a name, the dictionary is read
+    for row in entity_collection.find({"entity_name": {"$in": list(set(names.values()))}}, **find_options()):
+        _remember(row["_id"], row["entity_name"])
+        ids.setdefault(row["entity_name"], []).append(row["_id"])
+
+    result = {}
+
+    for path in paths:
+        choices = [[entity_id] + sorted(other for other in ids.get(names[entity_id], []) if other != entity_id) for entity_id in path]
+        result[path] = list(islice(product(*choices), MAX_PATH_VARIANTS))
+
+    return result
+
+def decode_path(path, names: Optional[Dict[int, str]] = None) -> str:
+    """
+    The node names of a path of entity ids punctuated by '.'
+    """
+    names = names if names is not None else entity_names(path)
+
+    return ".".join(names[entity_id] for entity_id in path)
+
+def decode_paths(paths) -> Dict[Tuple[int, ...], str]:
+    paths = list(paths)
+    names = entity_names(entity_id for path in paths for entity_id in path)
+
+    return {path: decode_path(path, names) for path in paths}
+
+def decode_tree_names(tree: dict):
+    """
+    Replace the entity ids of the names of a tree with the entity names, inplace. The root keeps its name
+    """
+    nodes = [node for node in iter_tree_nodes(tree) if isinstance(node["name"], int)]
+    names = entity_names(node["name"] for node in nodes)
+
+    for node in nodes:
+        node["name"] = names[node["name"]]
+
+if __name__ == "__main__":
+    # rebuild the dictionary from the nested paths of the journeys
+    entity_collection.create_indexes(ENTITY_INDEXES)
+
+    pairs = {}
+    for journey in miniapp_primary_collection.find({}, {"_id": 0, "path": 1}):
+        pairs.update(flatten_path_entities(journey.get("path")))
+
+    print("entities written:", register_entities(pairs.items()))
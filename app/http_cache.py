@@ -0,0 +1,110 @@
+from utils import *
+from cache import covered_dates, get_dates_version, get_dates_written_at, to_day
+from rollup import rollups_ready, USE_ROLLUPS
+from miniapp_journey import use_snapshots, TREE_STATS_MODE
+from path_registry import resolve_path_id
+
+from typing import Awaitable, Callable
+
+from fastapi import Request, Response, status
+from fastapi.concurrency import run_in_threadpool
+
+# Path: app/http_cache.py
+
+# Conditional GETs of the journey endpoints. The ETag of a response is derived from the request and from what its
+# payload is computed from: the version of the journey dates it covers (entity renames included), the backend reading
+# them, TREE_STATS_MODE and the path a path_id is registered for. All of them are known before the payload is loaded,
+# from the versions and rollup states this process read at most CACHE_VERSION_REFRESH_SECONDS ago, so a matching
+# If-None-Match is answered with a 304 without touching the result caches. The ETags are weak: GZipMiddleware sends
+# the same payload compressed or not, the bytes differ.
+#
+# A period is closed once none of its dates got journeys for HTTP_CLOSED_AFTER_DAYS days and, with USE_ROLLUPS, they
+# are all rolled up at their current version. Closed periods may be reused without revalidation for
+# HTTP_CLOSED_MAX_AGE seconds, the others must be revalidated on every use. Late journeys are still accepted, the
+# clients then see them once max-age is over.
+
+# bump it when the payloads change shape, the ETags handed out before stop matching
+ETAG_REVISION = os.environ.get("HTTP_ETAG_REVISION", "1")
+# days without ingestion into a period before it is considered closed
+CLOSED_AFTER_DAYS = int(os.environ.get("HTTP_CLOSED_AFTER_DAYS", 2))
+CLOSED_MAX_AGE = int(os.environ.get("HTTP_CLOSED_MAX_AGE", 24 * 3600))
+
+def make_etag(request: Request, state: str) -> str:
+    query = "&".join(sorted(f"{name}={value}" for name, value in request.query_params.multi_items()))
+    digest = hashlib.blake2b(f"{ETAG_REVISION}|{request.url.path}?{query}|{state}".encode("utf-8"), digest_size=16).hexdigest()
+
+    return f'W/"{digest}"'
+
+def may_be_closed(dates: List[datetime]) -> bool:
+    """
+    Whether the period ended HTTP_CLOSED_AFTER_DAYS days ago, checked before reading the ingestion state
+    """
+    return max(dates) + timedelta(days=1 + CLOSED_AFTER_DAYS) <= datetime.utcnow()
+
+def is_closed(dates: List[datetime], rolled_up: bool) -> bool:
+    if not may_be_closed(dates):
+        return False
+
+    cutoff = datetime.utcnow() - timedelta(days=CLOSED_AFTER_DAYS)
+    if any(written_at is not None and written_at > cutoff for written_at in get_dates_written_at(dates).values()):
+        return False
+
+    return not USE_ROLLUPS or rolled_up
+
+def read_state(dates: List[datetime], path_id: Optional[str] = None) -> Tuple[str, bool]:
+    """
+    What the response of the dates is computed from and whether their period is closed. The versions read first are
+    fresh for the written_at and rollup checks after them
+
+    :param path_id: path_id of the response, its registered path is part of the state
+    """
+    version = get_dates_version(dates)
+    rolled_up = rollups_ready(dates)
+    backend = "snapshot" if use_snapshots(dates) else "rollups" if rolled_up else "mongo"
+    path = resolve_path_id(path_id) if path_id else None
+
+    return f"{version}|{backend}|{TREE_STATS_MODE}|{path['path_key'] if path else None}", is_closed(dates, rolled_up)
+
+def cache_headers(etag: str, closed: bool) -> Dict[str, str]:
+    return {"ETag": etag, "Cache-Control": f"public, max-age={CLOSED_MAX_AGE}" if closed else "no-cache"}
+
+def etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+
+    if not header:
+        return False
+
+    if header.strip() == "*":
+        return True
+
+    # If-None-Match uses the weak comparison
+    return any(tag.strip().removeprefix("W/") == etag.removeprefix("W/") for tag in header.split(","))
+
+def period_dates(ds: date, granularity: Granularity, with_previous: bool = False) -> List[datetime]:
+    return covered_dates(to_day(ds), granularity, with_previous)
+
+async def conditional_response(request: Request, dates: List[datetime], respond: Callable[[], Awaitable[Response]], path_id: Optional[str] = None) -> Response:
+    """
+    304 when the client already holds the response of the current version of the dates, the response of respond
+    with its ETag and Cache-Control otherwise
+
+    :param dates: journey dates the response depends on, an empty list disables the conditional handling
+    :param path_id: path_id the response is computed for
+    """
+    if not dates:
+        return await respond()
+
+    state, closed = await run_in_threadpool(read_state, dates, path_id)
+    etag = make_etag(request, state)
+    headers = cache_headers(etag, closed)
+
+    if etag_matches(request, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    response = await respond()
+
+    # errors are not cached by the clients
+    if response.status_code == status.HTTP_200_OK:
+        response.headers.update(headers)
+
+    return response
@@ -0,0 +1,207 @@
+from utils import *
+from cache import RESULT_CACHES, top_paths_ranking_cache, top_paths_page_cache, path_tree_cache, path_trend_cache, cache_lease_collection, LEASE_INDEXES
+from rollup import rollup_collection, ROLLUP_INDEXES
+from entities import entity_collection, ENTITY_INDEXES
+from path_registry import path_registry_collection, PATH_REGISTRY_INDEXES
+from partitions import JOURNEY_INDEXES, journey_collections
+
+from pymongo import ASCENDING, IndexModel
+from pymongo.errors import OperationFailure
+import logging
+
+# Path: app/indexes.py
+
+# Indexes required by the journey queries and the cache lookups, created idempotently on app startup.
+#
+#   python indexes.py [--check]
+
+logger = logging.getLogger("journey.indexes")
+
+CACHE_INDEXES = {cache.name: cache.index_models() for cache in RESULT_CACHES}
+CACHE_INDEXES.update({cache.chunk_collection.name: cache.chunk_index_models() for cache in RESULT_CACHES})
+
+# duplicate key error of a unique index built over existing documents
+DUPLICATE_KEY = 11000
+
+# caches of a former format, written under another name and never read again
+LEGACY_CACHES = ["top_journeys_cache", "path_tree_cache", "top_paths_ranking_cache", "top_paths_page_cache", "top_paths_key_ranking_cache",
+    "top_paths_registered_page_cache", "path_trend_cache"]
+# collections left behind by a former version, dropped on startup. The rollups keyed on path strings and without
+# builds, the journey_id -> partition lookup replaced by the unique journey_id index of every partition
+LEGACY_COLLECTIONS = LEGACY_CACHES + [name + "_chunks" for name in LEGACY_CACHES] + [
+    "miniapp_daily_rollup", "miniapp_daily_rollup_state", "miniapp_daily_path_key_rollup", "miniapp_daily_path_key_rollup_state",
+    f"{miniapp_collection.name}_journey_partitions",
+]
+
+def remove_duplicates(collection: Collection, index: IndexModel) -> int:
+    """
+    Delete every document sharing its key of a unique index with another one
+
+    :return: number of documents deleted
+    """
+    pipeline = [
+        # the fields of the key may be dotted, they are not usable as names
+        {"$group": {"_id": {f"k{i}": f"${field}" for i, field in enumerate(index.document["key"])}, "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}},
+    ]
+    ids = [document_id for row in collection.aggregate(pipeline, allowDiskUse=True) for document_id in row["ids"]]
+
+    return collection.delete_many({"_id": {"$in": ids}}).deleted_count if ids else 0
+
+def create_indexes(collection: Collection, indexes: List[IndexModel], disposable: bool = False) -> List[str]:
+    """
+    Create the indexes of a collection one by one, an index that cannot be built is logged and skipped
+
+    :param disposable: the collection only holds cached data, the documents violating a unique index are deleted and
+        this index built again, e.g. the duplicates left by a cache written before its cache_key index
+    :raise RuntimeError: a unique index of a collection that is not disposable cannot be built, the writes rely on it
+    :return: names of the indexes created or already existing
+    """
+    result = []
+
+    for index in indexes:
+        name, unique = index.document["name"], index.document.get("unique", False)
+
+        try:
+            result += collection.create_indexes([index])
+            continue
+        except OperationFailure as e:
+            if unique and not disposable:
+                raise RuntimeError(f"unique index {name} of {collection.name} not created, its writes would store duplicates: {e}") from e
+
+            if not (unique and e.code == DUPLICATE_KEY):
+                logger.error("index %s of %s not created, its queries may scan the collection: %s", name, collection.name, e)
+                continue
+
+        logger.warning("deleted %d documents of %s breaking its unique index %s", remove_duplicates(collection, index), collection.name, name)
+
+        try:
+            result += collection.create_indexes([index])
+        except OperationFailure as e:
+            logger.error("index %s of %s not created, its queries may scan the collection: %s", name, collection.name, e)
+
+    return result
+
+def ensure_journey_indexes(db=journey_db) -> Dict[str, List[str]]:
+    """
+    Create the indexes of the journey collections, ingestion relies on their unique journey_id index
+
+    :raise RuntimeError: when the unique journey_id index cannot be built
+    :return: dict of collection name -> index names
+    """
+    # the partitions created later get their indexes on their first write
+    return {collection.name: create_indexes(db[collection.name], JOURNEY_INDEXES) for collection in journey_collections(miniapp_collection)}
+
+def drop_legacy_collections(db=journey_db) -> List[str]:
+    """
+    Drop the collections of LEGACY_COLLECTIONS still in the database, a no-op once they are gone
+
+    :return: names of the collections dropped
+    """
+    dropped = [name for name in db.list_collection_names() if name in LEGACY_COLLECTIONS]
+
+    for name in dropped:
+        logger.info("dropping %s, left behind by a former version", name)
+        db.drop_collection(name)
+
+    return dropped
+
+def ensure_indexes(db=journey_db) -> Dict[str, List[str]]:
+    """
+    Drop the legacy collections and create the journey and cache indexes, already existing indexes with the same spec
+    are left untouched
+
+    :raise RuntimeError: when a unique index of the journeys or the rollups cannot be built
+    :return: dict of collection name -> index names
+    """
+    drop_legacy_collections(db)
+
+    result = ensure_journey_indexes(db)
+
+    result[rollup_collection.name] = create_indexes(db[rollup_collection.name], ROLLUP_INDEXES)
+    result[entity_collection.name] = create_indexes(db[entity_collection.name], ENTITY_INDEXES)
+    result[path_registry_collection.name] = create_indexes(db[path_registry_collection.name], PATH_REGISTRY_INDEXES)
+    result[cache_lease_collection.name] = create_indexes(db[cache_lease_collection.name], LEASE_INDEXES)
+
+    for name, indexes in CACHE_INDEXES.items():
+        result[name] = create_indexes(db[name], indexes, disposable=True)
+
+    return result
+
+def canonical_query_shapes() -> List[Tuple[str, str, Dict]]:
+    """
+    One representative filter per query issued by the app
+
+    :return: list of (description, collection name, filter)
+    """
+    date_time = datetime(2023, 6, 10)
+    day = {"$gte": date_time, "$lt": date_time + timedelta(days=int(Granularity.DAILY.value))}
+    path_key = make_path_key([1, 2])
+    # the partition of date_time when the journeys are partitioned
+    journeys = miniapp_collection.partition_name(date_time) if isinstance(miniapp_collection, PartitionedCollection) else miniapp_collection.name
+
+    return [
+        ("top paths", journeys, {"journey_date": day, "device_os": "IOS"}),
+        ("top paths from start node", journeys, {gen_path_node_filter(position=0): {"$in": [1,]}, "journey_date": day}),
+        ("batch statistics", journeys, {"journey_date": day, "path_key": {"$in": [path_key,]}}),
+        ("exact path", journeys, {"path_key": path_key, "journey_date": day}),
+        ("rollup", rollup_collection.name, {"journey_date": day, "device_os": "IOS"}),
+        ("path trend", journeys, {"path_key": {"$in": [path_key,]}, "journey_date": {"$gte": date_time, "$lt": date_time + timedelta(days=30)}}),
+        ("rollup path trend", rollup_collection.name, {"path_key": {"$in": [path_key,]}, "journey_date": {"$gte": date_time, "$lt": date_time + timedelta(days=30)}}),
+        ("tree node", journeys, {gen_path_node_filter(position=0): 1}),
+        ("entity by name", entity_collection.name, {"entity_name": "First miniapp"}),
+        ("top paths ranking cache", top_paths_ranking_cache.name, {"date": date_time, "granularity": Granularity.DAILY.value, "start_node": None, "device_os": None}),
+        ("top paths page cache", top_paths_page_cache.name, {"date": date_time, "granularity": Granularity.DAILY.value, "start_node": None, "device_os": None, "offset": 0, "limit": MAX_TOP_PATHS}),
+        ("path trend cache", path_trend_cache.name, {"path_id": make_path_id("First miniapp.Second miniapp"), "from_date": date_time, "to_date": date_time, "device_os": None}),
+        ("first node cache", "first_node_cache", {"date": date_time, "granularity": Granularity.DAILY.value, "device_os": None}),
+        ("path tree cache", path_tree_cache.name, {"date": date_time, "granularity": Granularity.DAILY.value, "node_name": None, "depth": 0, "device_os": None,
+            "max_node_per_depth": MAX_NODE_PER_DEPTH, "max_depth": -1}),
+    ]
+
+def find_plan_stages(plan) -> List[str]:
+    """
+    Every stage name of a query plan, depth first
+    """
+    stages = []
+
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            stages.append(plan["stage"])
+
+        for key in ("inputStage", "queryPlan"):
+            stages.extend(find_plan_stages(plan.get(key)))
+
+        for sub_plan in plan.get("inputStages", []):
+            stages.extend(find_plan_stages(sub_plan))
+
+    return stages
+
+def check_indexes(db=journey_db) -> List[Dict]:
+    """
+    Run explain() on the canonical query shapes and report the ones whose winning plan is a COLLSCAN
+
+    :return: list of {"query", "collection", "filter", "stages"} of the queries falling back to a collection scan
+    """
+    result = []
+
+    for description, collection_name, filter in canonical_query_shapes():
+        explain = db[collection_name].find(filter).explain()
+        stages = find_plan_stages(explain.get("queryPlanner", {}).get("winningPlan"))
+
+        if "COLLSCAN" in stages:
+            result.append({"query": description, "collection": collection_name, "filter": filter, "stages": stages})
+
+    return result
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Create the indexes of the journey and cache collections")
+    parser.add_argument("--check", action="store_true", help="report the canonical queries falling back to a collection scan")
+    args = parser.parse_args()
+
+    print("indexes:", ensure_indexes())
+
+    if args.check:
+        for collscan in check_indexes():
+            print("COLLSCAN:", collscan["query"], collscan["collection"], collscan["filter"])
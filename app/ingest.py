@@ -0,0 +1,249 @@
+from utils import *
+from cache import invalidate_dates, to_day
+from entities import register_journey_entities
+from serialization import loads
+
+from concurrent.futures import ThreadPoolExecutor
+import sys
+from typing import Iterable, Iterator
+
+from pydantic import ValidationError
+from pymongo import ReplaceOne
+from pymongo.errors import BulkWriteError
+
+# Path: app/ingest.py
+
+# Bulk ingestion of the journeys, behind POST /journeys/bulk and from NDJSON files (one JourneyIn per line):
+#
+#   python ingest.py day.ndjson [more.ndjson ...] [--batch-size 1000] [--workers 4] [--no-rollups]
+#   zcat day.ndjson.gz | python ingest.py -
+#
+# Journeys are written with unordered insert_many, the journey_ids already stored are then replaced, so sending a
+# batch again is harmless. The versions of the touched journey dates are bumped after every batch. With monthly
+# partitions a batch is written to the partition of each month, see PartitionedCollection.remove_moved. The rollups of
+# the touched days are not rebuilt by a POST, the warmer refreshes them (see warmer.py).
+
+# journeys per insert_many
+INGEST_BATCH_SIZE = int(os.environ.get("INGEST_BATCH_SIZE", 1000))
+# journeys accepted by one POST /journeys/bulk
+INGEST_MAX_JOURNEYS = int(os.environ.get("INGEST_MAX_JOURNEYS", 50000))
+# bulk requests written at the same time by one worker, the others wait up to INGEST_QUEUE_TIMEOUT seconds then get a 503
+INGEST_CONCURRENCY = int(os.environ.get("INGEST_CONCURRENCY", 2))
+INGEST_QUEUE_TIMEOUT = float(os.environ.get("INGEST_QUEUE_TIMEOUT", 10))
+# size of the body of one POST /journeys/bulk, checked before reading it
+INGEST_MAX_BYTES = int(os.environ.get("INGEST_MAX_BYTES", 128 * 1024 * 1024))
+
+DUPLICATE_KEY = 11000
+
+def to_document(journey: JourneyIn) -> SON:
+    if journey.path is not None:
+        nodes = []
+        node = journey.path
+        while node is not None:
+            nodes.append(node)
+            node = node.child
+    else:
+        nodes = journey.nodes or []
+
+    path = None
+    for node in reversed(nodes):
+        path = make_miniapp_node(node.entity_id, node.entity_name, path)
+
+    journey_date = datetime(year=journey.journey_date.year, month=journey.journey_date.month, day=journey.journey_date.day)
+
+    return make_miniapp_journey(journey.agent_id, journey.journey_id, journey_date, journey.device_os, path)
+
+def insert_or_replace(collection: Collection, documents: List[SON], days: set) -> List[SON]:
+    """
+    Insert journey documents, the journey_ids already stored in the collection are replaced and the dates they were
+    stored under added to days
+
+    :return: the documents that replaced a stored journey
+    """
+    duplicates = []
+
+    try:
+        collection.insert_many(documents, ordered=False)
+    except BulkWriteError as e:
+        errors = e.details["writeErrors"]
+
+        if any(error["code"] != DUPLICATE_KEY for error in errors):
+            raise
+
+        duplicates = [documents[error["index"]] for error in errors]
+
+    if duplicates:
+        journey_ids = [document["journey_id"] for document in duplicates]
+
+        # a journey sent again may have moved to another date, the stored one changes too
+        days.update(to_day(row["journey_date"]) for row in collection.find({"journey_id": {"$in": journey_ids}}, {"journey_date": 1}))
+
+        for document in duplicates:
+            document.pop("_id", None)
+
+        collection.bulk_write([ReplaceOne({"journey_id": document["journey_id"]}, document, upsert=True) for document in duplicates], ordered=False)
+
+    return duplicates
+
+def write_batch(documents: List[SON], collection: Collection = miniapp_primary_collection) -> Dict[str, Any]:
+    """
+    Insert a batch of journey documents, the journey_ids already stored are replaced, then invalidate their dates
+
+    :return: dict of inserted, replaced and journey_dates
+    """
+    # the last occurrence of a journey_id in the batch wins
+    documents = list({document["journey_id"]: document for document in documents}.values())
+    days = {to_day(document["journey_date"]) for document in documents}
+    replaced = 0
+
+    # the names must be decodable before the journeys are visible
+    register_journey_entities(documents)
+
+    try:
+        if isinstance(collection, PartitionedCollection):
+            groups = collection.split(documents)
+
+            for name, group in groups.items():
+                replaced += len(insert_or_replace(collection.ensure_partition(name), group, days))
+
+            # a journey sent again with a date in another month was inserted in the new month
+            moved = collection.remove_moved(groups)
+            days.update(to_day(day) for day in moved)
+            replaced += len(moved)
+        else:
+            replaced = len(insert_or_replace(collection, documents, days))
+    finally:
+        # part of the batch may be written even when it failed
+        invalidate_dates(days)
+
+    return {"inserted": len(documents) - replaced, "replaced": replaced, "journey_dates": sorted(days)}
+
+def merge_results(total: Dict[str, Any], result: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "inserted": total["inserted"] + result["inserted"],
+        "replaced": total["replaced"] + result["replaced"],
+        "journey_dates": sorted(set(total["journey_dates"]) | set(result["journey_dates"])),
+    }
+
+EMPTY_RESULT = {"inserted": 0, "replaced": 0, "journey_dates": []}
+
+def ingest_journeys(journeys: Iterable[JourneyIn], batch_size: int = INGEST_BATCH_SIZE) -> Dict[str, Any]:
+    total = EMPTY_RESULT
+    batch = []
+
+    for journey in journeys:
+        batch.append(to_document(journey))
+
+        if len(batch) >= batch_size:
+            total = merge_results(total, write_batch(batch))
+            batch = []
+
+    if batch:
+        total = merge_results(total, write_batch(batch))
+
+    return total
+
+def parse_journeys(body: bytes) -> List[JourneyIn]:
+    """
+    The journeys of the JSON array of a POST /journeys/bulk
+
+    :raise OverflowError: more than INGEST_MAX_JOURNEYS journeys
+    :raise ValueError, TypeError, ValidationError: the body is not a JSON array of journeys
+    """
+    journeys = loads(body)
+
+    if not isinstance(journeys, list):
+        raise ValueError("the body must be a JSON array of journeys")
+    if len(journeys) > INGEST_MAX_JOURNEYS:
+        raise OverflowError(f"at most {INGEST_MAX_JOURNEYS} journeys per request")
+
+    return [JourneyIn(**journey) for journey in journeys]
+
+def read_ndjson(lines: Iterable[str], source: str, errors: List[str]) -> Iterator[JourneyIn]:
+    """
+    The valid journeys of the lines, a line that is not a valid journey is reported in errors and skipped
+    """
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+
+        try:
+            yield JourneyIn(**loads(line))
+        except (ValueError, TypeError, ValidationError) as e:
+            errors.append(f"{source}:{number}: {e}")
+
+def load_files(paths: List[str], batch_size: int = INGEST_BATCH_SIZE, workers: int = 4) -> Tuple[Dict[str, Any], List[str]]:
+    """
+    Load NDJSON files, `workers` batches are written at the same time and reading waits while they are all busy
+
+    :return: the merged result of the batches and the invalid lines
+    """
+    total = EMPTY_RESULT
+    errors = []
+    in_flight = []
+
+    def journeys():
+        for path in paths:
+            if path == "-":
+                yield from read_ndjson(sys.stdin, "<stdin>", errors)
+                continue
+
+            with open(path) as f:
+                yield from read_ndjson(f, path, errors)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        batch = []
+
+        for journey in journeys():
+            batch.append(to_document(journey))
+
+            if len(batch) < batch_size:
+                continue
+
+            # backpressure, never more batches in memory than the writers can take
+            if len(in_flight) >= workers:
+                total = merge_results(total, in_flight.pop(0).result())
+
+            in_flight.append(executor.submit(write_batch, batch))
+            batch = []
+
+        if batch:
+            in_flight.append(executor.submit(write_batch, batch))
+
+        for future in in_flight:
+            total = merge_results(total, future.result())
+
+    return total, errors
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    from indexes import ensure_journey_indexes
+    from mongo import wait_for_mongo
+    from rollup import materialize_days
+
+    parser = argparse.ArgumentParser(description="Load miniapp journeys from NDJSON files")
+    parser.add_argument("paths", nargs="+", help="NDJSON files, - reads stdin")
+    parser.add_argument("--batch-size", type=int, default=INGEST_BATCH_SIZE)
+    parser.add_argument("--workers", type=int, default=4, help="batches written in parallel")
+    parser.add_argument("--no-rollups", action="store_true", help="leave the rollups of the loaded dates to python rollup.py --dirty")
+    args = parser.parse_args()
+
+    wait_for_mongo()
+    # the journeys sent again are only replaced with the unique journey_id index
+    ensure_journey_indexes()
+
+    start = time.monotonic()
+    result, errors = load_files(args.paths, args.batch_size, args.workers)
+    seconds = time.monotonic() - start
+
+    for error in errors[:100]:
+        print(error, file=sys.stderr)
+
+    print(f"inserted {result['inserted']} replaced {result['replaced']} invalid {len(errors)} journeys in {seconds:.1f}s")
+
+    # rolled up once per loaded day, not after every batch
+    if not args.no_rollups and result["journey_dates"]:
+        for day, count in materialize_days(result["journey_dates"]).items():
+            print(day.date(), "rollup documents:", count)
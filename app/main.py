@@ -1,14 +1,35 @@
 from typing import Union, Annotated, List
 
-from fastapi import FastAPI, Response, Path, Query
+from fastapi import FastAPI, Request, Response, Path, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
+from fastapi.middleware.gzip import GZipMiddleware
+from functools import partial
+from starlette.routing import Match
 
 from openapi_tags import tags_metadata
-from datetime import date
+from datetime import date, timedelta
 
-from utils import Granularity, TopPath, Message, FirstNode, PathTree
-from miniapp_journey import get_top_journeys_from_node, get_first_nodes, get_path_tree
+from utils import Granularity, TopPath, Message, FirstNode, PathTree, PathTrend, BulkResult, MAX_TOP_PATHS, MAX_NODE_PER_DEPTH
+from miniapp_journey import get_top_journeys_from_node, get_first_nodes, get_path_tree, get_path_trend
+from miniapp_journey_async import get_top_journeys_from_node_async, get_first_nodes_async, get_path_tree_async, get_path_trend_async
+from indexes import ensure_indexes, check_indexes
+from mongo import wait_for_mongo
+from ingest import ingest_journeys, parse_journeys, INGEST_MAX_JOURNEYS, INGEST_MAX_BYTES, INGEST_CONCURRENCY, INGEST_QUEUE_TIMEOUT
+from cache import cache_stats
+from http_cache import conditional_response, period_dates
+from budget import run_with_budget
+from miniapp_journey import MAX_TREND_DAYS
+from serialization import json_response, json_rows_response
+from metrics import start_request, finish_request, render_metrics
+from pydantic import ValidationError
+import asyncio
 import json
+import logging
+import os
+import time
+
+logger = logging.getLogger("journey.main")
 
 # allow cors for all origins
 
@@ -20,8 +41,21 @@ origins = [
     "http://localhost:9000",
 ]
 
+# serve the journeys with the motor client (default), or with blocking pymongo in the threadpool when set to 0
+ASYNC_MODE = os.environ.get("ASYNC_MODE", "1") == "1"
+
 app = FastAPI(openapi_tags=tags_metadata)
 
+# bulk requests written at the same time by this worker
+ingest_slots = asyncio.Semaphore(INGEST_CONCURRENCY)
+
+# brotli when brotli-asgi is installed (it falls back to gzip for clients without br), gzip otherwise
+try:
+    from brotli_asgi import BrotliMiddleware
+    app.add_middleware(BrotliMiddleware, minimum_size=1000)
+except ImportError:
+    app.add_middleware(GZipMiddleware, minimum_size=1000)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
@@ -30,12 +64,52 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.middleware("http")
+async def track_request(request: Request, call_next):
+    # label by route template, the raw path of the journeys has a date in it
+    endpoint = "unmatched"
+    for route in app.routes:
+        match, _ = route.matches(request.scope)
+        if match == Match.FULL:
+            endpoint = route.path
+            break
+
+    request_metrics, token = start_request(endpoint)
+    start = time.perf_counter()
+    status_code = 500
+
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+        return response
+    finally:
+        finish_request(request_metrics, token, status_code, time.perf_counter() - start)
+
+@app.on_event("startup")
+def create_indexes():
+    # fail the worker early when the deployment is unreachable instead of on the first request
+    logger.info("mongo is up after %.1fs", wait_for_mongo())
+
+    ensure_indexes()
+
+    for collscan in check_indexes():
+        logger.warning("COLLSCAN on %s for %s", collscan["collection"], collscan["query"])
+
 @app.get("/ping", tags=["ping"])
 def ping_pong():
     return "pong!"
 
+@app.get("/cache/stats", tags=["monitoring"])
+def get_cache_stats():
+    return cache_stats()
+
+@app.get("/metrics", tags=["monitoring"])
+def get_metrics():
+    return Response(content=render_metrics(cache_stats()), media_type="text/plain; version=0.0.4")
+
 @app.get("/journeys/first_nodes/{ds}/{granularity}", tags=["miniapp journey table"],  response_model=List[FirstNode],
     responses={
+        503: {"model": Message, "description": "The request exceeds its query budget (time, paths or tree nodes)"},
         200: {
             "description": "First nodes retrieved successfully with any order.",
             "content": {
@@ -45,15 +119,23 @@ def ping_pong():
             }
         }
     })
-def first_nodes(ds: date, granularity: Granularity, device_os: Union[str, None] = None):
-    result = get_first_nodes(ds, granularity, device_os)
-    return Response(content=json.dumps(result), media_type="application/json")
+async def first_nodes(request: Request, ds: date, granularity: Granularity, device_os: Union[str, None] = None):
+    async def respond():
+        if ASYNC_MODE:
+            result = await get_first_nodes_async(ds, granularity, device_os)
+        else:
+            result = await run_in_threadpool(get_first_nodes, ds, granularity, device_os)
+
+        return json_response(result)
+
+    return await conditional_response(request, period_dates(ds, granularity), partial(run_with_budget, request, respond))
 
 @app.get("/journeys/top_paths/{ds}/{granularity}", tags=["miniapp journey table"], response_model=List[TopPath],
     responses={
         404: {"model": Message, "description": "The item was not found"},
+        503: {"model": Message, "description": "The request exceeds its query budget (time, paths or tree nodes)"},
         200: {
-            "description": "Paths retrieved successfully and statistics calculated, sorted by the number of sessions.",
+            "description": "Paths retrieved successfully and statistics calculated, sorted by the number of sessions. Only the paths of the page [offset, offset + limit) of the ranking are returned.",
             "content": {
                 "application/json": {
                     "example": [{"path": "First miniapp.Second miniapp.Third miniapp.Fourth miniapp", "stats": {"dist_users": 2, "sessions": 4, "device_os": [{"_id": "IOS", "sessions": 2, "dist_users": 2}, {"_id": "Android", "sessions": 2, "dist_users": 1}], "previous_sessions": 0, "previous_dist_users": 0}, "path_id": "a0a7aa8bbddd90cc1351f2f08729fcd3d74a42b123a542eb7c2b515c6f4a3b06"}, {"path": "First miniapp.Second miniapp.Third miniapp.Fourth miniapp.Five miniapp", "stats": {"dist_users": 1, "sessions": 1, "device_os": [{"_id": "Android", "sessions": 1, "dist_users": 1}], "previous_sessions": 0, "previous_dist_users": 0}, "path_id": "addade6906aaab08ebefd250e3d74c716b363f676f1b15840f9f10ccd736d253"}, {"path": "First miniapp.Second miniapp.Fourth miniapp", "stats": {"dist_users": 1, "sessions": 1, "device_os": [{"_id": "Android", "sessions": 1, "dist_users": 1}], "previous_sessions": 0, "previous_dist_users": 0}, "path_id": "7e3f36484a45bcf1dd7a94914cee109d3a379563ded0bac9823ed6842b3c33a7"}]
@@ -61,17 +143,58 @@ def first_nodes(ds: date, granularity: Granularity, device_os: Union[str, None]
             },
         },
 })
-def top_paths(ds: date, granularity: Granularity,  start_node: Union[str, None] = None, device_os: Union[str, None] = None):
+async def top_paths(request: Request, ds: date, granularity: Granularity,  start_node: Union[str, None] = None, device_os: Union[str, None] = None,
+        limit: Annotated[int, Query(ge=1, le=MAX_TOP_PATHS, description="number of paths of the page")] = MAX_TOP_PATHS,
+        offset: Annotated[int, Query(ge=0, lt=MAX_TOP_PATHS, description="rank of the first path of the page")] = 0):
     # return {"ds": ds, "granularity": granularity, "start_node": start_node, "device_os": device_os}
 
-    result = get_top_journeys_from_node(ds, granularity, start_node, device_os)
+    async def respond():
+        if ASYNC_MODE:
+            result = await get_top_journeys_from_node_async(ds, granularity, start_node, device_os, limit, offset)
+        else:
+            result = await run_in_threadpool(get_top_journeys_from_node, ds, granularity, start_node, device_os, limit, offset)
 
-    return Response(content=json.dumps(result), media_type="application/json")
+        # one chunk per path, each path encoded once when it was cached
+        return json_rows_response(result)
+
+    # the statistics compare with the previous period
+    return await conditional_response(request, period_dates(ds, granularity, with_previous=True), partial(run_with_budget, request, respond))
+
+@app.get("/journeys/path/{path_id}", tags=["miniapp journey table"], response_model=PathTrend,
+    responses={
+        400: {"model": Message, "description": "Invalid date range"},
+        404: {"model": Message, "description": "The path_id was never returned by top_paths"},
+        503: {"model": Message, "description": "The request exceeds its query budget (time, paths or tree nodes)"},
+        200: {
+            "description": "Daily statistics of the path over the date range, computed in one query.",
+            "content": {
+                "application/json": {
+                    "example": {"path": "First miniapp.Second miniapp", "path_id": "b3a8e0e1f9ab1bfe3a36f231f676f78bb30a519d2b21e6c530c0eee8ebb4a5d0", "series": [{"journey_date": "2023-06-10", "dist_users": 2, "sessions": 3, "device_os": [{"_id": "IOS", "sessions": 2, "dist_users": 1}, {"_id": "Android", "sessions": 1, "dist_users": 1}]}, {"journey_date": "2023-06-11", "dist_users": 0, "sessions": 0, "device_os": []}]}
+                }
+            },
+        },
+    })
+async def path_trend(request: Request, path_id: Annotated[str, Path(pattern="^[0-9a-f]{64}$", description="path_id returned by top_paths")],
+        from_date: Annotated[date, Query(alias="from", description="first journey date")],
+        to_date: Annotated[date, Query(alias="to", description="last journey date, included")],
+        device_os: Union[str, None] = None):
+    async def respond():
+        if ASYNC_MODE:
+            return await get_path_trend_async(path_id, from_date, to_date, device_os)
+
+        return await run_in_threadpool(get_path_trend, path_id, from_date, to_date, device_os)
+
+    # an invalid range is answered 400 by get_path_trend, without ETag
+    days = (to_date - from_date).days + 1
+    dates = [period_dates(from_date, Granularity.DAILY)[0] + timedelta(days=i) for i in range(days)] if 0 < days <= MAX_TREND_DAYS else []
+
+    return await conditional_response(request, dates, partial(run_with_budget, request, respond), path_id)
 
 @app.get("/journeys/tree/{ds}/{granularity}", tags=["miniapp journey tree"], response_model=PathTree,
     responses={
         400: {"model": Message, "description": "Invalid input"},
         404: {"model": Message, "description": "The item was not found"},
+        503: {"model": Message, "description": "The request exceeds its query budget (time, paths or tree nodes)"},
         200: {
             "description": "Tree retrieved successfully and statistics calculated.",
             "content": {
@@ -80,6 +203,72 @@ def top_paths(ds: date, granularity: Granularity,  start_node: Union[str, None]
                 }
             },
     }},)
-def get_tree(ds: date, granularity: Granularity,  node_name: Union[str, None] = None, depth: Union[int, None] = 0, device_os: Union[str, None] = None):
-    return get_path_tree(ds, granularity, node_name, depth, device_os)
+async def get_tree(request: Request, ds: date, granularity: Granularity,  node_name: Union[str, None] = None, depth: Union[int, None] = 0, device_os: Union[str, None] = None,
+        max_node_per_depth: Annotated[int, Query(ge=1, le=100, description="children kept per node, the others are summed in an \"others\" node")] = MAX_NODE_PER_DEPTH,
+        max_depth: Annotated[int, Query(ge=-1, description="maximum depth of the tree, the deeper nodes have no children, -1 for no limit")] = -1):
+    async def respond():
+        if ASYNC_MODE:
+            return await get_path_tree_async(ds, granularity, node_name, depth, device_os, max_node_per_depth, max_depth)
+
+        return await run_in_threadpool(get_path_tree, ds, granularity, node_name, depth, device_os, max_node_per_depth, max_depth)
+
+    return await conditional_response(request, period_dates(ds, granularity, with_previous=True), partial(run_with_budget, request, respond))
+
+
+def message_response(status_code: int, message: str, **kwargs) -> Response:
+    return Response(status_code=status_code, content=json.dumps({"message": message}), media_type="application/json", **kwargs)
+
+async def read_body(request: Request, max_bytes: int) -> Union[bytes, None]:
+    """
+    :return: the body, None once it is longer than max_bytes (a chunked body has no Content-Length)
+    """
+    body = bytearray()
+
+    async for chunk in request.stream():
+        body += chunk
+        if len(body) > max_bytes:
+            return None
+
+    return bytes(body)
+
+@app.post("/journeys/bulk", tags=["miniapp journey ingestion"], response_model=BulkResult,
+    openapi_extra={"requestBody": {"required": True, "description": f"JSON array of at most {INGEST_MAX_JOURNEYS} JourneyIn",
+        "content": {"application/json": {"schema": {"type": "array", "items": {"type": "object"}}}}}},
+    responses={
+        400: {"model": Message, "description": "The Content-Length header is not a number"},
+        413: {"model": Message, "description": "Too many journeys, or too large a body, in one request"},
+        422: {"model": Message, "description": "The body is not a JSON array of journeys"},
+        503: {"model": Message, "description": "The writers are busy, retry after the Retry-After seconds"},
+    })
+async def bulk_journeys(request: Request):
+    too_large = f"at most {INGEST_MAX_JOURNEYS} journeys and {INGEST_MAX_BYTES} bytes per request"
+    try:
+        content_length = int(request.headers.get("content-length", 0))
+    except ValueError:
+        return message_response(400, "invalid Content-Length")
+
+    if content_length > INGEST_MAX_BYTES:
+        return message_response(413, too_large)
+
+    # backpressure before the body is read, a client waits for a free writer a bounded time instead of piling up
+    # request bodies in memory
+    try:
+        await asyncio.wait_for(ingest_slots.acquire(), INGEST_QUEUE_TIMEOUT)
+    except asyncio.TimeoutError:
+        return message_response(503, "ingestion is busy", headers={"Retry-After": str(int(INGEST_QUEUE_TIMEOUT))})
+
+    try:
+        body = await read_body(request, INGEST_MAX_BYTES)
+        if body is None:
+            return message_response(413, too_large)
+
+        try:
+            journeys = await run_in_threadpool(parse_journeys, body)
+        except OverflowError:
+            return message_response(413, too_large)
+        except (ValueError, TypeError, ValidationError) as e:
+            return message_response(422, str(e))
 
+        return await run_in_threadpool(ingest_journeys, journeys)
+    finally:
+        ingest_slots.release()
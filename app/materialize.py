@@ -0,0 +1,64 @@
+from utils import *
+from entities import register_journey_entities
+from partitions import journey_collections
+
+from pymongo import UpdateOne
+
+# Path: app/materialize.py
+
+# Backfill the flattened path fields of the journeys written before they were materialized at ingest time, or
+# before the paths were dictionary-encoded.
+#
+#   python materialize.py [--batch-size 1000] [--force]
+
+def materialize_journey(journey: Dict) -> Dict:
+    """
+    Add the flattened path fields to a journey document before it is written, inplace
+    """
+    journey.update(materialize_path(journey.get("path")))
+
+    return journey
+
+def backfill_path_fields(collection: Collection, batch_size: int = 1000, force: bool = False) -> int:
+    """
+    Materialize path_ids, path_len and path_key on the journeys of the collection, register their entities and drop
+    the path_str, path_nodes and path_id fields of the string encoding
+
+    :param batch_size: number of updates sent per bulk write
+    :param force: rewrite the fields of every journey, not only the ones missing path_key
+    :return: number of journeys updated
+    """
+    filter = {} if force else {"path_key": {"$exists": False}}
+
+    updated = 0
+    requests = []
+    journeys = []
+
+    for journey in collection.find(filter, {"_id": 1, "path": 1}):
+        journeys.append(journey)
+        requests.append(UpdateOne({"_id": journey["_id"]}, {"$set": materialize_path(journey.get("path")), "$unset": {"path_str": "", "path_nodes": "", "path_id": ""}}))
+
+        if len(requests) >= batch_size:
+            register_journey_entities(journeys)
+            journeys = []
+
+            updated += collection.bulk_write(requests, ordered=False).modified_count
+            requests = []
+
+    if requests:
+        register_journey_entities(journeys)
+        updated += collection.bulk_write(requests, ordered=False).modified_count
+
+    return updated
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Materialize the flattened path fields of the miniapp journeys")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--force", action="store_true", help="rewrite the fields of every journey")
+    args = parser.parse_args()
+
+    # one pass per partition when the journeys are partitioned
+    for collection in journey_collections(miniapp_primary_collection):
+        print(collection.name, "updated journeys:", backfill_path_fields(collection, args.batch_size, args.force))
@@ -0,0 +1,218 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+import bisect
+import logging
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from pymongo import monitoring
+
+# Path: app/metrics.py
+
+# Per-request accounting of the Mongo commands (a pymongo command listener) and of the query phases, exposed in the
+# Prometheus text format by /metrics.
+
+# requests slower than this are logged with their breakdown, 0 disables the slow request log
+SLOW_REQUEST_SECONDS = float(os.environ.get("SLOW_REQUEST_SECONDS", 0))
+
+DURATION_BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+COUNT_BUCKETS = [0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000]
+
+logger = logging.getLogger("journey.metrics")
+
+class RequestMetrics:
+    """
+    What one request cost: Mongo commands, their duration and returned documents, and the time of each phase
+    """
+    __slots__ = ("endpoint", "commands", "mongo_seconds", "docs_returned", "phases", "_lock")
+
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        self.commands = {}
+        self.mongo_seconds = 0.0
+        self.docs_returned = 0
+        self.phases = {}
+        self._lock = threading.Lock()
+
+    def add_command(self, command_name: str, seconds: float, docs: int):
+        with self._lock:
+            self.commands[command_name] = self.commands.get(command_name, 0) + 1
+            self.mongo_seconds += seconds
+            self.docs_returned += docs
+
+    def add_phase(self, phase: str, seconds: float):
+        with self._lock:
+            self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    @property
+    def command_count(self) -> int:
+        return sum(self.commands.values())
+
+current_request = ContextVar("current_request", default=None)
+
+class Histogram:
+
+    def __init__(self, name: str, help: str, buckets: List[float]):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        # labels -> [bucket counts..., sum, count]
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels: Tuple, value: float):
+        with self._lock:
+            row = self.values.setdefault(labels, [0] * len(self.buckets) + [0.0, 0])
+
+            # first bucket whose bound is >= value, values above every bound only count in +Inf
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                row[index] += 1
+
+            row[-2] += value
+            row[-1] += 1
+
+    def render(self, label_names: List[str]) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+
+        with self._lock:
+            for labels, row in self.values.items():
+                base = ",".join(f'{k}="{v}"' for k, v in zip(label_names, labels))
+                cumulative = 0
+
+                for bound, count in zip(self.buckets, row):
+                    cumulative += count
+                    lines.append(f'{self.name}_bucket{{{base},le="{bound}"}} {cumulative}')
+
+                lines.append(f'{self.name}_bucket{{{base},le="+Inf"}} {row[-1]}')
+                lines.append(f"{self.name}_sum{{{base}}} {row[-2]}")
+                lines.append(f"{self.name}_count{{{base}}} {row[-1]}")
+
+        return lines
+
+class Counter:
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels: Tuple, value: float = 1):
+        with self._lock:
+            self.values[labels] = self.values.get(labels, 0) + value
+
+    def render(self, label_names: List[str]) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+
+        with self._lock:
+            for labels, value in self.values.items():
+                base = ",".join(f'{k}="{v}"' for k, v in zip(label_names, labels))
+                lines.append(f"{self.name}{{{base}}} {value}")
+
+        return lines
+
+request_duration = Histogram("journey_request_duration_seconds", "Duration of the requests", DURATION_BUCKETS)
+request_commands = Histogram("journey_request_mongo_commands", "Mongo commands issued by a request", COUNT_BUCKETS)
+request_mongo_duration = Histogram("journey_request_mongo_duration_seconds", "Time spent in Mongo commands by a request", DURATION_BUCKETS)
+phase_duration = Histogram("journey_phase_duration_seconds", "Duration of the phases of the journey queries", DURATION_BUCKETS)
+requests_total = Counter("journey_requests_total", "Requests served")
+mongo_commands_total = Counter("journey_mongo_commands_total", "Mongo commands issued")
+mongo_docs_returned_total = Counter("journey_mongo_docs_returned_total", "Documents returned by the Mongo cursors")
+
+def count_reply_docs(reply) -> int:
+    cursor = reply.get("cursor") if isinstance(reply, dict) else None
+
+    if isinstance(cursor, dict):
+        return len(cursor.get("firstBatch", cursor.get("nextBatch", [])))
+
+    return 0
+
+class CommandMetricsListener(monitoring.CommandListener):
+    """
+    Attribute every Mongo command to the request running it, commands outside a request are labelled "background"
+    """
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self._record(event.command_name, event.duration_micros / 1e6, count_reply_docs(event.reply))
+
+    def failed(self, event):
+        self._record(event.command_name, event.duration_micros / 1e6, 0)
+
+    def _record(self, command_name: str, seconds: float, docs: int):
+        request = current_request.get()
+        endpoint = request.endpoint if request is not None else "background"
+
+        if request is not None:
+            request.add_command(command_name, seconds, docs)
+
+        mongo_commands_total.inc((endpoint, command_name))
+        mongo_docs_returned_total.inc((endpoint,), docs)
+
+command_listener = CommandMetricsListener()
+
+@contextmanager
+def timed_phase(phase: str):
+    """
+    Time a phase of the current request: discover, stats, build, transform or serialize
+    """
+    start = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        request = current_request.get()
+
+        if request is not None:
+            request.add_phase(phase, seconds)
+
+        phase_duration.observe((request.endpoint if request is not None else "background", phase), seconds)
+
+def start_request(endpoint: str) -> Tuple[RequestMetrics, object]:
+    request = RequestMetrics(endpoint)
+    return request, current_request.set(request)
+
+def finish_request(request: RequestMetrics, token, status_code: int, seconds: float):
+    current_request.reset(token)
+    endpoint = request.endpoint
+
+    requests_total.inc((endpoint, str(status_code)))
+    request_duration.observe((endpoint,), seconds)
+    request_commands.observe((endpoint,), request.command_count)
+    request_mongo_duration.observe((endpoint,), request.mongo_seconds)
+
+    if SLOW_REQUEST_SECONDS and seconds >= SLOW_REQUEST_SECONDS:
+        logger.warning("slow request %s status=%s seconds=%.3f mongo_commands=%s mongo_seconds=%.3f docs_returned=%s phases=%s",
+            endpoint, status_code, seconds, request.commands, request.mongo_seconds, request.docs_returned,
+            {k: round(v, 3) for k, v in request.phases.items()})
+
+def render_metrics(cache_stats: Optional[Dict[str, Dict[str, int]]] = None) -> str:
+    lines = []
+    lines += requests_total.render(["endpoint", "status"])
+    lines += request_duration.render(["endpoint"])
+    lines += request_commands.render(["endpoint"])
+    lines += request_mongo_duration.render(["endpoint"])
+    lines += phase_duration.render(["endpoint", "phase"])
+    lines += mongo_commands_total.render(["endpoint", "command"])
+    lines += mongo_docs_returned_total.render(["endpoint"])
+
+    if cache_stats:
+        lines += ["# HELP journey_cache_events_total Result cache lookups and evictions", "# TYPE journey_cache_events_total counter"]
+
+        for cache_name, stats in cache_stats.items():
+            for event, value in stats.items():
+                if event not in ("memory_entries", "memory_bytes"):
+                    lines.append(f'journey_cache_events_total{{cache="{cache_name}",event="{event}"}} {value}')
+
+        lines += ["# HELP journey_cache_memory_entries Entries held by the in-process cache tier", "# TYPE journey_cache_memory_entries gauge"]
+        lines += [f'journey_cache_memory_entries{{cache="{cache_name}"}} {stats["memory_entries"]}' for cache_name, stats in cache_stats.items()]
+        lines += ["# HELP journey_cache_memory_bytes Encoded bytes held by the in-process cache tier", "# TYPE journey_cache_memory_bytes gauge"]
+        lines += [f'journey_cache_memory_bytes{{cache="{cache_name}"}} {stats["memory_bytes"]}' for cache_name, stats in cache_stats.items()]
+
+    return "\n".join(lines) + "\n"
@@ -1,14 +1,72 @@
 from utils import *
+from path_trie import get_path_trie
+from rollup import rollups_ready, retrieve_rollup_ranking, retrieve_rollup_statistics, retrieve_rollup_first_nodes, retrieve_rollup_path_sessions, retrieve_rollup_leaves, retrieve_rollup_daily_stats
+from snapshot import snapshots_ready, retrieve_snapshot_ranking, retrieve_snapshot_statistics, retrieve_snapshot_first_nodes, retrieve_snapshot_path_sessions, retrieve_snapshot_leaves
+from cache import top_paths_ranking_cache, top_paths_page_cache, first_node_cache, path_tree_cache, path_trend_cache, covered_dates, get_dates_written_at
+from entities import entity_ids, entity_names, path_variants, decode_path, decode_paths, decode_tree_names
+from path_registry import register_paths, resolve_path_id
 
 from typing import Union, Dict, List, Any, Optional, Tuple
 from datetime import timedelta, date, datetime
-import hashlib
 
 from fastapi import Response, status
+
+from serialization import json_response
+from metrics import timed_phase
+from budget import aggregate_options
 import operator
 
 # Path: app/miniapp_journey.py
 
+# The compute_* functions run on a miss of their cache, on the collection of compute_collection or, for the async
+# endpoints, on the LoopCollection of miniapp_journey_async.
+
+# "sketch" merges distinct-user sketches of the leaves, "query" runs the aggregations of every tree node, "prune" runs
+# them for the nodes rendered only, the children being ranked on the sessions of the path trie beforehand
+TREE_STATS_MODE = os.environ.get("TREE_STATS_MODE", "sketch")
+# "mongo" aggregates the journeys or their rollups, "snapshot" computes in process on the daily snapshots of
+# snapshot.py whenever the days of a query are exported, and falls back to "mongo" otherwise
+ANALYTICS_BACKEND = os.environ.get("ANALYTICS_BACKEND", "mongo")
+# longest date range of a path trend
+MAX_TREND_DAYS = int(os.environ.get("MAX_TREND_DAYS", 366))
+
+def use_snapshots(dates: List[datetime]) -> bool:
+    return ANALYTICS_BACKEND == "snapshot" and snapshots_ready(dates)
+
+def reads_primary(dates: List[datetime]) -> bool:
+    """
+    Whether a result on the dates must be computed on the primary: it is cached under their current version, which a
+    secondary may not have replicated the journeys of yet
+    """
+    if ANALYTICS_STALENESS_SECONDS == 0:
+        return False
+    if ANALYTICS_STALENESS_SECONDS == float("inf"):
+        return True
+
+    cutoff = datetime.utcnow() - timedelta(seconds=ANALYTICS_STALENESS_SECONDS)
+
+    return any(written_at is not None and written_at > cutoff for written_at in get_dates_written_at(dates).values())
+
+def compute_collection(dates: List[datetime]) -> Collection:
+    return miniapp_primary_collection if reads_primary(dates) else miniapp_collection
+
+def build_tree_leaf_filter(date_time: datetime, granularity: Granularity, root_filter: Dict, node_name: Optional[str], depth: int) -> Dict:
+    leaf_filter = build_batch_match_filter(date_time, granularity, root_filter)
+
+    if node_name:
+        leaf_filter[gen_path_node_filter(position=depth-1)] = {"$in": entity_ids(node_name)}
+
+    return leaf_filter
+
+def scope_tree_filter(tree: dict, root_filter: Dict):
+    """
+    Restrict the node filters of prepare_tree_filter to the journeys of the root filter (device_os), inplace
+    """
+    scope = {field: value for field, value in root_filter.items() if field != "journey_date"}
+
+    for node in iter_tree_nodes(tree):
+        node["filter"].update(scope)
+
 def build_root_node(start_date: date, granularity: Optional[Granularity], start_node: Optional[str] = None, device_os: Optional[str] = None) -> Dict[str, Any]:
     root_filter = {}
     date_time = datetime(year=start_date.year, month=start_date.month, day=start_date.day,)
@@ -19,136 +77,302 @@ def build_root_node(start_date: date, granularity: Optional[Granularity], start_
         root_filter["journey_date"] = {"$gte": date_time, "$lt": date_time + timedelta(days=int(Granularity.WEEKLY.value))}
 
     if start_node:
-        root_filter['path.entity_name'] = start_node
+        root_filter[gen_path_node_filter(position=0)] = {"$in": entity_ids(start_node)}
 
     if device_os:
         root_filter['device_os'] = device_os
 
-    root_node = {"filter": root_filter, "projection": { "_id": 0, "path.child.entity_name" if start_node else "path.entity_name": 1}}
+    root_node = {"filter": root_filter, "projection": { "_id": 0, "path_ids": 1}}
 
     return root_node
 
-def get_top_journeys_from_node(start_date: date, granularity: Optional[Granularity], start_node: Optional[str] = None, device_os: Optional[str] = None):
+def build_top_paths_page(paths_stats: Dict[Tuple[int, ...], Dict], page: List[Tuple[Tuple[int, ...], int]]) -> List[Dict]:
+    # the names are only decoded here, for the paths of the page
+    path_strs = decode_paths(path for path, _ in page)
+    # the path_ids handed out can be sent back to /journeys/path
+    register_paths(path_strs)
+
+    # in the order of the ranking, the pages of a ranking follow each other without overlap
+    return [{"path": path_strs[path], "stats": paths_stats[path], "path_id": make_path_id(path_strs[path])} for path, _ in page]
+
+def merge_named_paths(ranking: List[Tuple[Tuple[int, ...], int]]) -> List[Tuple[Tuple[int, ...], int]]:
+    """
+    One entry per path of names, the sessions of the paths of ids spelling it are added to the first of them in the
+    ranking. As the first nodes, entities sharing a name are one node. The entries are left unordered
+    """
+    path_strs = decode_paths(path for path, _ in ranking)
+    merged = {}
+
+    for path, sessions in ranking:
+        entry = merged.setdefault(path_strs[path], [path, 0])
+        entry[1] += sessions
+
+    return [(path, sessions) for path, sessions in merged.values()]
+
+def compute_paths_stats(collection, date_time: datetime, granularity: Granularity, root_filter: Dict, paths: List[Tuple[int, ...]]) -> Dict[Tuple[int, ...], Dict]:
+    """
+    Statistics of both periods of the paths of a ranking, a path stands for every path of ids spelling its names
+    """
+    variants = path_variants(paths)
+    all_paths = list(dict.fromkeys(variant for spellings in variants.values() for variant in spellings))
+
+    if use_snapshots(covered_dates(date_time, granularity, with_previous=True)):
+        variants_stats = retrieve_snapshot_statistics(date_time, granularity, root_filter, all_paths)
+    elif rollups_ready(covered_dates(date_time, granularity, with_previous=True)):
+        variants_stats = retrieve_rollup_statistics(date_time, granularity, root_filter, all_paths)
+    else:
+        # full statistics of these paths only, both periods in one aggregation
+        variants_stats = retrieve_batch_journey_statistics(collection, date_time, granularity, root_filter, all_paths)
+
+    return {path: merge_path_stats([variants_stats[variant] for variant in variants[path]]) for path in variants}
+
+def compute_ranking(collection, date_time: datetime, granularity: Granularity, root_filter: Dict) -> List[Tuple[Tuple[int, ...], int]]:
+    if use_snapshots(covered_dates(date_time, granularity)):
+        ranking = retrieve_snapshot_ranking(date_time, granularity, root_filter)
+    elif rollups_ready(covered_dates(date_time, granularity)):
+        ranking = retrieve_rollup_ranking(date_time, granularity, root_filter)
+    else:
+        # sessions only, the top MAX_TOP_PATHS paths and the ones tied with the last are kept
+        pipeline = build_path_ranking_pipeline(root_filter)
+        ranking = rank_paths(collection.aggregate(pipeline, allowDiskUse=True, **aggregate_options()))
+
+    ranking = merge_named_paths(ranking)
+
+    # the distinct users of the paths with the same sessions order them, as shown by their page
+    tied = tied_paths(ranking)
+    dist_users = {path: stats["dist_users"] for path, stats in compute_paths_stats(collection, date_time, granularity, root_filter, tied).items()} if tied else {}
+
+    return order_ranking(ranking, dist_users)
+
+def compute_top_paths_page(collection, date_time: datetime, granularity: Granularity, root_filter: Dict, ranking, offset: int, limit: int) -> List[Dict]:
+    # rankings read back from Mongo have lists for paths
+    page = [(tuple(path), sessions) for path, sessions in ranking[offset:offset + limit]]
+
+    if not page:
+        return []
+
+    with timed_phase("stats"):
+        # the statistics of the paths of the page only
+        paths_stats = compute_paths_stats(collection, date_time, granularity, root_filter, [path for path, _ in page])
+
+    with timed_phase("build"):
+        return build_top_paths_page(paths_stats, page)
+
+def get_top_journeys_from_node(start_date: date, granularity: Optional[Granularity], start_node: Optional[str] = None, device_os: Optional[str] = None, limit: int = MAX_TOP_PATHS, offset: int = 0):
+    """
+    :return: the paths of the page, each one already serialized to JSON bytes
+    """
 
     date_time = datetime(year=start_date.year, month=start_date.month, day=start_date.day,)
+    root_node = build_root_node(start_date, granularity, start_node, device_os)
 
-    # retrieve paths from cache
+    ranking_key = top_paths_ranking_cache.make_key(date=date_time, granularity=granularity.value, start_node=start_node, device_os=device_os)
+    dates = covered_dates(date_time, granularity)
+    with timed_phase("discover"):
+        ranking = top_paths_ranking_cache.get_or_compute(ranking_key, dates,
+            partial(compute_ranking, compute_collection(dates), date_time, granularity, root_node["filter"]))
 
-    top_journeys_cache_collection = journey_db["top_journeys_cache"]
+    page_key = top_paths_page_cache.make_key(date=date_time, granularity=granularity.value, start_node=start_node, device_os=device_os, offset=offset, limit=limit)
+    dates = covered_dates(date_time, granularity, with_previous=True)
 
-    top_journeys = top_journeys_cache_collection.find_one({"date": date_time, "granularity": granularity.value, "start_node": start_node, "device_os": device_os})
+    return top_paths_page_cache.get_or_compute(page_key, dates,
+        partial(compute_top_paths_page, compute_collection(dates), date_time, granularity, root_node["filter"], ranking, offset, limit))
 
-    if top_journeys:
-        return top_journeys['data']
+def build_first_nodes(first_node_ids: List[int]) -> List[Dict]:
+    names = entity_names(first_node_ids)
 
+    # entities sharing a name are one node
+    return [{"node_name": node_name} for node_name in dict.fromkeys(names[entity_id] for entity_id in first_node_ids)]
 
-    root_node = build_root_node(start_date, granularity, start_node, device_os)
+def compute_first_nodes(collection, date_time: datetime, granularity: Granularity, device_os: Optional[str]) -> List[Dict]:
+    root_filter = {}
 
-    # TODO: retrieve paths from cache
+    if granularity == Granularity.DAILY:
+        root_filter["journey_date"] = {"$gte": date_time, "$lt": date_time + timedelta(days=int(Granularity.DAILY.value))}
+    elif granularity == Granularity.WEEKLY:
+        root_filter["journey_date"] = {"$gte": date_time, "$lt": date_time + timedelta(days=int(Granularity.WEEKLY.value))}
+
+    if device_os:
+        root_filter['device_os'] = {'$in': device_os.split(',')}
+
+    if use_snapshots(covered_dates(date_time, granularity)):
+        return build_first_nodes(retrieve_snapshot_first_nodes(date_time, granularity, root_filter))
 
-    paths = find_all_path_from_node(miniapp_collection, root_node)
+    if rollups_ready(covered_dates(date_time, granularity)):
+        return build_first_nodes(retrieve_rollup_first_nodes(date_time, granularity, root_filter))
 
-    # TODO: save paths to cache
+    pipeline = [
+        {"$match": root_filter},
+        {"$group": {"_id": {"$arrayElemAt": ["$path_ids", 0]}}},
+    ]
 
-    result = []
+    return build_first_nodes([row["_id"] for row in collection.aggregate(pipeline, **aggregate_options()) if row["_id"] is not None])
 
-    for path, filters in add_tail_filter_to_paths(paths).items():
-        path_stats = retrieve_journey_statistics(miniapp_collection, date_time, granularity, (path, filters))
+def get_first_nodes(ds: date, granularity: Optional[Granularity], device_os: Optional[str] = None):
+    """
+    :return: the first nodes serialized to JSON bytes
+    """
 
-        path_stats.update({"path_id": hashlib.sha256(path.encode('utf-8')).hexdigest()})
+    date_time = datetime(year=ds.year, month=ds.month, day=ds.day,)
 
-        result.append(path_stats)
+    cache_key = first_node_cache.make_key(date=date_time, granularity=granularity.value, device_os=device_os)
 
-    # sort the result by sessions, descending
-    result.sort(key=lambda k: (k["stats"]["sessions"], k["stats"]["dist_users"]), reverse=True)
+    dates = covered_dates(date_time, granularity)
 
-    # save top journeys to cache
-    top_journeys_cache_collection.insert_one({"date": date_time, "granularity": granularity.value, "start_node": start_node, "device_os": device_os, "data": result})
+    return first_node_cache.get_or_compute(cache_key, dates, partial(compute_first_nodes, compute_collection(dates), date_time, granularity, device_os))
 
-    # result set limit to 1000
-    return result[:1000]
+def validate_tree_request(node_name: Optional[str], depth: int, max_node_per_depth: int, max_depth: int) -> Optional[Response]:
+    if not node_name and depth > 0:
+        return Response(status_code=status.HTTP_400_BAD_REQUEST, content="node_name is required if depth > 0")
 
-def get_first_nodes(ds: date, granularity: Optional[Granularity], device_os: Optional[str] = None):
+    if depth < 0:
+        return Response(status_code=status.HTTP_400_BAD_REQUEST, content="depth must be >= 0")
 
-    date_time = datetime(year=ds.year, month=ds.month, day=ds.day,)
-    # retrieve first nodes from cache
-    first_node_cache_collection = journey_db["first_node_cache"]
+    if node_name and depth == 0:
+        return Response(status_code=status.HTTP_400_BAD_REQUEST, content="depth must be > 0 if node_name is provided")
 
-    first_node = first_node_cache_collection.find_one({"date": date_time, "granularity": granularity.value, "device_os": device_os})
+    if max_node_per_depth < 1 or max_depth < -1:
+        return Response(status_code=status.HTTP_400_BAD_REQUEST, content="max_node_per_depth must be >= 1 and max_depth >= -1")
 
-    if first_node:
-        return first_node['data']
+    return None
 
-    root_filter = {}
+def compute_path_tree(collection, start_date: date, granularity: Granularity, node_name: Optional[str], depth: int, device_os: Optional[str],
+        max_node_per_depth: int, max_depth: int) -> Optional[Dict]:
+    date_time = datetime(year=start_date.year, month=start_date.month, day=start_date.day,)
+    root_node = build_root_node(start_date, granularity, None, device_os) # root node do not have node_name, pass None instead
 
-    if granularity == Granularity.DAILY:
-        root_filter["journey_date"] = {"$gte": date_time, "$lt": date_time + timedelta(days=int(Granularity.DAILY.value))}
-    elif granularity == Granularity.WEEKLY:
-        root_filter["journey_date"] = {"$gte": date_time, "$lt": date_time + timedelta(days=int(Granularity.WEEKLY.value))}
+    def load_paths():
+        if use_snapshots(covered_dates(date_time, granularity)):
+            return retrieve_snapshot_path_sessions(date_time, granularity, root_node["filter"])
 
-    if device_os:
-        root_filter['device_os'] = {'$in': device_os.split(',')}
+        if rollups_ready(covered_dates(date_time, granularity)):
+            return retrieve_rollup_path_sessions(date_time, granularity, root_node["filter"])
+
+        return find_path_sessions(collection, root_node)
+
+    # the trie of the period is shared by every (node_name, depth)
+    with timed_phase("discover"):
+        trie = get_path_trie(date_time, granularity, device_os, load_paths)
+
+    with timed_phase("build"):
+        tree = trie.build_tree(entity_ids(node_name) if node_name else None, depth)
+
+    if tree is None:
+        return None
+
+    with timed_phase("stats"):
+        if TREE_STATS_MODE == "sketch":
+            # one aggregation for the leaves, every node is a merge of the leaves below it
+            leaf_filter = build_tree_leaf_filter(date_time, granularity, root_node["filter"], node_name, depth)
 
-    root_node = {"filter": root_filter, "projection": { "_id": 0, "path.entity_name": 1}}
+            if use_snapshots(covered_dates(date_time, granularity, with_previous=True)):
+                leaves = retrieve_snapshot_leaves(date_time, granularity, leaf_filter)
+            elif rollups_ready(covered_dates(date_time, granularity, with_previous=True)):
+                leaves = retrieve_rollup_leaves(date_time, granularity, leaf_filter)
+            else:
+                leaves = build_leaf_period_stats(collection.aggregate(build_leaf_sketch_pipeline(leaf_filter, date_time), allowDiskUse=True, **aggregate_options()))
 
-    cursor = miniapp_collection.find(**root_node)
+            attach_leaf_paths(tree, leaves.keys(), depth - 1)
+            collect_tree_stat_from_leaves(tree, leaves)
+        else:
+            if TREE_STATS_MODE == "prune":
+                prune_tree(tree, max_node_per_depth, max_depth)
 
-    result = []
+            prepare_tree_filter(tree)
+            scope_tree_filter(tree, root_node["filter"])
+            collect_tree_stat(collection, date_time, granularity, tree)
 
-    for path in cursor:
-        if path['path']['entity_name'] not in result:
-            result.append(path['path']['entity_name'])
+    with timed_phase("transform"):
+        decode_tree_names(tree)
+        transform_and_limit_tree(tree, max_node_per_depth, max_depth)
 
-    # save first nodes to cache
-    final_result = [{"node_name": node_name} for node_name in result]
+    return tree
 
-    first_node_cache_collection.insert_one({"date": date_time, "granularity": granularity.value, "device_os": device_os, "data": final_result})
+def path_tree_response(result) -> Response:
+    if result is None:
+        return Response(status_code=status.HTTP_404_NOT_FOUND, content= '{"message": "No path found"}', media_type="application/json")
 
-    return final_result
+    # result is the tree already serialized
+    return json_response(result)
 
-def get_path_tree(start_date: date, granularity: Granularity,  node_name: Union[str, None] = None, depth: Union[int, None] = 0, device_os: Union[str, None] = None):
+def get_path_tree(start_date: date, granularity: Granularity,  node_name: Union[str, None] = None, depth: Union[int, None] = 0, device_os: Union[str, None] = None,
+        max_node_per_depth: int = MAX_NODE_PER_DEPTH, max_depth: int = -1):
 
     date_time = datetime(year=start_date.year, month=start_date.month, day=start_date.day,)
-    # retrieve paths from cache
 
-    path_tree_cache_collection = journey_db["path_tree_cache"]
+    invalid = validate_tree_request(node_name, depth, max_node_per_depth, max_depth)
+    if invalid is not None:
+        return invalid
 
-    path_tree = path_tree_cache_collection.find_one({"date": date_time, "granularity": granularity.value, "node_name": node_name, "depth": depth, "device_os": device_os})
+    cache_key = path_tree_cache.make_key(date=date_time, granularity=granularity.value, node_name=node_name, depth=depth, device_os=device_os,
+        max_node_per_depth=max_node_per_depth, max_depth=max_depth)
 
-    if path_tree:
-        return Response(content=json.dumps(path_tree['data']), status_code=status.HTTP_200_OK, media_type="application/json")
+    dates = covered_dates(date_time, granularity, with_previous=True)
 
-    if not node_name and depth > 0:
-        return Response(status_code=status.HTTP_400_BAD_REQUEST, content="node_name is required if depth > 0")
+    return path_tree_response(path_tree_cache.get_or_compute(cache_key, dates,
+        partial(compute_path_tree, compute_collection(dates), start_date, granularity, node_name, depth, device_os, max_node_per_depth, max_depth)))
 
-    if depth < 0:
-        return Response(status_code=status.HTTP_400_BAD_REQUEST, content="depth must be >= 0")
+def build_trend_series(daily: Dict[datetime, Dict], days: List[datetime]) -> List[Dict]:
+    empty = {"dist_users": 0, "sessions": 0, "device_os": []}
 
-    if node_name and depth == 0:
-        return Response(status_code=status.HTTP_400_BAD_REQUEST, content="depth must be > 0 if node_name is provided")
+    return [{"journey_date": day.date().isoformat(), **daily.get(day, empty)} for day in days]
 
-    root_node = build_root_node(start_date, granularity, None, device_os) # root node do not have node_name, pass None instead
+def validate_trend_range(from_date: date, to_date: date) -> Optional[Response]:
+    if to_date < from_date:
+        return Response(status_code=status.HTTP_400_BAD_REQUEST, content="to must be >= from")
 
-    # TODO: retrieve paths from cache
+    if (to_date - from_date).days >= MAX_TREND_DAYS:
+        return Response(status_code=status.HTTP_400_BAD_REQUEST, content=f"the range is limited to {MAX_TREND_DAYS} days")
 
-    paths = add_tail_filter_to_paths(find_all_path_from_node(miniapp_collection, root_node))
-    # TODO: save paths to cache
+    return None
 
-    sub_paths_dict = gen_sub_paths(paths, node_name, depth=depth)
-    # print("DEBUG: sub_paths_dict: ", sub_paths_dict)
+def build_trend_filter(path: Dict, device_os: Optional[str]) -> Dict:
+    # every path of ids spelling the names of the path
+    variants = path_variants([path["path_ids"]])[path["path_ids"]]
+    root_filter = {"path_key": {"$in": [make_path_key(variant) for variant in variants]}}
 
-    if not sub_paths_dict:
-        return Response(status_code=status.HTTP_404_NOT_FOUND, content= '{"message": "No path found"}', media_type="application/json")
+    if device_os:
+        root_filter["device_os"] = device_os
+
+    return root_filter
+
+PATH_NOT_FOUND = '{"message": "Unknown path_id"}'
+
+def trend_days(from_date: date, to_date: date) -> List[datetime]:
+    start_date = datetime(year=from_date.year, month=from_date.month, day=from_date.day,)
+
+    return [start_date + timedelta(days=i) for i in range((to_date - from_date).days + 1)]
+
+def compute_path_trend(collection, path: Dict, path_id: str, days: List[datetime], device_os: Optional[str]) -> Dict:
+    root_filter = build_trend_filter(path, device_os)
+    start_date, end_date = days[0], days[-1] + timedelta(days=1)
+
+    with timed_phase("stats"):
+        if rollups_ready(days):
+            daily = retrieve_rollup_daily_stats(start_date, end_date, root_filter)
+        else:
+            # every day grouped in one aggregation, each day is a "path" of build_batch_statistic_pipeline. Truncated,
+            # a journey_date stored with a time of day still counts in its day
+            match_filter = dict(root_filter, journey_date={"$gte": start_date, "$lt": end_date})
+            day = {"$dateTrunc": {"date": "$journey_date", "unit": "day"}}
+            daily = merge_daily_statistic_rows(collection.aggregate(build_batch_statistic_pipeline(match_filter, start_date, day), allowDiskUse=True, **aggregate_options()))
 
-    tree = build_tree(sub_paths_dict, is_root=(node_name is None))
-    prepare_tree_filter(tree)
-    collect_tree_stat(miniapp_collection, date_time, granularity, tree)
+    with timed_phase("build"):
+        return {"path": decode_path(path["path_ids"]), "path_id": path_id, "series": build_trend_series(daily, days)}
 
-    transform_and_limit_tree(tree)
+def get_path_trend(path_id: str, from_date: date, to_date: date, device_os: Optional[str] = None):
+    """
+    Sessions, distinct users and device_os of one path for every day of [from_date, to_date], in one query
+    """
+    invalid = validate_trend_range(from_date, to_date)
+    if invalid is not None:
+        return invalid
 
-    result = tree
+    path = resolve_path_id(path_id)
+    if path is None:
+        return Response(status_code=status.HTTP_404_NOT_FOUND, content=PATH_NOT_FOUND, media_type="application/json")
 
-    # save path tree to cache
-    path_tree_cache_collection.insert_one({"date": date_time, "granularity": granularity.value, "node_name": node_name, "depth": depth, "device_os": device_os, "data": result})
+    days = trend_days(from_date, to_date)
+    cache_key = path_trend_cache.make_key(path_id=path_id, from_date=days[0], to_date=days[-1], device_os=device_os)
 
-    return Response(content=json.dumps(result), status_code=status.HTTP_200_OK, media_type="application/json")
+    return json_response(path_trend_cache.get_or_compute(cache_key, days, partial(compute_path_trend, compute_collection(days), path, path_id, days, device_os)))
@@ -0,0 +1,153 @@
+from utils import *
+from cache import top_paths_ranking_cache, top_paths_page_cache, first_node_cache, path_tree_cache, path_trend_cache, covered_dates
+from miniapp_journey import build_root_node, compute_ranking, compute_top_paths_page, compute_first_nodes, compute_path_tree, compute_path_trend
+from miniapp_journey import reads_primary, validate_tree_request, path_tree_response, validate_trend_range, trend_days, PATH_NOT_FOUND
+from path_registry import resolve_path_id
+
+import asyncio
+import weakref
+
+from typing import Union, Dict, List, Any, Optional, Tuple
+from datetime import timedelta, date, datetime
+
+from fastapi import Response, status
+
+from serialization import json_response
+from metrics import timed_phase
+from budget import aggregate_options
+
+# Path: app/miniapp_journey_async.py
+
+# Async endpoints on the motor client. The results cached are answered on the event loop, a miss runs the compute
+# function of miniapp_journey in a worker thread with a LoopCollection: its aggregations are sent by motor on the
+# event loop, and the independent ones (tree node statistics) run concurrently. Like in the sync endpoints they read
+# the primary while a secondary may miss the last ingestion into their dates, see reads_primary.
+
+# maximum number of aggregations in flight at the same time on the event loop of a worker
+MONGO_CONCURRENCY = int(os.environ.get("MONGO_CONCURRENCY", 16))
+
+# event loop -> asyncio.Semaphore of MONGO_CONCURRENCY shared by every request of the loop
+_semaphores = weakref.WeakKeyDictionary()
+
+def loop_semaphore() -> asyncio.Semaphore:
+    loop = asyncio.get_running_loop()
+    semaphore = _semaphores.get(loop)
+
+    if semaphore is None:
+        semaphore = _semaphores[loop] = asyncio.Semaphore(MONGO_CONCURRENCY)
+
+    return semaphore
+
+async def aggregate_to_list(collection, pipeline: List[Dict], **kwargs) -> List[Dict]:
+    async with loop_semaphore():
+        return await collection.aggregate(pipeline, **kwargs).to_list(length=None)
+
+class LoopCollection:
+    """
+    Blocking aggregate and aggregate_all on the motor collection of the journeys of dates, called by the compute
+    functions from a worker thread
+    """
+
+    def __init__(self, dates: List[datetime], loop: asyncio.AbstractEventLoop):
+        self.dates = dates
+        self.loop = loop
+        self._primary = None
+
+    def _run(self, coro_fn):
+        if self._primary is None:
+            # decided in the worker thread, the last ingestion into the dates may have to be read
+            self._primary = reads_primary(self.dates)
+
+        async def run():
+            return await coro_fn(get_async_miniapp_collection(self._primary))
+
+        # the coroutine runs in a copy of the context of the thread, the budget of the request included
+        return asyncio.run_coroutine_threadsafe(run(), self.loop).result()
+
+    def aggregate(self, pipeline: List[Dict], **kwargs) -> List[Dict]:
+        return self._run(lambda collection: aggregate_to_list(collection, pipeline, **kwargs))
+
+    def aggregate_all(self, pipelines: List[List[Dict]], **kwargs) -> List[List[Dict]]:
+        async def aggregate_one(collection, pipeline):
+            async with loop_semaphore():
+                # bounded by the budget left once the aggregation gets its turn
+                return await collection.aggregate(pipeline, **kwargs, **aggregate_options()).to_list(length=None)
+
+        async def gather(collection):
+            return await asyncio.gather(*[aggregate_one(collection, pipeline) for pipeline in pipelines])
+
+        return self._run(gather)
+
+def get_loop_collection(dates: List[datetime]) -> LoopCollection:
+    return LoopCollection(dates, asyncio.get_running_loop())
+
+def in_thread(fn, *args):
+    """
+    compute_coro_fn of aget_or_compute running fn(*args) in a worker thread
+    """
+    return lambda: asyncio.to_thread(fn, *args)
+
+async def get_top_journeys_from_node_async(start_date: date, granularity: Optional[Granularity], start_node: Optional[str] = None, device_os: Optional[str] = None, limit: int = MAX_TOP_PATHS, offset: int = 0):
+    """
+    :return: the paths of the page, each one already serialized to JSON bytes
+    """
+
+    date_time = datetime(year=start_date.year, month=start_date.month, day=start_date.day,)
+    # resolving start_node may read the entity dictionary
+    root_node = await asyncio.to_thread(build_root_node, start_date, granularity, start_node, device_os)
+
+    ranking_key = top_paths_ranking_cache.make_key(date=date_time, granularity=granularity.value, start_node=start_node, device_os=device_os)
+    dates = covered_dates(date_time, granularity)
+    with timed_phase("discover"):
+        ranking = await top_paths_ranking_cache.aget_or_compute(ranking_key, dates,
+            in_thread(compute_ranking, get_loop_collection(dates), date_time, granularity, root_node["filter"]))
+
+    page_key = top_paths_page_cache.make_key(date=date_time, granularity=granularity.value, start_node=start_node, device_os=device_os, offset=offset, limit=limit)
+    dates = covered_dates(date_time, granularity, with_previous=True)
+
+    return await top_paths_page_cache.aget_or_compute(page_key, dates,
+        in_thread(compute_top_paths_page, get_loop_collection(dates), date_time, granularity, root_node["filter"], ranking, offset, limit))
+
+async def get_first_nodes_async(ds: date, granularity: Optional[Granularity], device_os: Optional[str] = None):
+    """
+    :return: the first nodes serialized to JSON bytes
+    """
+
+    date_time = datetime(year=ds.year, month=ds.month, day=ds.day,)
+
+    cache_key = first_node_cache.make_key(date=date_time, granularity=granularity.value, device_os=device_os)
+
+    dates = covered_dates(date_time, granularity)
+
+    return await first_node_cache.aget_or_compute(cache_key, dates, in_thread(compute_first_nodes, get_loop_collection(dates), date_time, granularity, device_os))
+
+async def get_path_tree_async(start_date: date, granularity: Granularity,  node_name: Union[str, None] = None, depth: Union[int, None] = 0, device_os: Union[str, None] = None,
+        max_node_per_depth: int = MAX_NODE_PER_DEPTH, max_depth: int = -1):
+
+    date_time = datetime(year=start_date.year, month=start_date.month, day=start_date.day,)
+
+    invalid = validate_tree_request(node_name, depth, max_node_per_depth, max_depth)
+    if invalid is not None:
+        return invalid
+
+    cache_key = path_tree_cache.make_key(date=date_time, granularity=granularity.value, node_name=node_name, depth=depth, device_os=device_os,
+        max_node_per_depth=max_node_per_depth, max_depth=max_depth)
+
+    dates = covered_dates(date_time, granularity, with_previous=True)
+
+    return path_tree_response(await path_tree_cache.aget_or_compute(cache_key, dates,
+        in_thread(compute_path_tree, get_loop_collection(dates), start_date, granularity, node_name, depth, device_os, max_node_per_depth, max_depth)))
+
+async def get_path_trend_async(path_id: str, from_date: date, to_date: date, device_os: Optional[str] = None):
+    invalid = validate_trend_range(from_date, to_date)
+    if invalid is not None:
+        return invalid
+
+    path = await asyncio.to_thread(resolve_path_id, path_id)
+    if path is None:
+        return Response(status_code=status.HTTP_404_NOT_FOUND, content=PATH_NOT_FOUND, media_type="application/json")
+
+    days = trend_days(from_date, to_date)
+    cache_key = path_trend_cache.make_key(path_id=path_id, from_date=days[0], to_date=days[-1], device_os=device_os)
+
+    return json_response(await path_trend_cache.aget_or_compute(cache_key, days, in_thread(compute_path_trend, get_loop_collection(days), path, path_id, days, device_os)))
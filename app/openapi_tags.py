@@ -7,6 +7,14 @@ tags_metadata = [
         "name": "miniapp journey tree",
         "description": "Operations with miniapp journeys in tree form.",
     },
+    {
+        "name": "miniapp journey ingestion",
+        "description": "Bulk writes of miniapp journeys.",
+    },
+    {
+        "name": "monitoring",
+        "description": "Counters of the result caches and the queries.",
+    },
     {
         "name": "ping",
         "description": "An example of a (dumb) ping pong operation.",
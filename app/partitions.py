@@ -0,0 +1,350 @@
+from datetime import datetime, timedelta
+import os
+import re
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from bson.objectid import ObjectId
+from bson.son import SON
+from pymongo import ASCENDING, IndexModel
+from pymongo.collection import Collection
+
+# Path: app/partitions.py
+
+# Monthly partitions of the journeys. With JOURNEY_PARTITIONING=month the journeys of a month are stored in their own
+# collection, miniapp2_YYYYMM, and PartitionedCollection routes the queries. The journey_date range of the first
+# $match selects the months, the other months are added with $unionWith, so a period spanning two months stays one
+# aggregation. Dropping or archiving a month is a drop or a rename of its collection.
+#
+#   python partitions.py --list
+#   python partitions.py --migrate                     copy the journeys of the single collection into the partitions
+#   python partitions.py --drop-before 2023-01         drop the months before January 2023
+#   python partitions.py --archive-before 2023-01      rename them to miniapp2_archive_YYYYMM, no longer queried
+#
+# The rollups, snapshots and cached results of a dropped month are kept, they keep serving its days.
+#
+# journey_id is only unique inside a partition, its unique index is the map of the journeys of the month and is
+# dropped with it. Every journey written carries the ObjectId of its batch: a journey sent again with a date in another
+# month is deleted from the other partitions where an older batch stored it, the latest batch wins.
+
+# "none" keeps every journey in the single miniapp2 collection
+JOURNEY_PARTITIONING = os.environ.get("JOURNEY_PARTITIONING", "none")
+
+JOURNEY_COLLECTION = "miniapp2"
+
+JOURNEY_INDEXES = [
+    # date range + platform, the match of every top_paths / first_nodes / batch statistics query
+    IndexModel([("journey_date", ASCENDING), ("device_os", ASCENDING), ("path_key", ASCENDING)], name="journey_date_device_os_path_key"),
+    # exact path lookups
+    IndexModel([("path_key", ASCENDING), ("journey_date", ASCENDING)], name="path_key_journey_date"),
+    # first node and tree node lookups by position
+    IndexModel([("path_ids.0", ASCENDING), ("journey_date", ASCENDING)], name="first_node_id_journey_date"),
+    # idempotent bulk ingestion, a journey sent again replaces the stored one. Unique in its partition only, see
+    # PartitionedCollection.remove_moved
+    IndexModel([("journey_id", ASCENDING)], name="journey_id", unique=True),
+]
+
+# find options run as a stage of the aggregation of several partitions, in this order
+FIND_STAGES = {"sort": "$sort", "skip": "$skip", "limit": "$limit"}
+
+def month_start(day: datetime) -> datetime:
+    return datetime(day.year, day.month, 1)
+
+def next_month(month: datetime) -> datetime:
+    return datetime(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+def journey_date_range(filter: Optional[Dict]) -> Tuple[Optional[datetime], Optional[datetime]]:
+    """
+    [start, end) of the journey dates matched by a filter, None for an open bound
+    """
+    value = (filter or {}).get("journey_date")
+
+    if isinstance(value, datetime):
+        return value, value + timedelta(microseconds=1)
+
+    if not isinstance(value, dict):
+        return None, None
+
+    start = value.get("$gte", value.get("$gt"))
+    end = value.get("$lt")
+
+    if end is None and "$lte" in value:
+        end = value["$lte"] + timedelta(microseconds=1)
+
+    return start, end
+
+class PartitionedCollection:
+    """
+    The journeys of every month, queried like one Collection by the journey queries: aggregate, find, find_one,
+    insert_many and delete_many
+
+    :param db: database of the partitions, a motor database works for aggregate
+    :param catalog_db: pymongo database listing the existing partitions, db by default
+    """
+
+    def __init__(self, db, name: str = JOURNEY_COLLECTION, read_preference=None, catalog_db=None):
+        self.db = db
+        self.name = name
+        self.read_preference = read_preference
+        self.catalog_db = catalog_db if catalog_db is not None else db
+        self._pattern = re.compile(rf"^{re.escape(name)}_(\d{{4}})(\d{{2}})$")
+        self._indexed = set()
+        self._lock = threading.Lock()
+
+    def partition_name(self, day: datetime) -> str:
+        return f"{self.name}_{day:%Y%m}"
+
+    def partition(self, name: str):
+        return self.db.get_collection(name, read_preference=self.read_preference)
+
+    def existing_partitions(self) -> List[str]:
+        """
+        Names of the partitions in the database, oldest first
+        """
+        names = self.catalog_db.list_collection_names(filter={"name": {"$regex": self._pattern.pattern}})
+
+        return sorted(name for name in names if self._pattern.match(name))
+
+    def partition_month(self, name: str) -> datetime:
+        year, month = self._pattern.match(name).groups()
+
+        return datetime(int(year), int(month), 1)
+
+    def route(self, filter: Optional[Dict]) -> List[str]:
+        """
+        Partitions holding the journeys of a filter, oldest first
+
+        A bounded journey_date range is routed without reading the catalog, the partitions of months without
+        journeys do not exist and match nothing.
+        """
+        start, end = journey_date_range(filter)
+
+        if start is None or end is None:
+            existing = self.existing_partitions()
+
+            if not existing:
+                return []
+
+            start = start or self.partition_month(existing[0])
+            end = end or next_month(self.partition_month(existing[-1]))
+
+        names = []
+        month = month_start(start)
+
+        while month < end:
+            names.append(self.partition_name(month))
+            month = next_month(month)
+
+        return names
+
+    def aggregate(self, pipeline: List[Dict], **kwargs):
+        """
+        The aggregation run on the first partition of the range, the $match of the pipeline run on the others is
+        appended with $unionWith before the rest of the pipeline
+        """
+        match = pipeline[0] if pipeline and "$match" in pipeline[0] else None
+        names = self.route(match["$match"] if match else None) or [self.partition_name(datetime.utcnow())]
+        rest = pipeline[1:] if match else pipeline
+
+        unions = [{"$unionWith": {"coll": name, "pipeline": [match] if match else []}} for name in names[1:]]
+
+        return self.partition(names[0]).aggregate(([match] if match else []) + unions + rest, **kwargs)
+
+    def find(self, filter: Optional[Dict] = None, projection: Optional[Dict] = None, **kwargs):
+        """
+        find on the partition of a single month range, an aggregation of the range otherwise
+
+        On a range of several months sort, skip and limit become stages of the aggregation, batch_size and
+        max_time_ms its options, any other find option raises TypeError.
+        """
+        names = self.route(filter)
+
+        if len(names) == 1:
+            return self.partition(names[0]).find(filter, projection, **kwargs)
+
+        unsupported = set(kwargs) - set(FIND_STAGES) - {"batch_size", "max_time_ms"}
+
+        if unsupported:
+            raise TypeError(f"find options {sorted(unsupported)} are not supported over several partitions")
+
+        pipeline = [{"$match": filter or {}}]
+
+        for option, stage in FIND_STAGES.items():
+            if kwargs.get(option):
+                pipeline.append({stage: SON(kwargs[option]) if option == "sort" else kwargs[option]})
+
+        if projection:
+            pipeline.append({"$project": {field: 1 for field in projection} if isinstance(projection, (list, tuple)) else projection})
+
+        options = {}
+
+        if kwargs.get("batch_size"):
+            options["batchSize"] = kwargs["batch_size"]
+
+        if kwargs.get("max_time_ms") is not None:
+            options["maxTimeMS"] = kwargs["max_time_ms"]
+
+        return self.aggregate(pipeline, **options)
+
+    def find_one(self, filter: Optional[Dict] = None, projection: Optional[Dict] = None):
+        for name in self.route(filter):
+            document = self.partition(name).find_one(filter, projection)
+
+            if document is not None:
+                return document
+
+        return None
+
+    def ensure_partition(self, name: str) -> Collection:
+        """
+        The partition, with its indexes created on its first write by this process
+        """
+        if name not in self._indexed:
+            self.db[name].create_indexes(JOURNEY_INDEXES)
+
+            with self._lock:
+                self._indexed.add(name)
+
+        return self.partition(name)
+
+    def split(self, documents: Iterable[Dict]) -> Dict[str, List[Dict]]:
+        """
+        dict of partition name -> journey documents stored in it, stamped with the ObjectId of the batch
+        """
+        batch = ObjectId()
+        groups = {}
+
+        for document in documents:
+            document["batch"] = batch
+            groups.setdefault(self.partition_name(document["journey_date"]), []).append(document)
+
+        return groups
+
+    def insert_many(self, documents: Iterable[Dict], ordered: bool = True):
+        for name, group in self.split(documents).items():
+            self.ensure_partition(name).insert_many(group, ordered=ordered)
+
+    def delete_many(self, filter: Dict) -> int:
+        return sum(self.partition(name).delete_many(filter).deleted_count for name in self.route(filter))
+
+    def remove_moved(self, documents_by_partition: Dict[str, List[Dict]]) -> List[datetime]:
+        """
+        Delete the copies of the journeys just written that an older batch stored in another partition
+
+        One lookup on the journey_id index of every partition. Of two batches writing the same journey_id to two
+        months at the same time, the copy of the older one is deleted by the newer one, and not the reverse.
+
+        :param documents_by_partition: journeys just written by split, by partition
+        :return: journey dates of the deleted copies
+        """
+        batch = next(document["batch"] for group in documents_by_partition.values() for document in group)
+        days = []
+
+        for name in self.existing_partitions():
+            journey_ids = [document["journey_id"] for other, group in documents_by_partition.items() if other != name for document in group]
+
+            if not journey_ids:
+                continue
+
+            # the journeys stored before the partitions have no batch
+            older = {"journey_id": {"$in": journey_ids}, "batch": {"$not": {"$gte": batch}}}
+            moved = list(self.db[name].find(older, {"journey_date": 1}))
+
+            if moved:
+                self.db[name].delete_many(dict(older, _id={"$in": [document["_id"] for document in moved]}))
+                days.extend(document["journey_date"] for document in moved)
+
+        return days
+
+    def partitions_before(self, month: datetime) -> List[str]:
+        return [name for name in self.existing_partitions() if self.partition_month(name) < month_start(month)]
+
+    def drop_before(self, month: datetime) -> List[str]:
+        names = self.partitions_before(month)
+
+        for name in names:
+            self.db.drop_collection(name)
+
+        return names
+
+    def archive_before(self, month: datetime) -> List[str]:
+        """
+        Rename the partitions before month to <name>_archive_YYYYMM, a metadata change in the same database
+
+        :return: names of the archives
+        """
+        archives = []
+
+        for name in self.partitions_before(month):
+            archive = f"{self.name}_archive_{self.partition_month(name):%Y%m}"
+            self.db[name].rename(archive)
+            archives.append(archive)
+
+        return archives
+
+    def migrate(self, source: Collection) -> Dict[str, int]:
+        """
+        Copy the journeys of the single collection into the partitions of their month, server side with $merge.
+        Copying again replaces the journeys already copied
+
+        :return: dict of partition name -> journeys in it
+        """
+        first = source.find_one({}, {"journey_date": 1}, sort=[("journey_date", ASCENDING)])
+
+        if first is None:
+            return {}
+
+        last = source.find_one({}, {"journey_date": 1}, sort=[("journey_date", -1)])
+        result = {}
+        month = month_start(first["journey_date"])
+
+        while month <= last["journey_date"]:
+            name = self.partition_name(month)
+            self.ensure_partition(name)
+
+            source.aggregate([
+                {"$match": {"journey_date": {"$gte": month, "$lt": next_month(month)}}},
+                {"$merge": {"into": name, "on": "journey_id", "whenMatched": "replace", "whenNotMatched": "insert"}},
+            ], allowDiskUse=True)
+
+            result[name] = self.db[name].estimated_document_count()
+            month = next_month(month)
+
+        return result
+
+def journey_collections(collection) -> List[Any]:
+    """
+    Every collection storing journeys behind a journey collection, its partitions when it is partitioned
+    """
+    if isinstance(collection, PartitionedCollection):
+        return [collection.partition(name) for name in collection.existing_partitions()]
+
+    return [collection]
+
+if __name__ == "__main__":
+    import argparse
+
+    from utils import journey_db, miniapp_primary_collection
+
+    parser = argparse.ArgumentParser(description="Manage the monthly partitions of the miniapp journeys")
+    parser.add_argument("--list", action="store_true", help="partitions and their estimated number of journeys")
+    parser.add_argument("--migrate", action="store_true", help=f"copy the journeys of {JOURNEY_COLLECTION} into the partitions")
+    parser.add_argument("--drop-before", type=lambda s: datetime.strptime(s, "%Y-%m"), help="YYYY-MM, drop the partitions of the months before")
+    parser.add_argument("--archive-before", type=lambda s: datetime.strptime(s, "%Y-%m"), help="YYYY-MM, rename the partitions of the months before")
+    args = parser.parse_args()
+
+    partitions = miniapp_primary_collection if isinstance(miniapp_primary_collection, PartitionedCollection) else PartitionedCollection(journey_db)
+
+    if args.migrate:
+        for name, count in partitions.migrate(journey_db[JOURNEY_COLLECTION]).items():
+            print(name, "journeys:", count)
+
+    if args.drop_before:
+        print("dropped:", partitions.drop_before(args.drop_before))
+
+    if args.archive_before:
+        print("archived:", partitions.archive_before(args.archive_before))
+
+    if args.list:
+        for name in partitions.existing_partitions():
+            print(name, partitions.db[name].estimated_document_count())
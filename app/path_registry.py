@@ -0,0 +1,90 @@
+from utils import *
+
+import threading
+
+from pymongo import ASCENDING, IndexModel
+from pymongo.errors import BulkWriteError
+
+from budget import find_options
+
+# Path: app/path_registry.py
+
+# Registry of the public path ids (sha256 of the node names) handed out by top_paths, so a path_id sent back to the
+# API resolves to its entity ids and path_key. The hash cannot be inverted, a path is registered when it is served.
+
+path_registry_collection = journey_db["miniapp_path_ids"]
+
+PATH_REGISTRY_INDEXES = [
+    IndexModel([("path_key", ASCENDING)], name="path_key"),
+]
+
+# path_ids already registered by this process, forgotten once it grows past this size
+PATH_REGISTRY_MEMORY_SIZE = int(os.environ.get("PATH_REGISTRY_MEMORY_SIZE", 100000))
+
+DUPLICATE_KEY = 11000
+
+_registered = set()
+# path_id -> resolved path, a registered path_id never changes
+_resolved = {}
+_lock = threading.Lock()
+
+def register_paths(path_strs: Dict[Tuple[int, ...], str]) -> int:
+    """
+    Register the path_id of the paths (entity ids -> node names), the path_ids already registered are left untouched
+
+    :return: number of path_ids written
+    """
+    documents = {}
+
+    for path, path_str in path_strs.items():
+        path_id = make_path_id(path_str)
+
+        if path_id not in _registered:
+            documents[path_id] = SON(_id=path_id, path_ids=list(path), path_key=make_path_key(path), path=path_str)
+
+    if not documents:
+        return 0
+
+    written = len(documents)
+
+    try:
+        path_registry_collection.insert_many(list(documents.values()), ordered=False)
+    except BulkWriteError as e:
+        errors = e.details["writeErrors"]
+
+        if any(error["code"] != DUPLICATE_KEY for error in errors):
+            raise
+
+        written -= len(errors)
+
+    with _lock:
+        if len(_registered) + len(documents) > PATH_REGISTRY_MEMORY_SIZE:
+            _registered.clear()
+
+        _registered.update(documents)
+
+    return written
+
+def resolve_path_id(path_id: str) -> Optional[Dict]:
+    """
+    :return: {"path_ids", "path_key", "path"} of a registered path_id, None when it was never served
+    """
+    path = _resolved.get(path_id)
+
+    if path is not None:
+        return path
+
+    document = path_registry_collection.find_one({"_id": path_id}, **find_options())
+
+    if document is None:
+        return None
+
+    path = {"path_ids": tuple(document["path_ids"]), "path_key": document["path_key"], "path": document["path"]}
+
+    with _lock:
+        if len(_resolved) >= PATH_REGISTRY_MEMORY_SIZE:
+            _resolved.clear()
+
+        _resolved[path_id] = path
+
+    return path
@@ -0,0 +1,152 @@
+from utils import *
+from cache import covered_dates, get_dates_version
+from budget import check_discovered_paths
+
+from collections import OrderedDict
+import threading
+
+# Path: app/path_trie.py
+
+# Trie of every path of a (date, granularity, device_os), built once and queried by get_path_tree for any
+# (node_name, depth) without rescanning the paths. Nodes are entity ids, get_path_tree decodes the names. Every node
+# counts the current period sessions of the paths going through it, enough to rank the children of a tree node.
+
+PATH_TRIE_CACHE_SIZE = int(os.environ.get("PATH_TRIE_CACHE_SIZE", 32))
+
+class PathTrieNode:
+    """
+    name: int: entity id
+    position: int: index of the node in the paths going through it, -1 for the root
+    children: dict of entity id -> PathTrieNode
+    path: tuple of int: the full path if a path ends at this node, None otherwise
+    sessions: int: sessions of the paths going through this node
+    """
+    __slots__ = ("name", "position", "children", "path", "sessions")
+
+    def __init__(self, name: Optional[int], position: int):
+        self.name = name
+        self.position = position
+        self.children = {}
+        self.path = None
+        self.sessions = 0
+
+class PathTrie:
+
+    def __init__(self):
+        self.root = PathTrieNode(None, -1)
+        # (position, entity id) -> trie nodes, the anchors of get_path_tree
+        self.nodes_by_position = {}
+        self.size = 0
+
+    @classmethod
+    def from_paths(cls, paths) -> "PathTrie":
+        """
+        :param paths: dict of path -> sessions, or the paths alone
+        """
+        trie = cls()
+
+        for path, sessions in (paths.items() if isinstance(paths, dict) else ((path, 0) for path in paths)):
+            trie.add(path, sessions)
+
+        return trie
+
+    def add(self, path: Tuple[int, ...], sessions: int = 0):
+        node = self.root
+        node.sessions += sessions
+
+        for position, name in enumerate(path):
+            child = node.children.get(name)
+
+            if child is None:
+                child = PathTrieNode(name, position)
+                node.children[child.name] = child
+                self.nodes_by_position.setdefault((position, child.name), []).append(child)
+                self.size += 1
+
+            node = child
+            node.sessions += sessions
+
+        node.path = path
+
+    def _merge(self, nodes: List[PathTrieNode], starting_point: int) -> Dict:
+        # trie nodes of the same entity at the same position under different parents are merged in one tree node
+        tree = {"name": nodes[0].name, "depth": nodes[0].position + 1, "starting_points": [starting_point,], "children": {},
+                "paths": [node.path for node in nodes if node.path is not None], "sessions": sum(node.sessions for node in nodes)}
+
+        groups = {}
+        for node in nodes:
+            for name, child in node.children.items():
+                groups.setdefault(name, []).append(child)
+
+        for name, group in groups.items():
+            tree["children"][name] = self._merge(group, starting_point)
+
+        return tree
+
+    def build_tree(self, node_ids: Optional[List[int]] = None, depth: int = 0) -> Optional[Dict]:
+        """
+        Tree of the paths below the entities node_ids at the given depth, or of every path under a "root" node
+        without node_ids
+
+        The tree has the shape expected by prepare_tree_filter, names are entity ids, "paths" lists the full paths
+        ending at each node and "sessions" counts the sessions through it. None when no path matches.
+        """
+        if node_ids is None:
+            if not self.root.children:
+                return None
+
+            tree = {"name": "root", "starting_points": [-1,], "children": {}, "depth": 0, "paths": [], "sessions": self.root.sessions}
+
+            for name, child in self.root.children.items():
+                tree["children"][name] = self._merge([child,], 0)
+
+            return tree
+
+        # one name may stand for several entity ids
+        anchors = [anchor for node_id in node_ids for anchor in self.nodes_by_position.get((depth - 1, node_id), [])]
+
+        if not anchors:
+            return None
+
+        return self._merge(anchors, depth - 1)
+
+_tries = OrderedDict()
+_tries_lock = threading.Lock()
+
+def _get_cached_trie(trie_key: Tuple, version: int) -> Optional[PathTrie]:
+    with _tries_lock:
+        entry = _tries.get(trie_key)
+
+        if entry is not None and entry[0] == version:
+            _tries.move_to_end(trie_key)
+            return entry[1]
+
+    return None
+
+def _remember_trie(trie_key: Tuple, version: int, trie: PathTrie):
+    with _tries_lock:
+        _tries[trie_key] = (version, trie)
+        _tries.move_to_end(trie_key)
+
+        while len(_tries) > PATH_TRIE_CACHE_SIZE:
+            _tries.popitem(last=False)
+
+def get_path_trie(date_time: datetime, granularity: Granularity, device_os: Optional[str], load_paths_fn) -> PathTrie:
+    """
+    Trie of the paths of (date, granularity, device_os), rebuilt only when journeys of the period are ingested
+
+    :param load_paths_fn: function without argument returning the dict of path (tuple of entity ids) -> sessions of the period
+    """
+    trie_key = (date_time, granularity.value, device_os)
+    version = get_dates_version(covered_dates(date_time, granularity))
+
+    trie = _get_cached_trie(trie_key, version)
+
+    if trie is None:
+        paths = load_paths_fn()
+        check_discovered_paths(len(paths))
+
+        trie = PathTrie.from_paths(paths)
+        _remember_trie(trie_key, version, trie)
+
+    return trie
@@ -0,0 +1,251 @@
+from utils import *
+from cache import to_day, covered_dates, get_date_versions, cache_version_collection, VERSION_REFRESH_SECONDS
+from sketch import DistinctSketch, PeriodStats
+from budget import aggregate_options, find_options, discovery_limit
+
+from bson.objectid import ObjectId
+import threading
+import time
+from pymongo import ASCENDING, IndexModel, InsertOne
+from pymongo.errors import DuplicateKeyError
+
+# Path: app/rollup.py
+
+# Daily rollup of the journeys: one document per (journey_date, path_key, device_os) with the sessions and the
+# distinct-user sketch. Rollup documents keep the journey field names (journey_date, path_key, path_ids,
+# device_os) so the filters built for raw journeys apply to them unchanged, and a week is a merge of 7 days.
+#
+# A day is rolled up again into a new build, documents carrying a new ObjectId, made current by swapping the build of
+# its state once complete. Readers only match the current builds and never see a partial day, the build current
+# before is deleted by the next rebuild.
+#
+#   python rollup.py --from 2023-06-10 [--to 2023-06-17]
+#   python rollup.py --dirty
+
+# the rollups keyed on path strings were in miniapp_daily_rollup and the ones without builds in
+# miniapp_daily_path_key_rollup, dropped on startup by indexes.drop_legacy_collections, every day is rolled up again
+rollup_collection = journey_db["miniapp_daily_rollup_builds"]
+# one document per rolled up day, version is the cache date version its current build was rolled up from
+rollup_state_collection = journey_db["miniapp_daily_rollup_builds_state"]
+
+# read the rollups instead of the raw journeys whenever the days of a query are rolled up
+USE_ROLLUPS = os.environ.get("USE_ROLLUPS", "1") == "1"
+
+# journey date -> (date version of its current build, monotonic time it was read), trusted as the date versions
+_states = {}
+_states_lock = threading.Lock()
+
+ROLLUP_INDEXES = [
+    IndexModel([("journey_date", ASCENDING), ("build", ASCENDING), ("path_key", ASCENDING), ("device_os", ASCENDING)], name="rollup_key", unique=True),
+    IndexModel([("journey_date", ASCENDING), ("device_os", ASCENDING), ("path_key", ASCENDING)], name="journey_date_device_os_path_key"),
+    # the trend of one path over a date range
+    IndexModel([("path_key", ASCENDING), ("journey_date", ASCENDING)], name="path_key_journey_date"),
+]
+
+def build_rollup_pipeline(day: datetime) -> List[Dict]:
+    return [
+        {"$match": {"journey_date": {"$gte": day, "$lt": day + timedelta(days=1)}}},
+        # merged per (path_key, device_os) by materialize_day
+        {"$group": {
+            "_id": {"path_key": "$path_key", "device_os": "$device_os", "bucket": agent_bucket()},
+            "path_ids": {"$first": "$path_ids"},
+            "sessions": {"$sum": 1},
+            "agents": {"$addToSet": "$agent_id"}}},
+    ]
+
+def materialize_day(day, collection: Collection = miniapp_primary_collection) -> int:
+    """
+    Rebuild the rollup documents of one journey date from the raw journeys, in a new build
+
+    :return: number of rollup documents written
+    """
+    day = to_day(day)
+    version = get_date_versions([day,])[day]
+    build = ObjectId()
+
+    # (path_key, device_os) -> [path_ids, sessions, DistinctSketch]
+    groups = {}
+
+    for row in collection.aggregate(build_rollup_pipeline(day), allowDiskUse=True):
+        if not row["path_ids"]:
+            continue
+
+        group = groups.setdefault((row["_id"]["path_key"], row["_id"]["device_os"]), [row["path_ids"], 0, DistinctSketch()])
+        group[1] += row["sessions"]
+        group[2].update(row["agents"])
+
+    requests = [
+        InsertOne(SON(journey_date=day, build=build, path_key=path_key, path_ids=path_ids, device_os=device_os, sessions=sessions, users=users.to_document()))
+        for (path_key, device_os), (path_ids, sessions, users) in groups.items()
+    ]
+
+    if requests:
+        rollup_collection.bulk_write(requests, ordered=False)
+
+    try:
+        # a concurrent rebuild of the day that started later stays current
+        previous = rollup_state_collection.find_one_and_update({"_id": day, "build": {"$not": {"$gt": build}}},
+            {"$set": {"version": version, "build": build, "updated_at": datetime.utcnow()}}, upsert=True)
+    except DuplicateKeyError:
+        rollup_collection.delete_many({"journey_date": day, "build": build})
+        return 0
+
+    with _states_lock:
+        _states[day] = (version, time.monotonic())
+
+    # the build replaced now is kept for the readers that matched it, the ones before are deleted
+    if previous is not None and previous.get("build") is not None:
+        rollup_collection.delete_many({"journey_date": day, "build": {"$lt": previous["build"]}})
+
+    return len(requests)
+
+def materialize_days(days) -> Dict[datetime, int]:
+    return {day: materialize_day(day) for day in sorted({to_day(d) for d in days})}
+
+def find_dirty_days() -> List[datetime]:
+    """
+    Rolled up days whose journeys changed since (their cache version moved), plus ingested days never rolled up
+    """
+    states = {row["_id"]: row.get("version") for row in rollup_state_collection.find()}
+    versions = {row["_id"]: row["version"] for row in cache_version_collection.find()}
+
+    return sorted(day for day in set(states) | set(versions) if states.get(day) != versions.get(day, 0))
+
+def refresh_rollups() -> Dict[datetime, int]:
+    """
+    Incremental update, only the days touched since their last rollup are rebuilt
+    """
+    return materialize_days(find_dirty_days())
+
+def rollups_ready(dates: List[datetime]) -> bool:
+    """
+    Whether every date is rolled up from its current journeys
+    """
+    if not USE_ROLLUPS:
+        return False
+
+    versions = get_date_versions(dates)
+    states = get_rollup_versions(dates)
+
+    return all(states[d] is not None and states[d] == versions[d] for d in dates)
+
+def get_rollup_versions(dates: List[datetime]) -> Dict[datetime, Optional[int]]:
+    """
+    Date version of the current build of every date, None when it is not rolled up, read from Mongo when this process
+    has no fresh copy
+    """
+    now = time.monotonic()
+
+    with _states_lock:
+        stale = [d for d in dates if d not in _states or now - _states[d][1] > VERSION_REFRESH_SECONDS]
+
+    if stale:
+        fetched = {d: (None, now) for d in stale}
+
+        for row in rollup_state_collection.find({"_id": {"$in": stale}}):
+            fetched[row["_id"]] = (row.get("version"), now)
+
+        with _states_lock:
+            _states.update(fetched)
+
+    with _states_lock:
+        return {d: _states[d][0] for d in dates}
+
+def rollup_builds(start_date: datetime, end_date: datetime) -> List[ObjectId]:
+    """
+    Current builds of the days [start_date, end_date)
+    """
+    states = rollup_state_collection.find({"_id": {"$gte": start_date, "$lt": end_date}, "build": {"$ne": None}}, {"build": 1}, **find_options())
+
+    return [row["build"] for row in states]
+
+def rollup_filter(root_filter: Dict, start_date: datetime, end_date: datetime) -> Dict:
+    filter = dict(root_filter)
+    filter["journey_date"] = {"$gte": start_date, "$lt": end_date}
+    filter["build"] = {"$in": rollup_builds(start_date, end_date)}
+
+    return filter
+
+def retrieve_rollup_ranking(start_date: datetime, granularity: Granularity, root_filter: Dict) -> List[Tuple[Tuple[int, ...], int]]:
+    pipeline = build_path_ranking_pipeline(rollup_filter(root_filter, start_date, start_date + timedelta(days=int(granularity))))
+    # a rollup document stands for "sessions" journeys
+    pipeline[-1]["$group"]["sessions"] = {"$sum": "$sessions"}
+
+    return rank_paths(rollup_collection.aggregate(pipeline, allowDiskUse=True, **aggregate_options()))
+
+def retrieve_rollup_first_nodes(start_date: datetime, granularity: Granularity, root_filter: Dict) -> List[int]:
+    pipeline = [
+        {"$match": rollup_filter(root_filter, start_date, start_date + timedelta(days=int(granularity)))},
+        {"$group": {"_id": {"$arrayElemAt": ["$path_ids", 0]}}},
+    ]
+
+    return [row["_id"] for row in rollup_collection.aggregate(pipeline, **aggregate_options()) if row["_id"] is not None]
+
+def retrieve_rollup_path_sessions(start_date: datetime, granularity: Granularity, root_filter: Dict) -> Dict[Tuple[int, ...], int]:
+    pipeline = build_path_ranking_pipeline(rollup_filter(root_filter, start_date, start_date + timedelta(days=int(granularity))))
+    pipeline[-1]["$group"]["sessions"] = {"$sum": "$sessions"}
+    pipeline += discovery_limit()
+
+    return {tuple(row["_id"]): row["sessions"] for row in rollup_collection.aggregate(pipeline, allowDiskUse=True, **aggregate_options()) if row["_id"]}
+
+def retrieve_rollup_leaves(start_date: datetime, granularity: Granularity, root_filter: Dict, paths: Optional[List[Tuple[int, ...]]] = None) -> Dict[Tuple[int, ...], Dict[str, PeriodStats]]:
+    """
+    Daily rollups of both periods merged per path
+
+    :return: dict of path -> period ("current" or "previous") -> PeriodStats, as build_leaf_period_stats
+    """
+    filter = rollup_filter(root_filter, start_date - timedelta(days=int(granularity)), start_date + timedelta(days=int(granularity)))
+
+    if paths is not None:
+        filter["path_key"] = {"$in": [make_path_key(path) for path in paths]}
+
+    leaves = {}
+
+    for row in rollup_collection.find(filter, {"_id": 0, "journey_date": 1, "path_ids": 1, "device_os": 1, "sessions": 1, "users": 1}, **find_options()):
+        period = "current" if row["journey_date"] >= start_date else "previous"
+
+        stats = leaves.setdefault(tuple(row["path_ids"]), {}).setdefault(period, PeriodStats())
+        stats.add(row["device_os"], row["sessions"], DistinctSketch.from_document(row["users"]))
+
+    return leaves
+
+def retrieve_rollup_statistics(start_date: datetime, granularity: Granularity, root_filter: Dict, paths: List[Tuple[int, ...]]) -> Dict[Tuple[int, ...], Dict]:
+    """
+    Same result as retrieve_batch_journey_statistics with paths, read from the rollups
+    """
+    leaves = retrieve_rollup_leaves(start_date, granularity, root_filter, paths)
+
+    return {path: period_stats_to_stats(leaves.get(path, {})) for path in paths}
+
+def retrieve_rollup_daily_stats(start_date: datetime, end_date: datetime, root_filter: Dict) -> Dict[datetime, Dict]:
+    """
+    Same result as merge_daily_statistic_rows for the days [start_date, end_date), read from the rollups
+    """
+    days = {}
+
+    for row in rollup_collection.find(rollup_filter(root_filter, start_date, end_date), {"_id": 0, "journey_date": 1, "device_os": 1, "sessions": 1, "users": 1}, **find_options()):
+        days.setdefault(row["journey_date"], PeriodStats()).add(row["device_os"], row["sessions"], DistinctSketch.from_document(row["users"]))
+
+    return {day: stats.to_stats() for day, stats in days.items()}
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Materialize the daily rollups of the miniapp journeys")
+    parser.add_argument("--from", dest="from_date", type=date.fromisoformat, help="first journey date to roll up")
+    parser.add_argument("--to", dest="to_date", type=date.fromisoformat, help="last journey date to roll up, default is --from")
+    parser.add_argument("--dirty", action="store_true", help="rebuild the days whose journeys changed since their rollup")
+    args = parser.parse_args()
+
+    rollup_collection.create_indexes(ROLLUP_INDEXES)
+
+    if args.dirty:
+        written = refresh_rollups()
+    elif args.from_date:
+        to_date = args.to_date or args.from_date
+        written = materialize_days(to_day(args.from_date) + timedelta(days=i) for i in range((to_date - args.from_date).days + 1))
+    else:
+        parser.error("one of --from or --dirty is required")
+
+    for day, count in written.items():
+        print(day.date(), "rollup documents:", count)
@@ -0,0 +1,126 @@
+import json
+import zlib
+from typing import Any, Iterable, List, Tuple
+
+from fastapi import Response
+from fastapi.responses import StreamingResponse
+
+# Path: app/serialization.py
+
+# JSON encoding of the API payloads. orjson is used when installed, the cached payloads are stored already encoded
+# so a cache hit is written to the socket as is. The payloads stored in Mongo are compressed, with zstd when
+# zstandard is installed and zlib otherwise.
+
+try:
+    import orjson
+
+    def dumps(obj: Any) -> bytes:
+        return orjson.dumps(obj)
+
+    loads = orjson.loads
+except ImportError:
+    def dumps(obj: Any) -> bytes:
+        return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+    loads = json.loads
+
+try:
+    import zstandard
+
+    COMPRESSION_CODEC = "zstd"
+except ImportError:
+    zstandard = None
+
+    COMPRESSION_CODEC = "zlib"
+
+# payloads stored as is, too small to be worth compressing
+IDENTITY = "identity"
+
+def compress(payload: bytes) -> Tuple[str, bytes]:
+    """
+    :return: (codec, compressed payload)
+    """
+    if zstandard is not None:
+        # compressors are not thread safe, and cheap to create
+        return "zstd", zstandard.ZstdCompressor(level=3).compress(payload)
+
+    return "zlib", zlib.compress(payload, 6)
+
+def decompress(codec: str, chunks: Iterable[bytes]) -> bytes:
+    """
+    Decompress a payload read as consecutive chunks, one compressed chunk in flight at a time. The decompressed
+    payload is returned whole
+
+    :raise ValueError: when the codec is not available in this process
+    """
+    if codec == IDENTITY:
+        return b"".join(chunks)
+
+    if codec == "zstd":
+        if zstandard is None:
+            raise ValueError("zstandard is not installed")
+
+        decompressor = zstandard.ZstdDecompressor().decompressobj()
+    elif codec == "zlib":
+        decompressor = zlib.decompressobj()
+    else:
+        raise ValueError(f"unknown codec {codec}")
+
+    try:
+        return b"".join(decompressor.decompress(chunk) for chunk in chunks)
+    except zlib.error as e:
+        raise ValueError(f"corrupted {codec} payload") from e
+    except Exception as e:
+        if zstandard is not None and isinstance(e, zstandard.ZstdError):
+            raise ValueError(f"corrupted {codec} payload") from e
+
+        raise
+
+# formats of the payloads stored by ResultCache
+RAW = "raw"
+JSON = "json"
+JSON_ROWS = "json_rows"
+
+def encode(data: Any, format: str):
+    """
+    :param format: RAW keeps the data, JSON encodes it to bytes, JSON_ROWS encodes every item of a list to bytes
+    """
+    if format == JSON:
+        return dumps(data)
+
+    if format == JSON_ROWS:
+        return [dumps(row) for row in data]
+
+    return data
+
+def pack_payload(data, format: str) -> bytes:
+    """
+    The encoded data of a JSON or JSON_ROWS format as one byte string, JSON rows never contain a raw newline
+    """
+    if format == JSON_ROWS:
+        return b"\n".join(data)
+
+    return data
+
+def unpack_payload(payload: bytes, format: str):
+    if format == JSON_ROWS:
+        return payload.split(b"\n") if payload else []
+
+    return payload
+
+def iter_json_rows(rows: Iterable[bytes]):
+    """
+    The JSON array of encoded rows, one row per chunk
+    """
+    yield b"["
+
+    for i, row in enumerate(rows):
+        yield (b"," + row) if i else row
+
+    yield b"]"
+
+def json_response(payload: bytes, status_code: int = 200) -> Response:
+    return Response(content=payload, status_code=status_code, media_type="application/json")
+
+def json_rows_response(rows: List[bytes]) -> StreamingResponse:
+    return StreamingResponse(iter_json_rows(rows), media_type="application/json")
@@ -0,0 +1,182 @@
+import hashlib
+import math
+import os
+from typing import Dict, Iterable, List, Optional
+
+# Path: app/sketch.py
+
+# Mergeable distinct-user counts: an exact set of agent ids while it is small, a HyperLogLog above the threshold.
+# Stats of a tree node, a week or all device_os are the merge of the sketches of their parts.
+
+# standard error of the HyperLogLog estimate, 1.04 / sqrt(number of registers)
+SKETCH_ERROR = float(os.environ.get("SKETCH_ERROR", 0.01))
+# distinct users counted exactly before switching to HyperLogLog, -1 counts everything exactly
+SKETCH_EXACT_THRESHOLD = int(os.environ.get("SKETCH_EXACT_THRESHOLD", 4096))
+# the agent ids of a group are collected by the aggregations in this many pieces, agent_id modulo the number of
+# pieces, each piece a document far below the 16 MB limit
+SKETCH_AGENT_BUCKETS = int(os.environ.get("SKETCH_AGENT_BUCKETS", 16))
+
+def precision_for_error(error: float) -> int:
+    """
+    Number of index bits of the HyperLogLog reaching the standard error, between 4 and 18
+    """
+    return min(18, max(4, math.ceil(math.log2((1.04 / error) ** 2))))
+
+def hash_agent(agent_id) -> int:
+    return int.from_bytes(hashlib.blake2b(str(agent_id).encode('utf-8'), digest_size=8).digest(), "big")
+
+class DistinctSketch:
+    """
+    Distinct count of agent ids
+
+    :param precision: index bits of the HyperLogLog, default from SKETCH_ERROR
+    :param exact_threshold: size of the exact set above which it is converted, -1 to stay exact
+    """
+    __slots__ = ("precision", "exact_threshold", "items", "registers")
+
+    def __init__(self, precision: Optional[int] = None, exact_threshold: int = SKETCH_EXACT_THRESHOLD):
+        self.precision = precision or precision_for_error(SKETCH_ERROR)
+        self.exact_threshold = exact_threshold
+        self.items = set()
+        self.registers = None
+
+    @classmethod
+    def from_agents(cls, agents: Iterable, **kwargs) -> "DistinctSketch":
+        sketch = cls(**kwargs)
+        sketch.update(agents)
+
+        return sketch
+
+    @property
+    def is_exact(self) -> bool:
+        return self.registers is None
+
+    def _add_hash(self, h: int):
+        index = h >> (64 - self.precision)
+        remaining = (h << self.precision) & ((1 << 64) - 1)
+        # position of the leftmost 1 bit in the remaining 64 - precision bits
+        rank = min(64 - self.precision, 64 - remaining.bit_length()) + 1
+
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def _to_hll(self):
+        self.registers = bytearray(1 << self.precision)
+
+        for agent_id in self.items:
+            self._add_hash(hash_agent(agent_id))
+
+        self.items = set()
+
+    def add(self, agent_id):
+        if self.registers is not None:
+            self._add_hash(hash_agent(agent_id))
+            return
+
+        self.items.add(agent_id)
+
+        if 0 <= self.exact_threshold < len(self.items):
+            self._to_hll()
+
+    def update(self, agents: Iterable):
+        for agent_id in agents:
+            self.add(agent_id)
+
+    def merge(self, other: "DistinctSketch") -> "DistinctSketch":
+        """
+        Union of the other sketch into this one, inplace
+        """
+        if other.registers is None:
+            self.update(other.items)
+            return self
+
+        if other.precision != self.precision:
+            raise ValueError(f"cannot merge sketches of precision {self.precision} and {other.precision}")
+
+        if self.registers is None:
+            self._to_hll()
+
+        self.registers = bytearray(max(a, b) for a, b in zip(self.registers, other.registers))
+
+        return self
+
+    def copy(self) -> "DistinctSketch":
+        sketch = DistinctSketch(self.precision, self.exact_threshold)
+        sketch.items = set(self.items)
+        sketch.registers = bytearray(self.registers) if self.registers is not None else None
+
+        return sketch
+
+    def count(self) -> int:
+        if self.registers is None:
+            return len(self.items)
+
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m) if m >= 128 else {16: 0.673, 32: 0.697, 64: 0.709}[m]
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            # small range correction, linear counting
+            estimate = m * math.log(m / zeros)
+
+        return int(round(estimate))
+
+    def to_document(self) -> Dict:
+        if self.registers is None:
+            return {"exact": list(self.items)}
+
+        return {"precision": self.precision, "registers": bytes(self.registers)}
+
+    @classmethod
+    def from_document(cls, document: Dict, exact_threshold: int = SKETCH_EXACT_THRESHOLD) -> "DistinctSketch":
+        if "exact" in document:
+            return cls.from_agents(document["exact"], exact_threshold=exact_threshold)
+
+        sketch = cls(document["precision"], exact_threshold)
+        sketch.registers = bytearray(document["registers"])
+
+        return sketch
+
+class PeriodStats:
+    """
+    Sessions and distinct users of a period, in total and per device_os
+    """
+    __slots__ = ("sessions", "users", "device_os")
+
+    def __init__(self):
+        self.sessions = 0
+        self.users = DistinctSketch()
+        # device_os -> [sessions, DistinctSketch]
+        self.device_os = {}
+
+    def add(self, device_os: str, sessions: int, users: DistinctSketch):
+        self.sessions += sessions
+        self.users.merge(users)
+
+        entry = self.device_os.get(device_os)
+        if entry is None:
+            self.device_os[device_os] = [sessions, users.copy()]
+        else:
+            entry[0] += sessions
+            entry[1].merge(users)
+
+    def merge(self, other: "PeriodStats") -> "PeriodStats":
+        for device_os, (sessions, users) in other.device_os.items():
+            self.add(device_os, sessions, users)
+
+        return self
+
+    def to_stats(self) -> Dict:
+        device_os = [{"_id": os_name, "sessions": sessions, "dist_users": users.count()} for os_name, (sessions, users) in self.device_os.items()]
+        device_os.sort(key=lambda d: (-d["sessions"], -d["dist_users"], d["_id"] or ""))
+
+        return {"dist_users": self.users.count(), "sessions": self.sessions, "device_os": device_os}
+
+def merge_period_stats(stats: List[PeriodStats]) -> PeriodStats:
+    result = PeriodStats()
+
+    for s in stats:
+        result.merge(s)
+
+    return result
@@ -0,0 +1,533 @@
+from __future__ import annotations
+
+from utils import *
+from cache import to_day, covered_dates, get_date_versions, cache_version_collection
+from sketch import DistinctSketch, PeriodStats
+from budget import check_budget, check_discovered_paths
+
+from collections import OrderedDict
+import json
+import shutil
+import threading
+import time
+import uuid
+from typing import Iterator
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Path: app/snapshot.py
+
+# Columnar snapshots of the journeys, one directory of NumPy arrays per journey date, read memory-mapped by an
+# in-process engine answering first_nodes, top_paths and the tree leaves without querying Mongo:
+#
+#   agents.npy      int64 [sessions]           agent_id of each journey
+#   os_codes.npy    int16 [sessions]           index of the device_os in meta.json
+#   path_codes.npy  int32 [sessions]           index of the path of the journey in the path table
+#   path_nodes.npy  int64 [paths, max length]  path table, entity ids padded with -1
+#   path_keys.npy   int64 [paths]              path_key of each path of the table
+#
+# A snapshot is valid for one cache date version. Every export is written to a directory of its own and published
+# by atomically replacing the link named after the version (2023-06-10.v42) to point to it, a published directory
+# is never modified nor removed while it is current. The API workers must share SNAPSHOT_DIR.
+#
+#   python snapshot.py --from 2023-06-10 [--to 2023-06-17]
+#   python snapshot.py --dirty
+#   python snapshot.py --dirty --interval 60       export the dirty days every minute, the snapshots service
+
+SNAPSHOT_DIR = os.environ.get("SNAPSHOT_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "snapshots"))
+# days kept memory-mapped by this process
+SNAPSHOT_CACHE_SIZE = int(os.environ.get("SNAPSHOT_CACHE_SIZE", 64))
+# exports no longer linked are removed after this delay, a reader may have resolved the link just before
+SNAPSHOT_GRACE_SECONDS = int(os.environ.get("SNAPSHOT_GRACE_SECONDS", 600))
+
+ARRAYS = ("agents", "os_codes", "path_codes", "path_nodes", "path_keys")
+PAD = -1
+
+def snapshot_path(day: datetime, version: int) -> str:
+    return os.path.join(SNAPSHOT_DIR, f"{day.date().isoformat()}.v{version}")
+
+def list_snapshots() -> Dict[datetime, List[int]]:
+    """
+    :return: dict of journey date -> versions of its snapshots on disk, latest first
+    """
+    result = {}
+
+    if not os.path.isdir(SNAPSHOT_DIR):
+        return result
+
+    for name in os.listdir(SNAPSHOT_DIR):
+        day, _, version = name.partition(".v")
+
+        if not version.isdigit():
+            continue
+
+        result.setdefault(to_day(date.fromisoformat(day)), []).append(int(version))
+
+    for versions in result.values():
+        versions.sort(reverse=True)
+
+    return result
+
+def export_day(day, collection: Collection = miniapp_primary_collection) -> int:
+    """
+    Write the snapshot of one journey date from the raw journeys, the snapshot before it is kept for the readers
+    still on the previous version, the older ones are removed
+
+    :return: number of sessions written
+    """
+    if np is None:
+        raise RuntimeError("numpy is required by the snapshots")
+
+    day = to_day(day)
+    version = get_date_versions([day,])[day]
+
+    codes = {}
+    paths = []
+    keys = []
+    os_names = {}
+    agents, os_codes, path_codes = [], [], []
+
+    rows = collection.find({"journey_date": {"$gte": day, "$lt": day + timedelta(days=1)}},
+                           {"_id": 0, "agent_id": 1, "device_os": 1, "path_ids": 1, "path_key": 1})
+
+    for row in rows.batch_size(10000):
+        # as the rollups, journeys without a path are never counted
+        if not row.get("path_ids"):
+            continue
+
+        code = codes.get(row["path_key"])
+        if code is None:
+            code = codes[row["path_key"]] = len(paths)
+            paths.append(row["path_ids"])
+            keys.append(row["path_key"])
+
+        agents.append(row["agent_id"])
+        os_codes.append(os_names.setdefault(row.get("device_os"), len(os_names)))
+        path_codes.append(code)
+
+    path_nodes = np.full((len(paths), max(map(len, paths), default=0)), PAD, dtype=np.int64)
+    for i, path in enumerate(paths):
+        path_nodes[i, :len(path)] = path
+
+    arrays = {
+        "agents": np.array(agents, dtype=np.int64),
+        "os_codes": np.array(os_codes, dtype=np.int16),
+        "path_codes": np.array(path_codes, dtype=np.int32),
+        "path_nodes": path_nodes,
+        "path_keys": np.array(keys, dtype=np.int64),
+    }
+
+    # unique, concurrent exports of the same day never write to the same directory
+    export = f"{snapshot_path(day, version)}.{uuid.uuid4().hex}"
+    os.makedirs(export)
+
+    for name, array in arrays.items():
+        np.save(os.path.join(export, f"{name}.npy"), array)
+
+    with open(os.path.join(export, "meta.json"), "w") as f:
+        json.dump({"version": version, "device_os": list(os_names), "sessions": len(agents), "paths": len(paths)}, f)
+
+    publish_snapshot(day, version, export)
+    remove_old_snapshots(day)
+
+    return len(agents)
+
+def publish_snapshot(day: datetime, version: int, export: str):
+    """
+    Point the link of the version to a complete export, readers only ever see complete snapshots
+    """
+    target = snapshot_path(day, version)
+
+    if os.path.isdir(target) and not os.path.islink(target):
+        # a complete snapshot of this version written before the links, it stays current
+        shutil.rmtree(export, ignore_errors=True)
+        return
+
+    link = f"{export}.link"
+    os.symlink(os.path.basename(export), link)
+    # atomic, the readers resolve either the previous export or this one
+    os.replace(link, target)
+
+def remove_old_snapshots(day: datetime):
+    """
+    Keep the snapshots of the 2 latest versions of a day, the exports they do not link to are removed once older
+    than SNAPSHOT_GRACE_SECONDS
+    """
+    versions = list_snapshots().get(day, [])
+
+    for old in versions[2:]:
+        path = snapshot_path(day, old)
+
+        if os.path.islink(path):
+            os.unlink(path)
+        else:
+            shutil.rmtree(path, ignore_errors=True)
+
+    linked = {os.path.realpath(snapshot_path(day, version)) for version in versions[:2]}
+    prefix = f"{day.date().isoformat()}.v"
+    now = time.time()
+
+    for name in os.listdir(SNAPSHOT_DIR):
+        path = os.path.join(SNAPSHOT_DIR, name)
+
+        # exports and leftover links only, the links of the versions are named 2023-06-10.v42
+        if not name.startswith(prefix) or name[len(prefix):].isdigit() or os.path.realpath(path) in linked:
+            continue
+
+        try:
+            if now - os.lstat(path).st_mtime < SNAPSHOT_GRACE_SECONDS:
+                continue
+
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.unlink(path)
+        except FileNotFoundError:
+            # removed by a concurrent export
+            pass
+
+def export_days(days) -> Dict[datetime, int]:
+    return {day: export_day(day) for day in sorted({to_day(d) for d in days})}
+
+def find_dirty_snapshot_days() -> List[datetime]:
+    """
+    Days whose latest snapshot is older than their journeys, plus ingested days never exported
+    """
+    snapshots = list_snapshots()
+    versions = {row["_id"]: row["version"] for row in cache_version_collection.find()}
+
+    return sorted(day for day in versions if versions[day] not in snapshots.get(day, []))
+
+def refresh_snapshots() -> Dict[datetime, int]:
+    return export_days(find_dirty_snapshot_days())
+
+def snapshots_ready(dates: List[datetime]) -> bool:
+    """
+    Whether every date has a snapshot of its current journeys
+    """
+    if np is None:
+        return False
+
+    versions = get_date_versions(dates)
+
+    return all(os.path.isdir(snapshot_path(d, versions[d])) for d in dates)
+
+_days = OrderedDict()
+_days_lock = threading.Lock()
+
+def load_day(day: datetime, version: int) -> Dict[str, Any]:
+    """
+    Arrays of the snapshot of a day, memory-mapped so the workers of a host share the page cache
+    """
+    key = (day, version)
+
+    with _days_lock:
+        snapshot = _days.get(key)
+
+        if snapshot is not None:
+            _days.move_to_end(key)
+            return snapshot
+
+    # resolved once, every array comes from the same export even when the link is replaced meanwhile
+    path = os.path.realpath(snapshot_path(day, version))
+    snapshot = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r") for name in ARRAYS}
+
+    with open(os.path.join(path, "meta.json")) as f:
+        snapshot["device_os"] = json.load(f)["device_os"]
+
+    with _days_lock:
+        _days[key] = snapshot
+
+        while len(_days) > SNAPSHOT_CACHE_SIZE:
+            _days.popitem(last=False)
+
+    return snapshot
+
+class SnapshotFrame:
+    """
+    Sessions of several days with one path table and one device_os table, read from the memory-mapped arrays of the
+    days, the session arrays are never copied, only the sessions matching a filter are
+
+    days: arrays of each day, current: whether each day is in the current period
+    path_nodes, path_keys: path table shared by the days, device_os: names of the os codes of the frame
+    path_maps, os_maps: code in the frame of each path and os code of each day, None when the frame has one day
+    """
+    __slots__ = ("days", "current", "path_maps", "os_maps", "path_nodes", "path_keys", "device_os")
+
+    def __init__(self, days: List[Dict[str, Any]], current: List[bool]):
+        self.days = days
+        self.current = current
+
+        if len(days) == 1:
+            self.device_os, self.path_nodes, self.path_keys = days[0]["device_os"], days[0]["path_nodes"], days[0]["path_keys"]
+            self.path_maps = self.os_maps = [None,]
+            return
+
+        self.device_os = list(dict.fromkeys(name for day in days for name in day["device_os"]))
+        os_index = {name: i for i, name in enumerate(self.device_os)}
+        self.os_maps = [np.array([os_index[name] for name in day["device_os"]], dtype=np.int16) for day in days]
+
+        width = max(day["path_nodes"].shape[1] for day in days)
+        nodes = [np.pad(day["path_nodes"], ((0, 0), (0, width - day["path_nodes"].shape[1])), constant_values=PAD) for day in days]
+
+        # a path seen on several days gets one code, found by its path_key
+        self.path_keys, first, inverse = np.unique(np.concatenate([day["path_keys"] for day in days]), return_index=True, return_inverse=True)
+        self.path_nodes = np.concatenate(nodes)[first]
+
+        offsets = np.cumsum([0,] + [len(day["path_keys"]) for day in days])
+        self.path_maps = [inverse[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+
+    def path(self, code: int) -> Tuple[int, ...]:
+        nodes = self.path_nodes[code]
+
+        return tuple(int(node) for node in nodes[nodes != PAD])
+
+    def path_mask(self, field: str, value) -> np.ndarray:
+        values = value["$in"] if isinstance(value, dict) else [value,]
+
+        if field == "path_key":
+            return np.isin(self.path_keys, values)
+
+        position = int(field[len("path_ids."):])
+
+        if position >= self.path_nodes.shape[1]:
+            return np.zeros(len(self.path_keys), dtype=bool)
+
+        return np.isin(self.path_nodes[:, position], values)
+
+    def masks(self, filter: Dict) -> Iterator[Optional[np.ndarray]]:
+        """
+        Sessions of each day matching a journey filter built by the API, None when all of them do, journey_date is
+        left to the days of the frame
+        """
+        paths = None
+        names = None
+
+        for field, value in filter.items():
+            if field == "journey_date":
+                continue
+            elif field == "device_os":
+                names = value["$in"] if isinstance(value, dict) else [value,]
+            elif field == "path_key" or field.startswith("path_ids."):
+                mask = self.path_mask(field, value)
+                paths = mask if paths is None else paths & mask
+            else:
+                raise ValueError(f"unsupported snapshot filter field {field}")
+
+        for day, path_map in zip(self.days, self.path_maps):
+            mask = None
+
+            if paths is not None:
+                mask = (paths if path_map is None else paths[path_map])[day["path_codes"]]
+
+            if names is not None:
+                os_mask = np.isin(day["os_codes"], [i for i, name in enumerate(day["device_os"]) if name in names])
+                mask = os_mask if mask is None else mask & os_mask
+
+            yield mask
+
+    def sessions(self, filter: Dict) -> np.ndarray:
+        """
+        Sessions per path code of the frame matching a journey filter
+        """
+        result = np.zeros(len(self.path_keys), dtype=np.int64)
+
+        for day, path_map, mask in zip(self.days, self.path_maps, self.masks(filter)):
+            codes = day["path_codes"] if mask is None else day["path_codes"][mask]
+            counts = np.bincount(codes, minlength=len(day["path_keys"]))
+
+            # the path table of a day has each path once, its codes in the frame are distinct
+            if path_map is None:
+                result += counts
+            else:
+                result[path_map] += counts
+
+        return result
+
+    def select(self, filter: Dict) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Sessions matching a journey filter
+
+        :return: their path codes and device_os codes in the frame, whether they are in the current period, their agents
+        """
+        codes, current, os_codes, agents = [], [], [], []
+
+        for day, is_current, path_map, os_map, mask in zip(self.days, self.current, self.path_maps, self.os_maps, self.masks(filter)):
+            # a full slice is a view of the mapped array
+            rows = slice(None) if mask is None else mask
+            day_codes, day_os = day["path_codes"][rows], day["os_codes"][rows]
+
+            codes.append(day_codes if path_map is None else path_map[day_codes])
+            os_codes.append(day_os if os_map is None else os_map[day_os])
+            current.append(np.full(len(day_codes), is_current))
+            agents.append(day["agents"][rows])
+
+        return tuple(np.concatenate(columns) for columns in (codes, current, os_codes, agents))
+
+def load_frame(start_date: datetime, granularity: Granularity, with_previous: bool = False) -> SnapshotFrame:
+    """
+    Frame of the days of a period, over the memory-mapped days shared by the requests
+    """
+    dates = covered_dates(start_date, granularity, with_previous)
+    versions = get_date_versions(dates)
+    days = []
+
+    for d in dates:
+        # the engine runs between the checks, not under a maxTimeMS
+        check_budget()
+        days.append(load_day(d, versions[d]))
+
+    return SnapshotFrame(days, [d >= start_date for d in dates])
+
+def group_starts(*columns) -> np.ndarray:
+    """
+    Positions where a new group starts in columns sorted on these columns
+    """
+    if not len(columns[0]):
+        return np.empty(0, dtype=np.int64)
+
+    change = np.zeros(len(columns[0]), dtype=bool)
+    change[0] = True
+
+    for column in columns:
+        change[1:] |= column[1:] != column[:-1]
+
+    return np.flatnonzero(change)
+
+def group_stats(group_columns: List[np.ndarray], agents: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Sessions and distinct agents per group of the columns, sort based
+
+    :return: the index of one session of each group in the input, its sessions and its distinct agents
+    """
+    order = np.lexsort((agents,) + tuple(reversed(group_columns)))
+    columns = [column[order] for column in group_columns]
+    starts = group_starts(*columns)
+    bounds = np.append(starts, len(order))
+
+    # a group start is always an agent start too, the agent starts of a group lie between its bounds
+    distinct = group_starts(*columns, agents[order])
+
+    return order[starts], np.diff(bounds), np.diff(np.searchsorted(distinct, bounds))
+
+def retrieve_snapshot_ranking(start_date: datetime, granularity: Granularity, root_filter: Dict, k: int = MAX_TOP_PATHS) -> List[Tuple[Tuple[int, ...], int]]:
+    frame = load_frame(start_date, granularity)
+    sessions = frame.sessions(root_filter)
+
+    top = np.flatnonzero(sessions)
+    if len(top) > k:
+        # sessions of the k-th path, the paths tied with it are all kept like rank_paths does
+        threshold = -np.partition(-sessions[top], k - 1)[k - 1]
+        top = top[sessions[top] >= threshold]
+
+    ranking = [(frame.path(code), int(sessions[code])) for code in top]
+    ranking.sort(key=lambda r: (-r[1], r[0]))
+
+    return ranking
+
+def retrieve_snapshot_first_nodes(start_date: datetime, granularity: Granularity, root_filter: Dict) -> List[int]:
+    frame = load_frame(start_date, granularity)
+    codes = np.flatnonzero(frame.sessions(root_filter))
+
+    return [int(node) for node in np.unique(frame.path_nodes[codes, 0])] if len(codes) else []
+
+def retrieve_snapshot_path_sessions(start_date: datetime, granularity: Granularity, root_filter: Dict) -> Dict[Tuple[int, ...], int]:
+    frame = load_frame(start_date, granularity)
+    sessions = frame.sessions(root_filter)
+    codes = np.flatnonzero(sessions)
+    check_discovered_paths(len(codes))
+
+    return {frame.path(code): int(sessions[code]) for code in codes}
+
+def retrieve_snapshot_statistics(start_date: datetime, granularity: Granularity, root_filter: Dict, paths: List[Tuple[int, ...]]) -> Dict[Tuple[int, ...], Dict]:
+    """
+    Same result as retrieve_batch_journey_statistics with paths, distinct users are exact
+    """
+    frame = load_frame(start_date, granularity, with_previous=True)
+    codes, current, os_codes, agents = frame.select(dict(root_filter, path_key={"$in": [make_path_key(path) for path in paths]}))
+    check_budget()
+    periods = {}
+
+    for i, sessions, users in zip(*group_stats([codes, current], agents)):
+        periods[(frame.path(codes[i]), bool(current[i]))] = {"sessions": int(sessions), "dist_users": int(users), "device_os": []}
+
+    for i, sessions, users in zip(*group_stats([codes, current, os_codes], agents)):
+        periods[(frame.path(codes[i]), bool(current[i]))]["device_os"].append(
+            {"_id": frame.device_os[os_codes[i]], "sessions": int(sessions), "dist_users": int(users)})
+
+    result = {}
+
+    for path in paths:
+        cur = periods.get((path, True)) or {"sessions": 0, "dist_users": 0, "device_os": []}
+        cur_stat = {"dist_users": cur["dist_users"], "sessions": cur["sessions"], "device_os": sort_device_os(cur["device_os"])}
+
+        result[path] = comparing_stat(cur_stat, periods.get((path, False), {}))
+
+    return result
+
+def retrieve_snapshot_leaves(start_date: datetime, granularity: Granularity, root_filter: Dict, paths: Optional[List[Tuple[int, ...]]] = None) -> Dict[Tuple[int, ...], Dict[str, PeriodStats]]:
+    """
+    :return: dict of path -> period ("current" or "previous") -> PeriodStats, as retrieve_rollup_leaves
+    """
+    frame = load_frame(start_date, granularity, with_previous=True)
+
+    if paths is not None:
+        root_filter = dict(root_filter, path_key={"$in": [make_path_key(path) for path in paths]})
+
+    codes, current, os_codes, agents = frame.select(root_filter)
+
+    order = np.lexsort((agents, os_codes, current, codes))
+    codes, current, os_codes, agents = codes[order], current[order], os_codes[order], agents[order]
+    starts = group_starts(codes, current, os_codes)
+
+    leaves = {}
+    path_of = {}
+
+    for i, (start, end) in enumerate(zip(starts, np.append(starts[1:], len(order)))):
+        if i % 4096 == 0:
+            check_budget()
+
+        code = int(codes[start])
+        path = path_of.get(code) or path_of.setdefault(code, frame.path(code))
+
+        stats = leaves.setdefault(path, {}).setdefault("current" if current[start] else "previous", PeriodStats())
+        stats.add(frame.device_os[os_codes[start]], int(end - start), DistinctSketch.from_agents(agents[start:end].tolist()))
+
+    return leaves
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Export the daily columnar snapshots of the miniapp journeys")
+    parser.add_argument("--from", dest="from_date", type=date.fromisoformat, help="first journey date to export")
+    parser.add_argument("--to", dest="to_date", type=date.fromisoformat, help="last journey date to export, default is --from")
+    parser.add_argument("--dirty", action="store_true", help="export the days whose journeys changed since their snapshot")
+    parser.add_argument("--interval", type=int, help="with --dirty, seconds between two exports, runs until stopped")
+    args = parser.parse_args()
+
+    if args.interval and not args.dirty:
+        parser.error("--interval requires --dirty")
+
+    if args.dirty:
+        from mongo import wait_for_mongo
+
+        wait_for_mongo()
+
+        while True:
+            for day, count in refresh_snapshots().items():
+                print(day.date(), "snapshot sessions:", count)
+
+            if not args.interval:
+                break
+
+            time.sleep(args.interval)
+    elif args.from_date:
+        to_date = args.to_date or args.from_date
+
+        for day, count in export_days(to_day(args.from_date) + timedelta(days=i) for i in range((to_date - args.from_date).days + 1)).items():
+            print(day.date(), "snapshot sessions:", count)
+    else:
+        parser.error("one of --from or --dirty is required")
@@ -0,0 +1,89 @@
+import asyncio
+import json
+
+import pytest
+from fastapi import Response
+
+import budget
+from budget import (BudgetExceeded, QueryBudget, QueryCancelled, CLIENT_CLOSED_REQUEST, MAX_DISCOVERED_PATHS, aggregate_options,
+    check_budget, check_discovered_paths, current_budget, discovery_limit, find_options, run_with_budget)
+
+# Path: app/tests/test_budget.py
+
+@pytest.fixture(autouse=True)
+def no_budget():
+    # the budget a test sets is dropped with it
+    token = current_budget.set(None)
+    yield
+    current_budget.reset(token)
+
+def test_no_budget():
+    check_budget()
+    check_discovered_paths(MAX_DISCOVERED_PATHS + 1)
+
+    assert aggregate_options() == {}
+    assert find_options() == {}
+    assert discovery_limit() == []
+
+def test_options_bound_the_queries():
+    current_budget.set(QueryBudget(10))
+
+    assert 0 < aggregate_options()["maxTimeMS"] <= 10000
+    assert 0 < find_options()["max_time_ms"] <= 10000
+    assert discovery_limit() == [{"$limit": MAX_DISCOVERED_PATHS + 2}]
+
+def test_exceeded():
+    current_budget.set(QueryBudget(0))
+
+    with pytest.raises(BudgetExceeded):
+        check_budget()
+
+    with pytest.raises(BudgetExceeded):
+        aggregate_options()
+
+def test_cancelled():
+    query_budget = QueryBudget(10)
+    current_budget.set(query_budget)
+    query_budget.cancel()
+
+    with pytest.raises(QueryCancelled):
+        find_options()
+
+def test_discovered_paths():
+    current_budget.set(QueryBudget(10))
+    check_discovered_paths(MAX_DISCOVERED_PATHS)
+
+    with pytest.raises(BudgetExceeded):
+        check_discovered_paths(MAX_DISCOVERED_PATHS + 1)
+
+class FakeRequest:
+    def __init__(self, disconnected: bool = False):
+        self.disconnected = disconnected
+
+    async def is_disconnected(self) -> bool:
+        return self.disconnected
+
+def test_run_with_budget_exceeded():
+    async def respond():
+        check_discovered_paths(MAX_DISCOVERED_PATHS + 1)
+
+    response = asyncio.run(run_with_budget(FakeRequest(), respond))
+
+    assert response.status_code == 503
+    assert "paths match the request" in json.loads(response.body)["message"]
+
+def test_run_with_budget_disconnected(monkeypatch):
+    monkeypatch.setattr(budget, "DISCONNECT_POLL_SECONDS", 0.01)
+    seen = []
+
+    async def respond():
+        seen.append(current_budget.get())
+        await asyncio.sleep(10)
+        return Response()
+
+    response = asyncio.run(run_with_budget(FakeRequest(disconnected=True), respond))
+
+    assert response.status_code == CLIENT_CLOSED_REQUEST
+    # the budget of the request is cancelled with its task, the queries of its threads stop at their next check
+    assert seen[0].cancelled
+    assert current_budget.get() is None
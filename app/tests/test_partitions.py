@@ -0,0 +1,39 @@
+from datetime import datetime, timedelta
+
+import pymongo
+
+from partitions import PartitionedCollection, journey_date_range
+
+# Path: app/tests/test_partitions.py
+
+db = pymongo.MongoClient(connect=False).journey_db
+
+def test_journey_date_range_bounds():
+    start, end = datetime(2023, 6, 1), datetime(2023, 6, 8)
+
+    assert journey_date_range({"journey_date": {"$gte": start, "$lt": end}}) == (start, end)
+    assert journey_date_range({"journey_date": {"$gt": start, "$lte": end}}) == (start, end + timedelta(microseconds=1))
+    assert journey_date_range({"journey_date": start}) == (start, start + timedelta(microseconds=1))
+
+def test_journey_date_range_open():
+    assert journey_date_range(None) == (None, None)
+    assert journey_date_range({"device_os": "IOS"}) == (None, None)
+    assert journey_date_range({"journey_date": {"$gte": datetime(2023, 6, 1)}}) == (datetime(2023, 6, 1), None)
+
+def test_route_one_month():
+    collection = PartitionedCollection(db, "miniapp")
+
+    assert collection.route({"journey_date": {"$gte": datetime(2023, 6, 1), "$lt": datetime(2023, 6, 8)}}) == ["miniapp_202306"]
+
+def test_route_across_months():
+    collection = PartitionedCollection(db, "miniapp")
+    filter = {"journey_date": {"$gte": datetime(2023, 11, 25), "$lt": datetime(2024, 2, 1)}}
+
+    assert collection.route(filter) == ["miniapp_202311", "miniapp_202312", "miniapp_202401"]
+
+def test_route_end_on_month_start():
+    collection = PartitionedCollection(db, "miniapp")
+
+    # [start, end) stops before July
+    assert collection.route({"journey_date": {"$gte": datetime(2023, 6, 24), "$lt": datetime(2023, 7, 1)}}) == ["miniapp_202306"]
+    assert collection.route({"journey_date": {"$gte": datetime(2023, 6, 24), "$lte": datetime(2023, 7, 1)}}) == ["miniapp_202306", "miniapp_202307"]
@@ -0,0 +1,73 @@
+from path_trie import PathTrie
+from utils import prune_tree
+
+# Path: app/tests/test_path_trie.py
+
+PATHS = {(1, 2, 3): 5, (1, 2): 2, (1, 4): 1, (2, 3): 7}
+
+def test_root_tree():
+    tree = PathTrie.from_paths(PATHS).build_tree()
+
+    assert tree["name"] == "root"
+    assert tree["sessions"] == 15
+    assert sorted(tree["children"]) == [1, 2]
+
+    node = tree["children"][1]
+    assert (node["depth"], node["sessions"], node["paths"]) == (1, 8, [])
+    assert node["children"][2]["paths"] == [(1, 2)]
+    assert node["children"][2]["sessions"] == 7
+    assert node["children"][2]["children"][3]["paths"] == [(1, 2, 3)]
+
+def test_anchored_tree_merges_the_parents():
+    # entity 2 at depth 2 follows 1 and 3, its two trie nodes make one tree node
+    trie = PathTrie.from_paths({**PATHS, (3, 2, 5): 4})
+
+    tree = trie.build_tree([2], 2)
+
+    assert (tree["name"], tree["depth"], tree["starting_points"]) == (2, 2, [1])
+    assert tree["sessions"] == 11
+    assert sorted(tree["children"]) == [3, 5]
+    assert tree["children"][3]["paths"] == [(1, 2, 3)]
+
+def test_several_ids_for_one_name():
+    tree = PathTrie.from_paths(PATHS).build_tree([1, 2], 1)
+
+    assert tree["sessions"] == 15
+    assert sorted(tree["children"]) == [2, 3, 4]
+
+def test_no_match():
+    trie = PathTrie.from_paths(PATHS)
+
+    assert trie.build_tree([9], 1) is None
+    assert trie.build_tree([3], 1) is None
+    assert PathTrie().build_tree() is None
+
+def test_prune_keeps_the_children_with_the_most_sessions():
+    tree = PathTrie.from_paths({**PATHS, (3, 2, 5): 4}).build_tree()
+
+    prune_tree(tree, max_node_per_depth=2)
+
+    # 2 (7 sessions) and 1 (8) are kept, 3 (4) is summed in "others"
+    assert sorted(tree["children"]) == [1, 2]
+    assert tree["others_sessions"] == 4
+    assert list(tree["children"][1]["children"]) == [2, 4]
+    assert "others_sessions" not in tree["children"][1]
+
+def test_prune_depth():
+    tree = PathTrie.from_paths(PATHS).build_tree()
+
+    prune_tree(tree, max_node_per_depth=1, max_depth=1)
+
+    # max_depth is the depth of the paths: the nodes deeper than 1 keep no children
+    assert list(tree["children"]) == [1]
+    assert tree["others_sessions"] == 7
+    assert list(tree["children"][1]["children"]) == [2]
+    assert tree["children"][1]["children"][2]["children"] == {}
+
+def test_prune_depth_of_an_anchored_tree():
+    tree = PathTrie.from_paths(PATHS).build_tree([1], 1)
+
+    prune_tree(tree, max_depth=1)
+
+    assert sorted(tree["children"]) == [2, 4]
+    assert tree["children"][2]["children"] == {}
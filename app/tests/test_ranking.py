@@ -0,0 +1,42 @@
+import random
+
+from utils import rank_paths, tied_paths, order_ranking, merge_path_stats
+
+# Path: app/tests/test_ranking.py
+
+ROWS = [{"_id": [3], "sessions": 5}, {"_id": [1, 2], "sessions": 2}, {"_id": [2], "sessions": 2}, {"_id": [1], "sessions": 2},
+    {"_id": [4], "sessions": 9}, {"_id": [], "sessions": 50}]
+
+def test_order():
+    assert rank_paths(ROWS, 10) == [((4,), 9), ((3,), 5), ((1,), 2), ((1, 2), 2), ((2,), 2)]
+
+def test_ties_at_the_cut_are_all_kept():
+    expected = [((4,), 9), ((3,), 5), ((1,), 2), ((1, 2), 2), ((2,), 2)]
+
+    for seed in range(20):
+        rows = list(ROWS)
+        random.Random(seed).shuffle(rows)
+
+        assert rank_paths(rows, 4) == expected
+
+def test_tied_paths():
+    ranking = [((4,), 9), ((3,), 5), ((1,), 2), ((1, 2), 2), ((2,), 2), ((5,), 1), ((6,), 1)]
+
+    assert tied_paths(ranking) == [(1,), (1, 2), (2,)]
+
+def test_order_ranking_by_distinct_users_then_path():
+    ranking = [((1, 2), 2), ((4,), 9), ((2,), 2), ((1,), 2), ((3,), 5)]
+    dist_users = {(1,): 1, (1, 2): 2, (2,): 2}
+
+    assert order_ranking(ranking, dist_users) == [((4,), 9), ((3,), 5), ((1, 2), 2), ((2,), 2), ((1,), 2)]
+    assert order_ranking(ranking, dist_users, 3) == [((4,), 9), ((3,), 5), ((1, 2), 2)]
+
+def test_merge_path_stats_adds_the_paths():
+    first = {"dist_users": 2, "sessions": 3, "device_os": [{"_id": "IOS", "sessions": 3, "dist_users": 2}], "previous_sessions": 1, "previous_dist_users": 1}
+    second = {"dist_users": 1, "sessions": 4, "device_os": [{"_id": "Android", "sessions": 2, "dist_users": 1}, {"_id": "IOS", "sessions": 2, "dist_users": 1}],
+        "previous_sessions": 0, "previous_dist_users": 0}
+
+    assert merge_path_stats([first]) is first
+    assert merge_path_stats([first, second]) == {"dist_users": 3, "sessions": 7,
+        "device_os": [{"_id": "IOS", "sessions": 5, "dist_users": 3}, {"_id": "Android", "sessions": 2, "dist_users": 1}],
+        "previous_sessions": 1, "previous_dist_users": 1}
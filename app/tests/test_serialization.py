@@ -0,0 +1,44 @@
+import zlib
+
+import pytest
+
+from serialization import IDENTITY, JSON, JSON_ROWS, compress, decompress, dumps, encode, iter_json_rows, loads, pack_payload, unpack_payload
+
+# Path: app/tests/test_serialization.py
+
+ROWS = [{"path": "a.b", "stats": {"sessions": 3}}, {"path": "line\nbreak", "stats": {"sessions": 1}}]
+
+def split(payload: bytes, size: int):
+    return [payload[start:start + size] for start in range(0, len(payload), size)]
+
+@pytest.mark.parametrize("format, data", [(JSON, {"children": ROWS}), (JSON_ROWS, ROWS), (JSON_ROWS, [])])
+def test_payload_round_trip(format, data):
+    encoded = encode(data, format)
+    codec, compressed = compress(pack_payload(encoded, format))
+
+    # read back in chunks, as from the chunk documents of the cache
+    assert unpack_payload(decompress(codec, split(compressed, 7)), format) == encoded
+
+def test_rows_never_contain_a_newline():
+    payload = pack_payload(encode(ROWS, JSON_ROWS), JSON_ROWS)
+
+    assert [loads(row) for row in unpack_payload(payload, JSON_ROWS)] == ROWS
+
+def test_identity_and_zlib():
+    payload = dumps(ROWS) * 10
+
+    assert decompress(IDENTITY, split(payload, 10)) == payload
+    assert decompress("zlib", split(zlib.compress(payload), 3)) == payload
+
+def test_unreadable_payloads():
+    with pytest.raises(ValueError):
+        decompress("lz4", [b"x"])
+
+    with pytest.raises(ValueError):
+        decompress("zlib", [b"not zlib"])
+
+def test_iter_json_rows():
+    rows = encode(ROWS, JSON_ROWS)
+
+    assert loads(b"".join(iter_json_rows(rows))) == ROWS
+    assert b"".join(iter_json_rows([])) == b"[]"
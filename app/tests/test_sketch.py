@@ -0,0 +1,66 @@
+import pytest
+
+from sketch import DistinctSketch, PeriodStats, SKETCH_ERROR, merge_period_stats, precision_for_error
+
+# Path: app/tests/test_sketch.py
+
+# estimates are checked within 4 standard errors, the hashes are deterministic so the tests are too
+TOLERANCE = 4 * SKETCH_ERROR
+
+def assert_close(estimate: int, expected: int):
+    assert abs(estimate - expected) <= TOLERANCE * expected, (estimate, expected)
+
+def test_exact_below_threshold():
+    sketch = DistinctSketch.from_agents([1, 2, 2, 3], exact_threshold=10)
+
+    assert sketch.is_exact
+    assert sketch.count() == 3
+
+def test_precision_for_error():
+    assert precision_for_error(0.01) == 14
+    assert precision_for_error(1) == 4
+    assert precision_for_error(0.0001) == 18
+
+@pytest.mark.parametrize("agents", [5000, 50000])
+def test_estimate_error(agents):
+    sketch = DistinctSketch.from_agents(range(agents), exact_threshold=100)
+
+    assert not sketch.is_exact
+    assert_close(sketch.count(), agents)
+
+def test_merge_counts_the_union():
+    left = DistinctSketch.from_agents(range(0, 30000), exact_threshold=100)
+    right = DistinctSketch.from_agents(range(20000, 50000), exact_threshold=100)
+    small = DistinctSketch.from_agents([49999, 50000, 50001], exact_threshold=100)
+
+    assert_close(left.copy().merge(right).merge(small).count(), 50002)
+    # merging an exact sketch into a HyperLogLog and the reverse give the same registers
+    assert small.copy().merge(left).registers == left.copy().merge(small).registers
+
+def test_merge_precision_mismatch():
+    left = DistinctSketch.from_agents(range(200), precision=10, exact_threshold=100)
+    right = DistinctSketch.from_agents(range(200), precision=12, exact_threshold=100)
+
+    with pytest.raises(ValueError):
+        left.merge(right)
+
+def test_document_round_trip():
+    for sketch in (DistinctSketch.from_agents([1, 2, 3], exact_threshold=10), DistinctSketch.from_agents(range(1000), exact_threshold=10)):
+        restored = DistinctSketch.from_document(sketch.to_document(), exact_threshold=10)
+
+        assert restored.count() == sketch.count()
+        assert restored.registers == sketch.registers
+
+def test_period_stats_merge():
+    ios, android = PeriodStats(), PeriodStats()
+    ios.add("IOS", 10, DistinctSketch.from_agents([1, 2, 3]))
+    android.add("Android", 4, DistinctSketch.from_agents([3, 4]))
+    android.add("IOS", 1, DistinctSketch.from_agents([5]))
+
+    stats = merge_period_stats([ios, android]).to_stats()
+
+    # an agent on two device_os is one distinct user of the period
+    assert stats == {"dist_users": 5, "sessions": 15, "device_os": [
+        {"_id": "IOS", "sessions": 11, "dist_users": 4},
+        {"_id": "Android", "sessions": 4, "dist_users": 2},
+    ]}
@@ -0,0 +1,183 @@
+from utils import *
+from cache import to_day, covered_dates, get_dates_version
+from miniapp_journey import get_first_nodes, get_top_journeys_from_node, get_path_tree
+from serialization import loads
+from mongo import wait_for_mongo
+from rollup import USE_ROLLUPS, refresh_rollups
+
+from concurrent.futures import ThreadPoolExecutor
+import time
+
+from pymongo import ASCENDING, IndexModel, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+# Path: app/warmer.py
+
+# Cache warming worker, run next to the FastAPI app. It precomputes first nodes, top paths and trees of the recent
+# journey dates so interactive requests hit warm caches. Every pass first rolls up again the days changed by the
+# ingestion since their last rollup, the warmed results then read the fresh rollups.
+#
+# Jobs are documents of cache_warming_jobs, claimed with a lease: a crashed worker's jobs are picked up again once
+# their lease expires, failed jobs are retried by the next planning pass, and a job already done at the current
+# data version is never planned twice.
+#
+#   python warmer.py [--workers 4] [--lookback-days 2] [--interval 300] [--once]
+
+warming_job_collection = journey_db["cache_warming_jobs"]
+
+WARMING_JOB_INDEXES = [
+    IndexModel([("status", ASCENDING), ("lease_until", ASCENDING)], name="status_lease_until"),
+]
+
+# device_os values warmed, None is the "all platforms" dashboard
+COMMON_DEVICE_OS = [None, "IOS", "Android"]
+# per-first-node top paths and depth-1 trees are warmed for this many first nodes
+TOP_FIRST_NODES = int(os.environ.get("WARMER_TOP_FIRST_NODES", 10))
+LEASE_SECONDS = int(os.environ.get("WARMER_LEASE_SECONDS", 600))
+
+def job_id(kind: str, ds: datetime, granularity: Granularity, device_os: Optional[str], node_name: Optional[str] = None) -> str:
+    return "|".join([kind, ds.strftime("%Y-%m-%d"), str(granularity.value), device_os or "", node_name or ""])
+
+def enqueue_job(kind: str, ds: datetime, granularity: Granularity, device_os: Optional[str], node_name: Optional[str] = None) -> bool:
+    """
+    Add a pending job unless the same job is already planned at the current data version
+
+    :return: whether the job was (re)queued
+    """
+    _id = job_id(kind, ds, granularity, device_os, node_name)
+    version = get_dates_version(covered_dates(ds, granularity, with_previous=True))
+
+    job = SON(_id=_id, kind=kind, ds=ds, granularity=granularity.value, device_os=device_os, node_name=node_name,
+        version=version, status="pending", lease_until=None, created_at=datetime.utcnow())
+
+    try:
+        warming_job_collection.insert_one(job)
+        return True
+    except DuplicateKeyError:
+        pass
+
+    # the data changed since the job ran or it failed, warm it again
+    result = warming_job_collection.update_one({"_id": _id, "$or": [{"version": {"$ne": version}}, {"status": "failed"}]}, {"$set": {"version": version, "status": "pending", "lease_until": None}})
+
+    return result.modified_count > 0
+
+def plan_jobs(lookback_days: int = 2, today: Optional[datetime] = None) -> int:
+    """
+    Queue the base jobs of the journey dates of the last lookback_days days, and again their failed jobs
+
+    The weekly dashboards warmed are the weeks ending on each of those dates. A failed first_node job is queued again
+    here, its base job is not run again until the data changes.
+    """
+    today = to_day(today or datetime.utcnow())
+    queued = 0
+    planned = []
+
+    for i in range(1, lookback_days + 1):
+        day = today - timedelta(days=i)
+
+        if miniapp_collection.find_one({"journey_date": {"$gte": day, "$lt": day + timedelta(days=1)}}, {"_id": 1}) is None:
+            continue
+
+        for granularity in Granularity:
+            ds = day - timedelta(days=int(granularity) - 1)
+
+            planned.append(ds)
+
+            for device_os in COMMON_DEVICE_OS:
+                queued += enqueue_job("base", ds, granularity, device_os)
+
+    for job in warming_job_collection.find({"status": "failed", "ds": {"$in": planned}}):
+        queued += enqueue_job(job["kind"], job["ds"], Granularity(job["granularity"]), job["device_os"], job["node_name"])
+
+    return queued
+
+def claim_job() -> Optional[Dict]:
+    now = datetime.utcnow()
+
+    return warming_job_collection.find_one_and_update(
+        {"$or": [{"status": "pending"}, {"status": "running", "lease_until": {"$lt": now}}]},
+        {"$set": {"status": "running", "lease_until": now + timedelta(seconds=LEASE_SECONDS)}},
+        sort=[("created_at", ASCENDING)],
+        return_document=ReturnDocument.AFTER)
+
+def run_job(job: Dict):
+    ds = job["ds"]
+    granularity = Granularity(job["granularity"])
+    device_os = job["device_os"]
+
+    if job["kind"] == "base":
+        get_first_nodes(ds, granularity, device_os)
+        ranking = [loads(row) for row in get_top_journeys_from_node(ds, granularity, None, device_os)]
+        get_path_tree(ds, granularity, None, 0, device_os)
+
+        # first nodes ordered by the sessions of the top paths starting there
+        first_node_sessions = {}
+        for row in ranking:
+            first_node = row["path"].split(".")[0]
+            first_node_sessions[first_node] = first_node_sessions.get(first_node, 0) + row["stats"]["sessions"]
+
+        for first_node in sorted(first_node_sessions, key=first_node_sessions.get, reverse=True)[:TOP_FIRST_NODES]:
+            enqueue_job("first_node", ds, granularity, device_os, first_node)
+
+    elif job["kind"] == "first_node":
+        get_top_journeys_from_node(ds, granularity, job["node_name"], device_os)
+        get_path_tree(ds, granularity, job["node_name"], 1, device_os)
+
+def work(job: Dict) -> Tuple[str, Optional[str]]:
+    try:
+        run_job(job)
+    except Exception as e:
+        # the lease is released, the job is retried by the next planning pass
+        warming_job_collection.update_one({"_id": job["_id"]}, {"$set": {"status": "failed", "lease_until": None, "error": repr(e)}})
+        return job["_id"], repr(e)
+
+    warming_job_collection.update_one({"_id": job["_id"], "version": job["version"]}, {"$set": {"status": "done", "lease_until": None, "done_at": datetime.utcnow()}, "$unset": {"error": ""}})
+
+    return job["_id"], None
+
+def progress() -> Dict[str, int]:
+    return {row["_id"]: row["count"] for row in warming_job_collection.aggregate([{"$group": {"_id": "$status", "count": {"$sum": 1}}}])}
+
+def run_pending_jobs(workers: int = 4) -> int:
+    """
+    Run the pending jobs, at most `workers` at a time, until the queue is empty
+
+    :return: number of jobs run
+    """
+    done = 0
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            jobs = [job for job in (claim_job() for _ in range(workers)) if job is not None]
+
+            if not jobs:
+                return done
+
+            for _id, error in executor.map(work, jobs):
+                done += 1
+                print("warmed" if error is None else "failed", _id, error or "", progress())
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Precompute the caches of the recent journey dates")
+    parser.add_argument("--workers", type=int, default=4, help="jobs run in parallel")
+    parser.add_argument("--lookback-days", type=int, default=2, help="journey dates before today to warm")
+    parser.add_argument("--interval", type=int, default=300, help="seconds between two planning passes")
+    parser.add_argument("--once", action="store_true", help="plan and run the jobs once, then exit")
+    args = parser.parse_args()
+
+    wait_for_mongo()
+    warming_job_collection.create_indexes(WARMING_JOB_INDEXES)
+
+    while True:
+        if USE_ROLLUPS:
+            print("rolled up days:", len(refresh_rollups()))
+
+        print("planned jobs:", plan_jobs(args.lookback_days))
+        print("ran jobs:", run_pending_jobs(args.workers), progress())
+
+        if args.once:
+            break
+
+        time.sleep(args.interval)